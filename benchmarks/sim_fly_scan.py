@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''
+    End-to-end benchmark of scan.fly_scan on the simulated beamline.
+
+    Runs a complete fly scan (flats, darks, PSO fly motion, HDF file and
+    theta) against tomo7bm.sim and reports the wall time next to the time
+    the rotation itself needs, plus the frames written and dropped.  Extra
+    arguments are passed on as scan options, e.g.
+
+        python benchmarks/sim_fly_scan.py --num-projections 361 --exposure-time 0.005
+'''
+import os
+import glob
+import time
+import argparse
+import tempfile
+
+import h5py
+
+from tomo7bm import config
+from tomo7bm import log
+from tomo7bm import sim
+from tomo7bm import scan
+
+SCAN_DEFAULTS = ['--num-projections', '181', '--num-white-images', '5', '--num-dark-images', '5',
+                 '--exposure-time', '0.01', '--bright-exposure-time', '0.01', '--retrace-speed', '60']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frame-rate', type=float, default=sim.MAX_FRAME_RATE,
+                        help='maximum frame rate of the simulated camera (Hz)')
+    parser.add_argument('--disk-rate', type=float, default=None,
+                        help='rate (frames/s) the simulated HDF writer stores frames; default keeps up')
+    args, scan_args = parser.parse_known_args()
+
+    work_dir = tempfile.mkdtemp(prefix='tomo7bm_bench_')
+    log.setup_custom_logger(os.path.join(work_dir, 'sim_fly_scan.log'))
+    beamline = sim.install(args.frame_rate, os.path.join(work_dir, 'data'), args.disk_rate)
+
+    scan_parser = argparse.ArgumentParser()
+    config.Params(sections=config.SCAN_PARAMS).add_arguments(scan_parser)
+    params = scan_parser.parse_args(['--config', os.path.join(work_dir, 'tomo7bm.conf')]
+                                    + SCAN_DEFAULTS + scan_args)
+
+    start = time.perf_counter()
+    scan.fly_scan(params)
+    elapsed = time.perf_counter() - start
+
+    rotation_time = abs(params.sample_rotation_end - params.sample_rotation_start) / params.slew_speed
+    print('total scan time     {:8.2f} s'.format(elapsed))
+    print('rotation time       {:8.2f} s  ({:.1f} deg/s)'.format(rotation_time, params.slew_speed))
+    print('overhead            {:8.2f} s'.format(elapsed - rotation_time))
+    print('PSO pulses          {:8d}'.format(beamline.pso.pulses))
+    print('dropped frames      {:8d}'.format(beamline.camera.dropped_frames))
+    for file_name in sorted(glob.glob(os.path.join(work_dir, 'data', '*.h5'))):
+        with h5py.File(file_name, 'r') as f:
+            shapes = ', '.join('{:s} {:d}'.format(name, f['exchange'][name].shape[0])
+                               for name in f['exchange'])
+        print('{:s}: {:s}'.format(os.path.basename(file_name), shapes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+'''
+    Latency benchmark for tomo7bm.pvs.wait_pv.
+
+    Compares the event-driven waiter with the old 10 ms polling loop on a
+    simulated PV whose value changes from another thread.  Each get() on the
+    simulated PV costs one simulated Channel Access round trip.
+
+    Usage:  python benchmarks/wait_pv_latency.py [--trials N] [--rtt SECONDS]
+'''
+import time
+import random
+import argparse
+import threading
+
+from tomo7bm import pvs
+
+
+class SimPV():
+    '''Minimal stand-in for an epics.PV with monitor callbacks.
+    '''
+    def __init__(self, pvname, value=0, rtt=0.0005):
+        self.pvname = pvname
+        self.value = value
+        self.rtt = rtt
+        self.num_gets = 0
+        self.callbacks = {}
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+    def get(self, **kw):
+        self.num_gets += 1
+        time.sleep(self.rtt)
+        return self.value
+
+    def put(self, value, **kw):
+        self.value = value
+        with self._lock:
+            callbacks = list(self.callbacks.values())
+        for callback in callbacks:
+            callback(pvname=self.pvname, value=value)
+
+    def add_callback(self, callback, **kw):
+        with self._lock:
+            self._next_index += 1
+            self.callbacks[self._next_index] = callback
+            return self._next_index
+
+    def remove_callback(self, index):
+        with self._lock:
+            self.callbacks.pop(index, None)
+
+
+def poll_wait_pv(pv, wait_val, max_timeout_sec=-1):
+    '''The polling version of wait_pv used before the event-driven one.
+    '''
+    time.sleep(.01)
+    startTime = time.time()
+    while True:
+        pv_val = pv.get()
+        if type(pv_val) == float:
+            if abs(pv_val - wait_val) < pvs.EPSILON:
+                return True
+        if (pv_val != wait_val):
+            if max_timeout_sec > -1:
+                if time.time() - startTime >= max_timeout_sec:
+                    return False
+            time.sleep(.01)
+        else:
+            return True
+
+
+def measure(wait_func, trials, rtt):
+    '''Returns a list of latencies (s) between the PV change and the waiter
+    returning, plus the average number of gets per wait.
+    '''
+    latencies = []
+    gets = 0
+    for i in range(trials):
+        pv = SimPV('sim:Acquire', 1, rtt)
+        changed_at = []
+
+        def change():
+            time.sleep(random.uniform(0.02, 0.08))
+            changed_at.append(time.perf_counter())
+            pv.put(0)
+
+        t = threading.Thread(target=change)
+        t.start()
+        assert wait_func(pv, 0, 5)
+        latencies.append(time.perf_counter() - changed_at[0])
+        t.join()
+        gets += pv.num_gets
+    return latencies, gets / trials
+
+
+def report(name, latencies, gets):
+    latencies = sorted(latencies)
+    mean = sum(latencies) / len(latencies)
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    print('{:<14s} mean {:7.3f} ms   p95 {:7.3f} ms   max {:7.3f} ms   gets/wait {:6.1f}'.format(
+            name, mean * 1e3, p95 * 1e3, latencies[-1] * 1e3, gets))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=50, help='number of waits per method')
+    parser.add_argument('--rtt', type=float, default=0.0005, help='simulated CA round trip (s)')
+    args = parser.parse_args()
+
+    report('polling', *measure(poll_wait_pv, args.trials, args.rtt))
+    report('event-driven', *measure(pvs.wait_pv, args.trials, args.rtt))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+import argparse
+
+import pytest
+
+from tomo7bm import config
+from tomo7bm import pso
+from tomo7bm import pvs
+from tomo7bm import sim
+
+
+@pytest.fixture
+def make_params(tmp_path):
+    '''Returns a function that parses scan options into params, as tomo scan does.
+    '''
+    def make(*args):
+        parser = argparse.ArgumentParser()
+        config.Params(sections=config.SCAN_PARAMS).add_arguments(parser)
+        return parser.parse_args(['--config', str(tmp_path / 'tomo7bm.conf')] + list(args))
+    return make
+
+
+@pytest.fixture
+def beamline(tmp_path):
+    '''The simulated beamline as the PV backend, for one test.
+    '''
+    beamline = sim.install(file_path=str(tmp_path / 'data'))
+    yield beamline
+    pvs.set_backend(None)
+    pso.driver = None
@@ -0,0 +1,55 @@
+import math
+
+import pytest
+
+from tomo7bm import estimate
+
+
+def test_move_time():
+    assert estimate.move_time(0.0, 2.0, 1.0) == 0.0
+    assert estimate.move_time(10.0, 2.0, 0.0) == 5.0
+    # Trapezoid: full speed after the acceleration time
+    assert estimate.move_time(10.0, 2.0, 1.0) == 6.0
+    assert estimate.move_time(-10.0, 2.0, 1.0) == 6.0
+    # Triangle: never reaches full speed
+    assert estimate.move_time(1.0, 2.0, 1.0) == pytest.approx(2 * math.sqrt(0.5))
+    # The two meet where the move just reaches full speed
+    assert estimate.move_time(2.0, 2.0, 1.0) == pytest.approx(2.0)
+    assert estimate.move_time(2.0 + 1e-9, 2.0, 1.0) == pytest.approx(2.0)
+
+
+def scan_params(make_params, *args):
+    return make_params('--num-projections', '181', '--exposure-time', '0.01', '--ccd-readout', '0.0',
+                       '--slew_speed', '1.0', *args)
+
+
+def test_manual_slew_speed(make_params):
+    params = scan_params(make_params, '--auto-slew-speed', 'manual')
+    timer = estimate.estimate_scan(params)
+    assert timer.speed_source == 'manual'
+    assert timer.params.slew_speed == 1.0
+    assert timer.phases['rotation'] > 180.0
+
+
+def test_auto_slew_speed(make_params):
+    params = scan_params(make_params, '--auto-slew-speed', 'acquisition')
+    timer = estimate.estimate_scan(params)
+    assert timer.speed_source == 'acquisition time'
+    # 100 Hz at one degree per projection
+    assert timer.params.slew_speed == pytest.approx(100.0)
+    assert timer.phases['rotation'] < 5.0
+    # The params of the caller are left alone
+    assert params.slew_speed == 1.0
+
+
+def test_camera_limit(make_params):
+    params = scan_params(make_params, '--auto-slew-speed', 'acquisition')
+    timer = estimate.estimate_scan(params, camera_max_framerate=20.0)
+    assert timer.speed_source == 'camera link'
+    assert timer.params.slew_speed == pytest.approx(20.0)
+
+
+def test_phases_are_floats(make_params):
+    timer = estimate.estimate_scan(scan_params(make_params, '--scan-type', 'mosaic'))
+    assert all(type(seconds) is float for seconds in timer.phases.values())
+    assert timer.total() == pytest.approx(sum(timer.phases.values()))
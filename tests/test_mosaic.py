@@ -0,0 +1,63 @@
+import pytest
+
+from tomo7bm import mosaic
+
+DYNAMICS = {'Motor_SampleX': (1.0, 0.0), 'Motor_SampleY': (1.0, 0.0)}
+
+
+def mosaic_params(make_params, *args):
+    return make_params('--vertical-scan-start', '0', '--vertical-scan-end', '2', '--vertical-scan-step-size', '1',
+                       '--horizontal-scan-start', '0', '--horizontal-scan-end', '2',
+                       '--horizontal-scan-step-size', '1', '--flat-dark-policy', 'once', *args)
+
+
+def positions(tiles):
+    return [(tile.y, tile.x) for tile in tiles]
+
+
+def test_grid_includes_both_ends(make_params):
+    tiles = mosaic.grid(mosaic_params(make_params))
+    assert len(tiles) == 9
+    assert tiles[0] == mosaic.Tile(0, 0, 0.0, 0.0)
+    assert tiles[-1] == mosaic.Tile(2, 2, 2.0, 2.0)
+
+
+def test_serpentine_reverses_odd_rows(make_params):
+    tiles = mosaic.serpentine(mosaic.grid(mosaic_params(make_params)))
+    assert [(tile.v, tile.h) for tile in tiles] == [(0, 0), (0, 1), (0, 2), (1, 2), (1, 1), (1, 0),
+                                                    (2, 0), (2, 1), (2, 2)]
+
+
+@pytest.mark.parametrize('order', mosaic.ORDERS)
+def test_every_order_visits_every_tile_once(make_params, order):
+    params = mosaic_params(make_params)
+    tiles = mosaic.plan_tiles(params, DYNAMICS, order)
+    assert sorted(tiles) == sorted(mosaic.grid(params))
+
+
+def test_raster_order(make_params):
+    params = mosaic_params(make_params)
+    assert mosaic.plan_tiles(params, DYNAMICS, 'raster') == mosaic.grid(params)
+
+
+def test_nearest_starts_next_to_the_start(make_params):
+    tiles = mosaic.nearest(mosaic.grid(mosaic_params(make_params)), DYNAMICS, (2.0, 2.0))
+    assert positions(tiles)[0] == (2.0, 2.0)
+
+
+def test_auto_picks_the_quickest(make_params):
+    params = mosaic_params(make_params)
+    start = (0.0, 0.0)
+    tiles = mosaic.plan_tiles(params, DYNAMICS, 'auto')
+    times = {order: mosaic.travel_time(mosaic.plan_tiles(params, DYNAMICS, order), DYNAMICS, start)
+             for order in mosaic.ORDERS}
+    assert mosaic.travel_time(tiles, DYNAMICS, start) == min(times.values())
+    assert times['serpentine'] < times['raster']
+
+
+def test_travel_time(make_params):
+    tiles = mosaic.grid(mosaic_params(make_params))[:3]
+    # Out along the row and straight back, Y and X moving together
+    assert mosaic.travel_time(tiles, DYNAMICS, (0.0, 0.0)) == 4.0
+    # plus out to (5, 0) and back at each tile
+    assert mosaic.travel_time(tiles, DYNAMICS, (0.0, 0.0), (5.0, 0.0)) == 4.0 + 2 * 3 * 5.0
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+from tomo7bm import pipeline
+
+
+def fail(name):
+    raise RuntimeError(name + ' failed')
+
+
+def test_steps_run_in_order():
+    finalizer = pipeline.Finalizer()
+    done = []
+    finalizer.submit_close(done.append, 'close')
+    finalizer.submit_check(done.append, 'check')
+    finalizer.submit(done.append, 'scp')
+    finalizer.wait_finished()
+    assert done == ['close', 'check', 'scp']
+
+
+def test_failed_check_skips_the_rest_of_the_file():
+    finalizer = pipeline.Finalizer()
+    done = []
+    finalizer.submit_close(done.append, 'close 1')
+    finalizer.submit_check(fail, 'theta 1')
+    finalizer.submit(done.append, 'config 1')
+    finalizer.submit(done.append, 'scp 1')
+    with pytest.raises(RuntimeError, match='theta 1'):
+        finalizer.wait_closed()
+    # The next file is finished again
+    finalizer.submit_close(done.append, 'close 2')
+    finalizer.submit(done.append, 'scp 2')
+    finalizer.wait_finished()
+    assert done == ['close 1', 'close 2', 'scp 2']
+
+
+def test_cancel():
+    finalizer = pipeline.Finalizer()
+    running = threading.Event()
+    release = threading.Event()
+    done = []
+
+    def close():
+        running.set()
+        release.wait()
+        fail('close')
+    finalizer.submit_close(close)
+    finalizer.submit_check(done.append, 'check')
+    finalizer.submit(done.append, 'scp')
+    running.wait()
+    release.set()
+    errors = finalizer.cancel()
+    assert [str(error) for error in errors] == ['close failed']
+    assert done == []
+    # Nothing is left to wait for or raise
+    finalizer.wait_closed()
+    finalizer.wait_finished()
@@ -0,0 +1,186 @@
+import math
+
+import numpy as np
+import pytest
+
+from tomo7bm import pso
+
+# 1000 encoder counts per degree, 0.5 s to reach speed
+STAGE = pso.StageDescription(1000.0, 0.5, 0, 1)
+
+
+def encoder_counts(plan, stage):
+    '''Encoder counts of the PSO positions of plan from the arm position.
+    '''
+    motor_dir = -1 if stage.direction else 1
+    return ((plan.PSO_positions - plan.PSO_positions[0]) * motor_dir
+                * stage.encoder_direction * stage.encoder_multiply)
+
+
+def test_compute_plan_forward():
+    plan = pso.compute_plan(0.0, 180.0, 181, 1, 10.0, STAGE)
+    assert plan.delta_encoder_counts == 1000
+    assert plan.delta_egu == 1.0
+    assert plan.user_direction == 1
+    assert plan.overall_sense == 1
+    # Taxi over the 2.5 deg acceleration distance, rounded up, plus half a spacing
+    assert plan.taxi_dist == 3.5
+    assert (plan.motor_start, plan.motor_end) == (-3.5, 183.5)
+    assert (plan.window_start, plan.window_end) == (-500, 180500)
+    np.testing.assert_allclose(plan.proj_positions, np.arange(181.0))
+    assert plan.time_estimate == pytest.approx(187.0 / 10.0 + 0.5)
+
+
+@pytest.mark.parametrize('start, end', [(0.0, 180.0), (180.0, 0.0), (-20.0, 70.0)])
+@pytest.mark.parametrize('direction', [0, 1])
+@pytest.mark.parametrize('encoder_direction', [1, -1])
+def test_window_holds_every_pulse(start, end, direction, encoder_direction):
+    stage = pso.StageDescription(1000.0, 0.5, direction, encoder_direction)
+    plan = pso.compute_plan(start, end, 91, 1, 10.0, stage)
+    counts = encoder_counts(plan, stage)
+    assert plan.window_start < plan.window_end
+    # The window reaches half a spacing past the first and last pulse
+    assert plan.window_start == pytest.approx(counts.min() - plan.delta_encoder_counts / 2)
+    assert plan.window_end == pytest.approx(counts.max() + plan.delta_encoder_counts / 2)
+    # The motor runs from before the first pulse to past the last one
+    assert (plan.motor_end - plan.motor_start) * (end - start) > 0
+    assert abs(plan.motor_start - start) == abs(plan.motor_end - end) == plan.taxi_dist
+
+
+def test_images_per_projection():
+    plan = pso.compute_plan(0.0, 180.0, 91, 4, 10.0, STAGE)
+    assert len(plan.PSO_positions) == 4 * 91
+    assert plan.delta_encoder_counts == 500
+    assert plan.proj_positions[-1] == 180.0
+
+
+def test_non_integral_spacing_is_rounded():
+    plan = pso.compute_plan(0.0, 10.0, 4, 1, 10.0, STAGE)
+    assert plan.delta_encoder_counts == 3333
+    assert plan.actual_end == pytest.approx(9.999)
+
+
+def test_reverse_plan_measures_the_same_angles():
+    plan = pso.compute_plan(0.0, 10.0, 4, 1, 10.0, STAGE)
+    reverse = pso.reverse_plan(plan, STAGE)
+    assert reverse.user_direction == -plan.user_direction
+    assert reverse.req_start == plan.proj_positions[-1]
+    assert reverse.delta_encoder_counts == plan.delta_encoder_counts
+    np.testing.assert_allclose(reverse.proj_positions[::-1], plan.proj_positions, atol=1e-12)
+    # and back again
+    forward = pso.reverse_plan(reverse, STAGE)
+    np.testing.assert_allclose(forward.proj_positions, plan.proj_positions, atol=1e-12)
+
+
+def test_plans_are_memoized():
+    assert pso.compute_plan(0.0, 180.0, 181, 1, 10.0, STAGE) is pso.compute_plan(0.0, 180.0, 181, 1, 10.0, STAGE)
+
+
+def test_plan_fly_scan(make_params):
+    params = make_params('--num-projections', '91', '--sample-rotation-start', '0', '--sample-rotation-end', '180',
+                         '--slew_speed', '10', '--recursive-filter', '--recursive-filter-n-images', '4')
+    plan = pso.plan_fly_scan(params, STAGE)
+    assert plan is pso.compute_plan(0.0, 180.0, 91, 4, 10.0, STAGE)
+    params.recursive_filter = False
+    assert pso.plan_fly_scan(params, STAGE).num_images_per_proj == 1
+
+
+def test_interlace_fraction():
+    assert pso.interlace_fraction('none', 4) == 0.0
+    assert pso.interlace_fraction('uniform', 4) == 0.25
+    assert pso.interlace_fraction('golden', 4) == pytest.approx((3.0 - math.sqrt(5.0)) / 2.0)
+
+
+def continuous_params(make_params, num_proj):
+    return make_params('--num-projections', str(num_proj), '--sample-rotation-start', '0',
+                       '--sample-rotation-end', '180')
+
+
+def test_continuous_segments_repeat(make_params):
+    params = continuous_params(make_params, 100)
+    plan = pso.plan_continuous_scan(params, STAGE, 4)
+    assert plan.num_proj == 400
+    assert plan.delta_encoder_counts == 1800
+    np.testing.assert_array_equal(np.bincount(pso.subscan_index(plan, 180.0)), [100] * 4)
+    angles = plan.proj_positions.reshape(4, 100) - 180.0 * np.arange(4)[:, None]
+    np.testing.assert_allclose(angles, np.tile(angles[0], (4, 1)), atol=1e-9)
+
+
+def test_continuous_spacing_is_whole_counts(make_params):
+    params = continuous_params(make_params, 7)
+    plan = pso.plan_continuous_scan(params, STAGE, 3)
+    # 180 deg / 7 is 25714.29 counts
+    assert plan.delta_encoder_counts == 25714
+    assert plan.delta_egu == 25.714
+    # Each turn falls short by 7 spacings less the range
+    drift = plan.proj_positions[14] - 2 * 180.0 - plan.proj_positions[0]
+    assert drift == pytest.approx(2 * (7 * 25.714 - 180.0))
+
+
+@pytest.mark.parametrize('mode', ['uniform', 'golden'])
+@pytest.mark.parametrize('num_segments', [2, 4, 5])
+def test_interlaced_segment_counts(make_params, mode, num_segments):
+    params = continuous_params(make_params, 100)
+    fraction = pso.interlace_fraction(mode, num_segments)
+    plan = pso.plan_continuous_scan(params, STAGE, num_segments, fraction)
+    assert plan.num_proj == math.ceil(num_segments * (100 + fraction))
+    counts = np.bincount(pso.subscan_index(plan, 180.0))
+    assert len(counts) == num_segments
+    assert counts.sum() == plan.num_proj
+    assert set(counts) <= {100, 101}
+    # Each turn is shifted from the one before
+    starts = np.flatnonzero(np.diff(pso.subscan_index(plan, 180.0))) + 1
+    shifts = (plan.proj_positions[starts] - plan.req_start) % 180.0
+    assert np.all(shifts > 0) and np.all(shifts < plan.delta_egu)
+
+
+def test_solve_spacing_exact_first():
+    options = pso.solve_spacing(180.0, 181, 2, 1000.0, 10.0)
+    best = options[0]
+    assert (best.num_proj, best.delta_encoder_counts, best.range_error) == (181, 1000, 0.0)
+    assert best.scan_time == 18.0
+    errors = [abs(option.range_error) for option in options]
+    assert errors == sorted(errors)
+    for option in options:
+        assert abs(option.num_proj - 181) <= 2
+        assert option.scan_range == pytest.approx(option.delta_encoder_counts * (option.num_proj - 1) / 1000.0)
+
+
+def test_solve_spacing_continuous():
+    # n projections span n spacings when the scan does not close
+    best = pso.solve_spacing(180.0, 181, 2, 1000.0, 10.0, closed=False)[0]
+    assert (best.num_proj, best.delta_encoder_counts, best.range_error) == (180, 1000, 0.0)
+
+
+def test_solve_spacing_time_budget():
+    options = pso.solve_spacing(180.0, 181, 2, 1000.0, 10.0, time_budget=17.95)
+    assert options
+    assert all(option.scan_time <= 17.95 for option in options)
+    assert all(option.num_proj < 181 for option in options)
+
+
+def test_frame_rate_limits(make_params):
+    params = make_params('--num-projections', '181', '--exposure-time', '0.01', '--ccd-readout', '0.0',
+                         '--permitted-blur', '0.5', '--auto-slew-speed', 'both')
+    delta_angle, limits = pso.frame_rate_limits(params, 500.0, camera_max_framerate=80.0)
+    assert delta_angle == 1.0
+    assert limits['acquisition time'] == pytest.approx(100.0)
+    assert limits['camera link'] == 80.0
+    assert limits['disk write rate'] == np.inf
+    assert limits['blur'] == pytest.approx(np.degrees(np.arcsin(0.5 / 500.0)) / 0.01)
+    params.auto_slew_speed = 'acquisition'
+    assert 'blur' not in pso.frame_rate_limits(params, 500.0)[1]
+
+
+def test_command_without_reply(beamline):
+    driver = pso.init_driver()
+    pso.set_default_speed(30.0)
+    assert driver.command('PSOCONTROL A RESET') == (True, '%')
+    assert driver.command('PSOBOGUS A 1') == (False, 'command error')
+    # The controller never answers
+    beamline.pso.command_pv.on_put = None
+    beamline.pso.reply_pv.update('')
+    assert driver.command('PSOCONTROL A OFF') == (False, 'no reply')
+    # stop_scan() goes on past the PSO cleanup
+    driver.cleanup_PSO()
+    assert driver.motor.get('VELO') == 30.0
@@ -0,0 +1,59 @@
+import pytest
+
+from tomo7bm import references
+
+
+def policy(make_params, *args):
+    return references.ReferencePolicy(make_params(*args))
+
+
+def test_first_scan_always_takes_references(make_params):
+    for name in ('every', 'once', 'every-n', 'every-minutes', 'drift'):
+        assert policy(make_params, '--flat-dark-policy', name).due(0.0)
+
+
+def test_every(make_params):
+    refs = policy(make_params, '--flat-dark-policy', 'every')
+    refs.taken('a.h5', 0.0)
+    assert refs.due(1.0)
+
+
+def test_once(make_params):
+    refs = policy(make_params, '--flat-dark-policy', 'once')
+    refs.taken('a.h5', 0.0)
+    for i in range(5):
+        assert not refs.due(1000.0 * i)
+        refs.skipped()
+
+
+def test_every_n(make_params):
+    refs = policy(make_params, '--flat-dark-policy', 'every-n', '--flat-dark-every', '3')
+    due = []
+    for i in range(7):
+        take = refs.due(float(i))
+        due.append(take)
+        refs.update('%d.h5' % i, take, float(i))
+    assert due == [True, False, False, True, False, False, True]
+
+
+def test_every_minutes(make_params):
+    refs = policy(make_params, '--flat-dark-policy', 'every-minutes', '--flat-dark-minutes', '2')
+    refs.taken('a.h5', 100.0)
+    assert not refs.due(219.0)
+    assert refs.due(220.0)
+
+
+def test_drift(make_params):
+    refs = policy(make_params, '--flat-dark-policy', 'drift', '--flat-drift-threshold', '0.05')
+    assert not refs.needs_check()
+    refs.taken('a.h5', 0.0, white=1100.0, dark=100.0)
+    assert refs.needs_check()
+    assert refs.drift(1050.0) == pytest.approx(0.05)
+    assert not refs.due(1.0, 1060.0)
+    assert refs.due(1.0, 1040.0)
+    assert not refs.due(1.0, 1149.0)
+    assert refs.due(1.0, 1151.0)
+    # No flat measured now, or none for the last set
+    assert refs.due(1.0, None)
+    refs.taken('b.h5', 2.0)
+    assert refs.due(3.0, 1100.0)
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+
+from tomo7bm import validate
+
+# Ten projections one degree apart at 10 deg/s: one pulse every 0.1 s
+THETA = np.arange(10.0)
+SPEED = 10.0
+PERIOD = 0.1
+
+
+def frames(pulses, unique_ids=None):
+    '''UniqueIds and time stamps of frames taken at pulses.
+    '''
+    pulses = np.asarray(pulses)
+    if unique_ids is None:
+        unique_ids = np.arange(1, len(pulses) + 1)
+    return np.asarray(unique_ids), 5.0 + pulses * PERIOD
+
+
+def test_all_frames():
+    check = validate.check_frames(*frames(range(10)), THETA, SPEED)
+    np.testing.assert_array_equal(check.pulse, np.arange(10))
+    assert check.valid.all()
+    assert (check.num_expected, check.num_missing, check.num_duplicate, check.num_outside,
+            check.num_mismatch) == (10, 0, 0, 0, 0)
+    assert check.ok()
+
+
+def test_missed_trigger():
+    # The camera missed pulse 3: the UniqueIds run on, the time stamps jump
+    pulses = [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    check = validate.check_frames(*frames(pulses), THETA, SPEED)
+    np.testing.assert_array_equal(check.pulse, pulses)
+    assert (check.num_missing, check.num_duplicate, check.num_mismatch) == (1, 0, 0)
+    assert not check.ok()
+    assert check.ok(max_missing=1)
+
+
+def test_frame_lost_after_camera():
+    # Frame 4 was taken but never stored: UniqueIds and time stamps both jump
+    pulses = [0, 1, 2, 3, 5, 6, 7, 8, 9]
+    check = validate.check_frames(*frames(pulses, [1, 2, 3, 4, 6, 7, 8, 9, 10]), THETA, SPEED)
+    np.testing.assert_array_equal(check.pulse, pulses)
+    assert (check.num_missing, check.num_duplicate, check.num_mismatch) == (1, 0, 0)
+
+
+def test_unique_ids_without_time_stamps():
+    unique_ids = np.array([1, 2, 3, 4, 6, 7, 8, 9, 10])
+    check = validate.check_frames(unique_ids, None, THETA, SPEED)
+    np.testing.assert_array_equal(check.pulse, [0, 1, 2, 3, 5, 6, 7, 8, 9])
+    assert check.num_missing == 1
+
+
+def test_duplicate_frame():
+    pulses = [0, 1, 2, 3, 3, 4, 5, 6, 7, 8, 9]
+    check = validate.check_frames(*frames(pulses, [1, 2, 3, 4, 4, 5, 6, 7, 8, 9, 10]), THETA, SPEED)
+    np.testing.assert_array_equal(check.pulse, pulses)
+    assert (check.num_missing, check.num_duplicate) == (0, 1)
+    # The first copy is the valid one
+    np.testing.assert_array_equal(np.flatnonzero(~check.valid), [4])
+    assert not check.ok(max_missing=5)
+
+
+def test_frame_outside_the_scan():
+    check = validate.check_frames(*frames(range(11)), THETA, SPEED)
+    assert (check.num_missing, check.num_duplicate, check.num_outside) == (0, 0, 1)
+    assert not check.valid[-1]
+    assert check.ok()
+
+
+def test_angles_anchor_the_first_frame():
+    # The first two pulses came before the camera was ready
+    pulses = np.arange(2, 10)
+    angles = THETA[pulses] + 0.01
+    check = validate.check_frames(*frames(pulses), THETA, SPEED, angles=angles)
+    np.testing.assert_array_equal(check.pulse, pulses)
+    assert check.num_missing == 2
+    # Without the angles the first frame is taken as the first projection
+    check = validate.check_frames(*frames(pulses), THETA, SPEED)
+    np.testing.assert_array_equal(check.pulse, np.arange(8))
+
+
+def test_reverse_scan():
+    theta = THETA[::-1]
+    angles = theta.copy()
+    angles[3] = np.nan
+    check = validate.check_frames(*frames(range(10)), theta, SPEED, angles=angles)
+    assert check.valid.all()
+
+
+def test_unique_ids_and_time_stamps_disagree():
+    # The UniqueId skips one, the time stamp says no frame is missing
+    unique_ids = np.array([1, 2, 4, 5, 6, 7, 8, 9, 10, 11])
+    check = validate.check_frames(unique_ids, frames(range(10))[1], THETA, SPEED)
+    assert check.num_mismatch == 1
+
+
+def test_several_ids_per_frame():
+    # With the recursive filter each stored frame counts n camera frames
+    unique_ids = 4 * np.arange(1, 11)
+    check = validate.check_frames(unique_ids, None, THETA, SPEED, ids_per_frame=4)
+    assert check.valid.all()
+
+
+def test_uniform():
+    assert validate.uniform(THETA)
+    assert validate.uniform(THETA[::-1])
+    assert not validate.uniform(np.array([0.0, 1.0, 3.0]))
+    assert not validate.uniform(np.zeros(3))
+    assert not validate.uniform(THETA[:1])
+
+
+@pytest.mark.parametrize('first, count, chunk', [(0, 10, 3), (4, 100, 4), (12, 5, 2)])
+def test_read_chunked(first, count, chunk):
+    data = np.arange(13)
+    np.testing.assert_array_equal(validate.read_chunked(data, first, count, chunk), data[first:first + count])
@@ -49,18 +49,18 @@ def find_resolution(params):
         flir.init(global_PVs, params)
         flir.set(global_PVs, params) 
 
-        dark_field, white_field = flir.take_dark_and_white(global_PVs, params, True)
+        dark_field, white_field = flir.take_dark_and_white(global_PVs, params, True, params.alignment_num_frames)
         start_position = global_PVs["Motor_SampleX"].drive    
         log.info('  *** First image at X: %f mm' % (start_position))
         log.info('  *** acquire first image')
-        sphere_0 = flir.take_image(global_PVs, params)
+        sphere_0 = flir.take_image(global_PVs, params, params.alignment_num_frames)
        
         second_image_x_position = start_position  + params.off_axis_position
         log.info('  *** Second image at X: %f mm' % (second_image_x_position))
         global_PVs["Motor_SampleX"].move(second_image_x_position, wait=True, timeout=600.0)
         time.sleep(0.5)
         log.info('  *** acquire second image')
-        sphere_1 = flir.take_image(global_PVs, params)
+        sphere_1 = flir.take_image(global_PVs, params, params.alignment_num_frames)
 
         log.info('  *** moving X stage back to %f mm position' % (start_position))
         aps7bm.close_shutters(global_PVs, params)
@@ -175,15 +175,15 @@ def take_sphere_0_180(global_PVs, params):
     '''Take images at 0 and 180 degrees, returning images as two arrays.
     '''
     try:
-        dark_field, white_field = flir.take_dark_and_white(global_PVs, params, True)
+        dark_field, white_field = flir.take_dark_and_white(global_PVs, params, True, params.alignment_num_frames)
         time.sleep(1)
         log.info('  *** Take first image of 0/180 degree set.')
-        image_0 = flir.take_image(global_PVs, params)
+        image_0 = flir.take_image(global_PVs, params, params.alignment_num_frames)
         log.info('  *** *** DONE')
         log.info('  *** Move stage 180 degrees.')
         global_PVs['Motor_SampleRot'].move(180, relative=True, wait=True)
         log.info('  *** Take second image of 0/180 degree set.')
-        image_180 = flir.take_image(global_PVs, params)
+        image_180 = flir.take_image(global_PVs, params, params.alignment_num_frames)
         log.info('  *** *** DONE')
         log.info('  *** Move stage back.')
         global_PVs['Motor_SampleRot'].move(-180, relative=True, wait=False)
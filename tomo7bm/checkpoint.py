@@ -0,0 +1,119 @@
+'''
+    Checkpoints for vertical and mosaic series.
+
+    A series is expanded into a list of tasks, one per scan, which is saved
+    as JSON next to the data and updated as each file is finished.  After a
+    fault, tomo scan --resume skips the tasks whose files are complete and
+    goes on from the first one that is not.
+'''
+import os
+import json
+
+import h5py
+
+from tomo7bm import log
+
+PENDING = 'pending'
+DONE = 'done'
+
+
+def task(index, repeat, v, h, y, x=None, suffix=''):
+    '''One scan of a series: repeat number, grid indices v and h, sample
+    position (x is None if the series does not move X) and file name suffix.
+    '''
+    return {'index': index, 'repeat': repeat, 'v': v, 'h': h, 'y': y, 'x': x,
+            'suffix': suffix, 'status': PENDING, 'file': None}
+
+
+def valid_file(file_name):
+    '''True if file_name is a closed scan file with its angles added, and
+    not failed by the dropped-frame check.
+    '''
+    if not file_name or not os.path.exists(file_name):
+        return False
+    try:
+        with h5py.File(file_name, 'r') as hdf_f:
+            num_frames = hdf_f['/exchange/data'].shape[0]
+            if '/exchange/theta_valid' in hdf_f and not hdf_f['/exchange/theta_valid'].attrs.get('ok', True):
+                return False
+            return num_frames > 0 and hdf_f['/exchange/theta'].shape[0] == num_frames
+    except (OSError, KeyError):
+        return False
+
+
+class Series():
+    '''Task list of a series of scans, saved to file_name.
+    '''
+    def __init__(self, file_name, scan_type, tasks):
+        self.file_name = file_name
+        self.scan_type = scan_type
+        self.tasks = tasks
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as f:
+            saved = json.load(f)
+        return cls(file_name, saved['scan_type'], saved['tasks'])
+
+    def save(self):
+        '''Writes the task list; a crash mid-write leaves the old one.
+        '''
+        temp_name = self.file_name + '.tmp'
+        with open(temp_name, 'w') as f:
+            json.dump({'scan_type': self.scan_type, 'tasks': self.tasks}, f, indent=1)
+        os.replace(temp_name, self.file_name)
+
+    def pending(self, repeat):
+        return [t for t in self.tasks if t['repeat'] == repeat and t['status'] != DONE]
+
+    def finished(self, task, file_name):
+        '''Marks task done once file_name is finished, unless it is not valid.
+        '''
+        if not valid_file(file_name):
+            log.warning('  *** Scan %d: %s is not valid, leave it to scan again' % (task['index'], file_name))
+            return
+        task['status'] = DONE
+        task['file'] = file_name
+        self.save()
+
+    def validate(self):
+        '''Marks the done tasks whose files are missing or incomplete as pending.
+        '''
+        for t in self.tasks:
+            if t['status'] == DONE and not valid_file(t['file']):
+                log.warning('  *** Scan %d: %s is incomplete, scan again' % (t['index'], t['file']))
+                t['status'] = PENDING
+                t['file'] = None
+
+
+def series_file(global_PVs, scan_type):
+    '''The checkpoint of a scan_type series of the current sample.
+    '''
+    return os.path.join(global_PVs['HDF1_FilePath'].get(as_string=True),
+                        global_PVs['Sample_Name'].get(as_string=True) + '_' + scan_type + '_series.json')
+
+
+def start_series(global_PVs, params, scan_type, tasks):
+    '''Returns the Series to run.  With params.resume, the saved series of
+    this sample if it has tasks left; otherwise a new one of tasks.
+    The resume flag only applies once, and is cleared.
+    '''
+    file_name = series_file(global_PVs, scan_type)
+    if params.resume:
+        params.resume = False
+        try:
+            series = Series.load(file_name)
+        except (OSError, ValueError, KeyError):
+            log.warning('  *** No %s series to resume in %s' % (scan_type, file_name))
+        else:
+            series.validate()
+            num_left = sum(t['status'] != DONE for t in series.tasks)
+            if series.scan_type == scan_type and num_left:
+                log.warning('  *** Resume %s: %d of %d scans left' % (file_name, num_left, len(series.tasks)))
+                series.save()
+                return series
+            log.warning('  *** Nothing to resume in %s' % file_name)
+    series = Series(file_name, scan_type, tasks)
+    series.save()
+    log.info('  *** Series of %d scans saved to %s' % (len(tasks), file_name))
+    return series
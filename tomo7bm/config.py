@@ -14,6 +14,8 @@ from tomo7bm import __version__
 home = os.path.expanduser("~")
 LOGS_HOME = os.path.join(home, 'logs')
 CONFIG_FILE_NAME = os.path.join(home, 'tomo7bm.conf')
+PV_USAGE_FILE = os.path.join(home, 'tomo7bm_pv_usage.json')
+THROUGHPUT_FILE = os.path.join(home, 'tomo7bm_throughput.json')
 
 SECTIONS = OrderedDict()
 
@@ -39,7 +41,19 @@ SECTIONS['general'] = {
     'testing': {
         'default': False,
         'help': 'If True, do not acutally open the shutters.',
-        'action': 'store_true'}
+        'action': 'store_true'},
+    'pv-connect-timeout': {
+        'default': 5.0,
+        'type': float,
+        'help': 'Overall time (s) to wait for all PVs to connect at startup.'},
+    'simulate': {
+        'default': False,
+        'help': 'If True, run against the simulated beamline in tomo7bm.sim instead of the IOCs.',
+        'action': 'store_true'},
+    'sim-max-frame-rate': {
+        'default': 160.0,
+        'type': float,
+        'help': 'Maximum frame rate (Hz) of the simulated camera.'},
         }
 
 SECTIONS['experiment-info'] = {
@@ -215,6 +229,28 @@ SECTIONS['scan'] = {
         'type': util.positive_int,
         'default': 20,
         'help': " "},
+    'flat-dark-policy': {
+        'default': 'every',
+        'choices': ['every', 'once', 'every-n', 'every-minutes', 'drift'],
+        'type': str,
+        'help': "When a series of scans takes flats and darks: every scan, once, every --flat-dark-every scans, every --flat-dark-minutes or on intensity drift."},
+    'flat-dark-every': {
+        'type': util.positive_int,
+        'default': 10,
+        'help': "Scans per set of flats and darks for --flat-dark-policy every-n."},
+    'flat-dark-minutes': {
+        'type': float,
+        'default': 30.0,
+        'help': "Minutes between sets of flats and darks for --flat-dark-policy every-minutes."},
+    'flat-drift-threshold': {
+        'type': float,
+        'default': 0.05,
+        'help': "Relative change of the flat intensity that triggers new flats and darks for --flat-dark-policy drift."},
+    'flat-dark-reuse': {
+        'default': 'copy',
+        'choices': ['copy', 'link'],
+        'type': str,
+        'help': "Scans without their own flats and darks get a copy of, or an HDF external link to, the last set."},
     'white-field-motion': {
         'choices': ['horizontal', 'vertical'],
         'default': 'horizontal',
@@ -252,6 +288,68 @@ SECTIONS['scan'] = {
         'type': util.positive_int,
         'default': 1,
         'help': " "},
+    'fly-stall-periods': {
+        'default': 10.0,
+        'type': float,
+        'help': "Stop a fly scan if no frame arrives for this many frame periods."},
+    'max-missing-frames': {
+        'default': 0,
+        'type': int,
+        'help': "Stop a series when a fly scan misses more than this many projections, or stores one twice."},
+    'live-check': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Check frames from the image1 plugin during fly scans, and stop a scan that loses the beam, saturates or whose sample drifts."},
+    'live-decimate': {
+        'default': 10,
+        'type': util.positive_int,
+        'help': "With --live-check, check every this many frames."},
+    'live-intensity-drop': {
+        'default': 0.5,
+        'type': float,
+        'help': "With --live-check, stop when the mean intensity falls by more than this fraction of the start."},
+    'live-max-saturation': {
+        'default': 0.01,
+        'type': float,
+        'help': "With --live-check, stop when more than this fraction of the pixels is saturated."},
+    'live-max-drift': {
+        'default': 50.0,
+        'type': float,
+        'help': "With --live-check, stop when the sample centroid moves up or down more than this many pixels from the start."},
+    'zigzag': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Alternate the rotation direction of repeated scans instead of retracing to the start."},
+    'continuous': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Take the --sleep-steps scans in one continuous rotation, into a single file with flats and darks before and after."},
+    'projection-window': {
+        'default': 0,
+        'type': int,
+        'help': "Look for projection counts within this many of --num-projections that give a whole number of encoder counts per PSO pulse."},
+    'scan-time-budget': {
+        'default': 0.0,
+        'type': float,
+        'help': "Longest rotation time (s) for the --projection-window options; 0 for no limit."},
+    'auto-projections': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Scan with the best --projection-window option instead of --num-projections."},
+    'interlace': {
+        'default': 'none',
+        'choices': ['none', 'golden', 'uniform'],
+        'type': str,
+        'help': "Continuous scan of --sleep-steps turns, each shifted by a golden ratio or 1/N fraction of the projection spacing."},
+    'resume': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Continue the last vertical or mosaic series of this sample from its first unfinished scan."},
+    'mosaic-order': {
+        'default': 'auto',
+        'choices': ['auto', 'raster', 'serpentine', 'nearest'],
+        'type': str,
+        'help': "Order of the mosaic tiles; auto picks the one with the least stage motion."},
     }
                                           
 SECTIONS['furnace'] = {                 # True: moves the furnace  to FurnaceYOut position to take white field: 
@@ -302,6 +400,23 @@ SECTIONS['stage-settings'] = {
         'default':  0.5,
         'type': float,
         'help': "If slew speed is calculated based on blur, how much blur is allowable."}, 
+    'throughput-calibration': {
+        'choices': ['auto', 'recalibrate', 'off'],
+        'default': 'auto',
+        'type': str,
+        'help': "Limit the frame rate by the measured camera link and disk write rates (auto: measure when older than --throughput-max-age), measure them again now, or use the nominal rates (off)."},
+    'throughput-disk-path': {
+        'default': None,
+        'type': str,
+        'help': "Directory on this computer, on the disk the HDF writer stores to, for the disk write rate test. Without it the disk is not measured."},
+    'throughput-disk-rate': {
+        'default': 200.0,
+        'type': float,
+        'help': "Nominal write rate (MB/s) of the disk the HDF writer stores to, used when it is not measured."},
+    'throughput-max-age': {
+        'default': 24.0,
+        'type': float,
+        'help': "Hours before a camera or disk throughput measurement is taken again."},
     'rotation-slow-factor': {
         'default': 1.0,
         'type': util.restricted_float,
@@ -341,6 +456,10 @@ SECTIONS['alignment'] = {
         'default': 0.1,
         'type': float,
         'help': "Off axis horizontal position of the sphere used to calculate resolution (mm)"},
+    'alignment-num-frames': {
+        'default': 1,
+        'type': util.positive_int,
+        'help': "Number of frames averaged into each alignment image, flat and dark."},
     }
 
 SCAN_PARAMS = ('experiment-info', 'detector', 'scintillator', 'hdf-plugin', 'file', 'beamline', 'sample', 'sample-motion', 'scan', 'furnace', 'file-transfer', 'stage-settings')
@@ -44,7 +44,10 @@ def create_remote_directory(remote_server, remote_dir):
         return -1
 
 
-def scp(global_PVs, params):
+def scp(global_PVs, params, fname=None):
+    '''Copies the HDF file fname, by default the last one the writer opened,
+    to the remote analysis directory.
+    '''
 
     log.info(' ')
     log.info('  *** Data transfer')
@@ -54,7 +57,9 @@ def scp(global_PVs, params):
     log.info('      *** remote server: %s' % remote_server)
     log.info('      *** remote top directory: %s' % (remote_top_dir))
 
-    fname_origin = Path(global_PVs['HDF1_FullFileName_RBV'].get(as_string=True))
+    if fname is None:
+        fname = global_PVs['HDF1_FullFileName_RBV'].get(as_string=True)
+    fname_origin = Path(fname)
 
     log.info('      *** origin: %s' % str(fname_origin))
     log.info('      *** destination: %s' % params.remote_analysis_dir)
@@ -68,7 +73,7 @@ def scp(global_PVs, params):
     elif ret == 2:
         iret = create_remote_directory(remote_server, remote_top_dir)
         if iret == 0: 
-            os.system('scp -q ' + fname_origin + ' ' + params.remote_analysis_dir + '&')
+            os.system('scp -q ' + str(fname_origin) + ' ' + params.remote_analysis_dir + '&')
         log.info('  *** Data transfer: Done!')
         return 0
     else:
@@ -0,0 +1,335 @@
+'''
+    Scan time estimates, without running the scan.
+
+    ScanTimer steps through the same motions and acquisitions as the scan
+    functions in scan.py, keeping track of where each motor is, and adds up
+    the time of each step by phase.  Moves use a trapezoidal profile from
+    the motor record VELO and ACCL; the fixed costs of shutters, settling
+    sleeps and camera setup come from OVERHEADS.
+'''
+import copy
+import math
+import datetime
+from collections import OrderedDict
+
+import numpy as np
+
+from tomo7bm import log
+from tomo7bm import pso
+from tomo7bm import mosaic
+from tomo7bm import references
+
+# Fixed costs (s), measured at 7-BM-B
+OVERHEADS = {
+    'shutter': 1.0,             # shutter A open or close, until the status PV agrees
+    'settle': 0.5,              # sleep after closing the shutter
+    'acquire_start': 1.0,       # sleep after starting flats or darks
+    'camera_setup': 0.5,        # flir.set(): stop the camera, write PVs, arm the HDF writer
+    'acquire_setup': 0.3,       # flir.acquire() and flats/darks PV writes
+    'pso_command': 0.02,        # one ASCII command to the Ensemble
+    'hdf_close': 1.0,           # last frames to disk and file closed
+    'add_theta': 0.2,           # reopen the file to add theta
+    }
+
+# VELO (mm/s) and ACCL (s) of the sample stages, for estimates without the IOC
+MOTOR_DYNAMICS = {
+    'Motor_SampleX': (2.0, 0.2),
+    'Motor_SampleY': (2.0, 0.2),
+    }
+
+NUM_PSO_COMMANDS = 9
+
+# Half the sensor width (pixels) of the 7bm_pg4 camera, for the blur
+# limit of estimates without the IOC
+IMAGE_HALF_WIDTH = 1224.0
+
+
+def move_time(distance, velocity, accel_time):
+    '''Time for a trapezoidal move over distance, with accel_time to reach
+    velocity as in the motor record ACCL.
+    '''
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    if accel_time <= 0:
+        return distance / velocity
+    if velocity * accel_time > distance:
+        # Never reaches full speed
+        return 2 * math.sqrt(distance * accel_time / velocity)
+    return distance / velocity + accel_time
+
+
+def stage_dynamics(params, global_PVs=None):
+    '''Returns {motor name: (VELO, ACCL)} for the sample stages and the
+    rotation.  Read from the motors if global_PVs is given; otherwise from
+    MOTOR_DYNAMICS and, for the rotation, the retrace speed and accl_rot.
+    '''
+    if global_PVs is not None:
+        return {name: (global_PVs[name].slew_speed, global_PVs[name].acceleration)
+                for name in ('Motor_SampleX', 'Motor_SampleY', 'Motor_SampleRot')}
+    dynamics = dict(MOTOR_DYNAMICS)
+    dynamics['Motor_SampleRot'] = (float(params.retrace_speed), float(params.accl_rot))
+    return dynamics
+
+
+class ScanTimer():
+    '''Adds up the time a scan takes, by phase.
+
+    position holds where each motor is after the steps so far; the sample
+    starts at X = Y = 0 and the rotation at the start angle.  Files of
+    series are finished in the background, as by pipeline.finalizer:
+    closed is the time the last file closes, finished the time the
+    worker is done, both on the scale of total().  speed_source says where
+    params.slew_speed came from.
+    '''
+    def __init__(self, params, dynamics, overheads=OVERHEADS, speed_source='manual'):
+        self.params = params
+        self.speed_source = speed_source
+        self.dynamics = dynamics
+        self.overheads = overheads
+        self.phases = OrderedDict()
+        self.position = {'Motor_SampleX': 0.0, 'Motor_SampleY': 0.0,
+                         'Motor_SampleRot': float(params.sample_rotation_start)}
+        self.stage = pso.StageDescription(pso.ROTATION_DRIVER['encoder_multiply'],
+                                          dynamics['Motor_SampleRot'][1], 0, pso.ENCODER_DIRECTION)
+        self.closed = 0.0
+        self.finished = 0.0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + float(seconds)
+
+    def move(self, phase, name, target, velocity=None):
+        '''Moves a motor to target, at velocity or its VELO.
+        '''
+        default_velocity, accel_time = self.dynamics[name]
+        self.add(phase, move_time(target - self.position[name], velocity or default_velocity, accel_time))
+        self.position[name] = target
+
+    def move_together(self, phase, targets):
+        '''Moves several motors at once, as pvs.move_motors().
+        '''
+        times = [0.0]
+        for name, target in targets.items():
+            velocity, accel_time = self.dynamics[name]
+            times.append(move_time(target - self.position[name], velocity, accel_time))
+            self.position[name] = target
+        self.add(phase, max(times))
+
+    def sample_out(self):
+        '''scan.move_sample_out(); returns the sample in position.
+        '''
+        params = self.params
+        in_position = {'Motor_SampleX': self.position['Motor_SampleX'],
+                       'Motor_SampleY': self.position['Motor_SampleY']}
+        if not params.sample_move_freeze:
+            self.move_together('sample motion', {'Motor_SampleX': float(params.sample_out_x),
+                                                 'Motor_SampleY': float(params.sample_out_y)})
+        return in_position
+
+    def sample_in(self, in_position):
+        if not self.params.sample_move_freeze:
+            self.move_together('sample motion', in_position)
+
+    def overhead(self, phase, name, count=1):
+        self.add(phase, count * self.overheads[name])
+
+    def wait_until(self, phase, when):
+        self.add(phase, max(0.0, when - self.total()))
+
+    def shutter(self):
+        if not self.params.testing:
+            self.overhead('shutters', 'shutter')
+
+    def total(self):
+        return sum(self.phases.values())
+
+    def frames(self, phase, num_images, exposure_time):
+        '''Flats or darks: num_images frames after a fixed start-up sleep.
+        '''
+        period = max(exposure_time, float(self.params.exposure_time)) + float(self.params.ccd_readout)
+        self.overhead(phase, 'acquire_setup')
+        self.add(phase, max(self.overheads['acquire_start'], num_images * period))
+
+    def references_due(self, refs):
+        '''scan.references_due(), assuming the flat intensity never drifts.
+        '''
+        if refs is None:
+            return True
+        if refs.needs_check():
+            self.wait_until('HDF close', self.finished)
+            in_position = self.sample_out()
+            self.shutter()
+            self.frames('flats', 1, float(self.params.bright_exposure_time))
+            self.shutter()
+            self.sample_in(in_position)
+        return refs.due(self.total(), refs.white)
+
+    def flat_and_dark(self):
+        '''scan.acquire_flat_and_dark()
+        '''
+        params = self.params
+        num_images = int(params.num_white_images) * int(params.recursive_filter_n_images)
+        in_position = self.sample_out()
+        self.shutter()
+        self.frames('flats', num_images, float(params.bright_exposure_time))
+        self.shutter()
+        self.overhead('settle', 'settle')
+        # acquire_dark() takes as many frames as the flats
+        self.frames('darks', num_images, float(params.exposure_time))
+        self.sample_in(in_position)
+
+    def program_PSO(self, plan):
+        '''pso.program_PSO(): to the first PSO position, then back to the
+        start of the taxi distance, at the retrace speed.
+        '''
+        self.move('PSO programming', 'Motor_SampleRot', plan.PSO_positions[0])
+        self.overhead('PSO programming', 'pso_command', NUM_PSO_COMMANDS)
+        self.move('PSO programming', 'Motor_SampleRot', plan.motor_start)
+        # flir.set() waits for the last file to close
+        self.wait_until('HDF close', self.closed)
+        self.overhead('camera setup', 'camera_setup')
+
+    def rotate(self, plan):
+        '''flir.acquire(): the fly motion itself.
+        '''
+        self.overhead('camera setup', 'acquire_setup')
+        self.add('rotation', plan.time_estimate)
+        self.position['Motor_SampleRot'] = plan.motor_end
+
+    def finish(self):
+        '''The file is closed and theta added in the background.
+        '''
+        self.shutter()
+        self.overhead('settle', 'settle')
+        self.closed = max(self.total(), self.finished) + self.overheads['hdf_close']
+        self.finished = self.closed + self.overheads['add_theta']
+
+    def tomo_fly_scan(self, reverse=False, refs=None):
+        '''scan.tomo_fly_scan().  The retrace to the start angle is part of
+        the next scan's move to its first PSO position.
+        '''
+        start_time = self.total()
+        take_references = self.references_due(refs)
+        plan = pso.plan_fly_scan(self.params, self.stage)
+        if reverse:
+            plan = pso.reverse_plan(plan, self.stage)
+        self.program_PSO(plan)
+        if take_references:
+            self.flat_and_dark()
+        self.shutter()
+        self.rotate(plan)
+        self.finish()
+        if refs is None:
+            return
+        if take_references:
+            refs.taken('estimate', start_time, 1.0, 0.0)
+        else:
+            refs.skipped()
+
+    def tomo_continuous_scan(self, num_segments):
+        '''scan.tomo_continuous_scan()
+        '''
+        params = self.params
+        fraction = pso.interlace_fraction(params.interlace, num_segments)
+        plan = pso.plan_continuous_scan(params, self.stage, num_segments, fraction)
+        self.program_PSO(plan)
+        self.flat_and_dark()
+        self.shutter()
+        self.rotate(plan)
+        self.shutter()
+        self.flat_and_dark()
+        self.overhead('HDF close', 'hdf_close')
+        self.overhead('HDF close', 'add_theta')
+
+    def sleep(self, step, num_steps):
+        if step + 1 != num_steps:
+            self.add('sleep', float(self.params.sleep_time))
+
+    def fly_scan(self):
+        '''scan.fly_scan()
+        '''
+        params = self.params
+        num_steps = int(params.sleep_steps)
+        if params.continuous or params.interlace != 'none':
+            self.tomo_continuous_scan(num_steps)
+            return
+        refs = references.ReferencePolicy(params)
+        for i in range(num_steps):
+            self.tomo_fly_scan(reverse=params.zigzag and i % 2 == 1, refs=refs)
+            self.sleep(i, num_steps)
+        self.wait_until('HDF close', self.finished)
+
+    def fly_scan_vertical(self):
+        '''scan.fly_scan_vertical()
+        '''
+        params = self.params
+        num_steps = int(params.sleep_steps)
+        start_y = float(params.vertical_scan_start)
+        refs = references.ReferencePolicy(params)
+        for i in range(num_steps):
+            for y in np.arange(start_y, params.vertical_scan_end, params.vertical_scan_step_size):
+                self.move('sample motion', 'Motor_SampleY', y)
+                self.tomo_fly_scan(refs=refs)
+            self.move('sample motion', 'Motor_SampleY', start_y)
+            self.sleep(i, num_steps)
+        self.wait_until('HDF close', self.finished)
+        self.move('rotation', 'Motor_SampleRot', 0.0)
+
+    def fly_scan_mosaic(self):
+        '''scan.fly_scan_mosaic(), one scan per tile in the mosaic.plan_tiles() order.
+        '''
+        params = self.params
+        num_steps = int(params.sleep_steps)
+        start_x, start_y = float(params.horizontal_scan_start), float(params.vertical_scan_start)
+        tiles = mosaic.plan_tiles(params, self.dynamics, params.mosaic_order)
+        refs = references.ReferencePolicy(params)
+        for i in range(num_steps):
+            for tile in tiles:
+                self.move_together('sample motion', {'Motor_SampleX': tile.x, 'Motor_SampleY': tile.y})
+                self.tomo_fly_scan(refs=refs)
+            self.move_together('sample motion', {'Motor_SampleX': start_x, 'Motor_SampleY': start_y})
+            self.move('rotation', 'Motor_SampleRot', 0.0)
+            self.sleep(i, num_steps)
+            self.wait_until('HDF close', self.finished)
+
+
+def estimate_scan(params, dynamics=None, im_half_width=IMAGE_HALF_WIDTH, camera_max_framerate=np.inf):
+    '''Returns the ScanTimer for the scan params describes.  Unless
+    params.auto_slew_speed is 'manual', the scan rotates at the speed
+    scan.set_slew_speed() would pick from pso.frame_rate_limits(), for an
+    image im_half_width pixels from the axis; the disk is assumed to keep up.
+    '''
+    speed_source = 'manual'
+    if params.auto_slew_speed != 'manual':
+        params = copy.copy(params)
+        delta_angle, limits = pso.frame_rate_limits(params, im_half_width, camera_max_framerate)
+        speed_source = min(limits, key=limits.get)
+        params.slew_speed = limits[speed_source] * delta_angle
+    timer = ScanTimer(params, dynamics or stage_dynamics(params), speed_source=speed_source)
+    if params.scan_type == 'vertical':
+        timer.fly_scan_vertical()
+    elif params.scan_type == 'mosaic':
+        timer.fly_scan_mosaic()
+    else:
+        timer.fly_scan()
+    return timer
+
+
+def log_estimate(timer):
+    '''Logs the time of each phase, the total and the finish time if the
+    scan started now.
+    '''
+    total = timer.total()
+    if timer.speed_source == 'manual':
+        source = 'manual slew speed'
+    else:
+        source = 'limited by ' + timer.speed_source
+    log.info('  *** Scan time estimate at {:6.3f} deg/s, {:s}'.format(float(timer.params.slew_speed), source))
+    log.info('  *** *** {:<18s} {:>10s} {:>6s}'.format('phase', 'time (s)', 'share'))
+    for phase, seconds in timer.phases.items():
+        log.info('  *** *** {:<18s} {:10.1f} {:5.1f}%'.format(phase, seconds, 100.0 * seconds / total))
+    log.info('  *** *** {:<18s} {:10.1f}'.format('total', total))
+    finish = datetime.datetime.now() + datetime.timedelta(seconds=total)
+    log.warning('  *** Estimated scan time {:s}, done at {:s}'.format(
+                    str(datetime.timedelta(seconds=round(total))), finish.strftime('%Y-%m-%d %H:%M:%S')))
+    return total
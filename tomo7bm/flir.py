@@ -3,8 +3,8 @@
     
 '''
 import sys
-import json
 import time
+import threading
 from pathlib import Path
 import h5py
 import traceback
@@ -12,8 +12,13 @@ import numpy as np
 
 from tomo7bm import aps7bm
 from tomo7bm import log
+from tomo7bm import pvs
 from tomo7bm import pso
+from tomo7bm import pipeline
 from tomo7bm import scan
+from tomo7bm import throughput
+from tomo7bm import live
+from tomo7bm import validate
 
 FrameTypeData = 0
 FrameTypeDark = 1
@@ -24,32 +29,44 @@ DetectorAcquire = 1
 
 Recursive_Filter_Type = 'RecursiveAve'
 
+# Seconds the HDF writer may go without writing a frame before we force
+# the file closed
+FLUSH_STALL_TIME = 10.0
+
 def init(global_PVs, params):
     '''Performs initialization of camera.
     Takes a frame to make sure we have frame data.
     '''
     if params.camera_ioc_prefix in params.valid_camera_prefixes:
         log.info('  *** init Point Grey camera')
-        global_PVs['HDF1_Capture'].put(0, wait=True)
-        global_PVs['HDF1_EnableCallbacks'].put('Disable', wait=True)
-        global_PVs['Cam1_TriggerMode'].put('Internal', wait=True)    # 
-        global_PVs['Cam1_TriggerMode'].put('Overlapped', wait=True)  # sequence Internal / Overlapped / internal because of CCD bug!!
-        global_PVs['Cam1_TriggerMode'].put('Internal', wait=True)    #
-        global_PVs['Proc1_Filter_Callbacks'].put( 'Every array' )
-        global_PVs['Cam1_ImageMode'].put('Single', wait=True)
-        global_PVs['Cam1_Display'].put(1)
+        puts = pvs.PutTransaction(global_PVs)
+        puts.put('HDF1_Capture', 0)
+        puts.barrier()
+        puts.put('HDF1_EnableCallbacks', 'Disable')
+        puts.put('Cam1_TriggerMode', 'Internal', force=True)    # 
+        puts.put('Cam1_TriggerMode', 'Overlapped', force=True)  # sequence Internal / Overlapped / internal because of CCD bug!!
+        puts.put('Cam1_TriggerMode', 'Internal', force=True)    #
+        puts.put('Proc1_Filter_Callbacks', 'Every array')
+        puts.put('Cam1_ImageMode', 'Single')
+        puts.put('Cam1_Display', 1)
+        puts.commit()
         global_PVs['Cam1_Acquire'].put(DetectorAcquire)
         aps7bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorAcquire, 2)
-        global_PVs['Proc1_Callbacks'].put('Disable')
-        global_PVs['Proc1_Filter_Enable'].put('Disable')
-        global_PVs['HDF1_ArrayPort'].put(global_PVs['Cam1_AsynPort'].get())
+        puts.put('Proc1_Callbacks', 'Disable')
+        puts.put('Proc1_Filter_Enable', 'Disable')
+        puts.put('HDF1_ArrayPort', global_PVs['Cam1_AsynPort'].get())
+        puts.commit()
         log.info('  *** init Point Grey camera: Done!')
 
 
-def set(global_PVs, params):
+def set(global_PVs, params, num_frames=None):
     '''Sets up detector and arms it for PSO pulses.
+    num_frames is the number of frames the HDF file will hold; by default
+    one set of projections, darks and flats.
     '''
     fname = params.file_name
+    # Never touch the detector or re-arm the writer while the last file is still being written
+    pipeline.finalizer.wait_closed()
     # Set detectors
     if params.camera_ioc_prefix in params.valid_camera_prefixes:
         log.info(' ')
@@ -59,14 +76,16 @@ def set(global_PVs, params):
         global_PVs['Cam1_Acquire'].put(DetectorIdle)
         aps7bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle)
         #Set up the XML files to determine HDF file layout
+        puts = pvs.PutTransaction(global_PVs)
         attrib_file = Path.joinpath(Path(__file__).parent,'mctDetectorAttributes1.xml')
-        global_PVs['Cam1_AttributeFile'].put(str(attrib_file), wait=True) 
+        puts.put('Cam1_AttributeFile', str(attrib_file)) 
         layout_file = Path.joinpath(Path(__file__).parent,'mct3.xml')
-        global_PVs['HDF1_XMLFileName'].put(str(layout_file),wait=True) 
+        puts.put('HDF1_XMLFileName', str(layout_file)) 
 
-        global_PVs['Cam1_ArrayCallbacks'].put('Enable', wait=True)
-        global_PVs['Cam1_AcquirePeriod'].put(float(params.exposure_time), wait=True)
-        global_PVs['Cam1_AcquireTime'].put(float(params.exposure_time), wait=True)
+        puts.put('Cam1_ArrayCallbacks', 'Enable')
+        puts.put('Cam1_AcquirePeriod', float(params.exposure_time))
+        puts.put('Cam1_AcquireTime', float(params.exposure_time))
+        puts.commit()
 
         log.info('  *** setup Point Grey: Done!')
     else:
@@ -75,49 +94,56 @@ def set(global_PVs, params):
     if params.file_name is None:
         log.warning('  *** hdf_writer will not be configured')
     else:
-        _setup_hdf_writer(global_PVs, params, fname)
+        _setup_hdf_writer(global_PVs, params, fname, num_frames)
 
 
-def _setup_hdf_writer(global_PVs, params, fname=None):
+def _setup_hdf_writer(global_PVs, params, fname=None, num_frames=None):
 
     if params.camera_ioc_prefix in params.valid_camera_prefixes:
         # setup Point Grey hdf writer PV's
         log.info('  ')
         log.info('  *** setup hdf_writer')
-        _setup_frame_type(global_PVs, params)
+        puts = pvs.PutTransaction(global_PVs)
+        _setup_frame_type(puts)
         if params.recursive_filter == True:
             log.info('    *** Recursive Filter Enabled')
-            global_PVs['Proc1_Enable_Background'].put('Disable', wait=True)
-            global_PVs['Proc1_Enable_FlatField'].put('Disable', wait=True)
-            global_PVs['Proc1_Enable_Offset_Scale'].put('Disable', wait=True)
-            global_PVs['Proc1_Enable_Low_Clip'].put('Disable', wait=True)
-            global_PVs['Proc1_Enable_High_Clip'].put('Disable', wait=True)
-
-            global_PVs['Proc1_Callbacks'].put('Enable', wait=True)
-            global_PVs['Proc1_Filter_Enable'].put('Enable', wait=True)
-            global_PVs['HDF1_ArrayPort'].put('PROC1', wait=True)
-            global_PVs['Proc1_Filter_Type'].put(Recursive_Filter_Type, wait=True)
-            global_PVs['Proc1_Num_Filter'].put(int(params.recursive_filter_n_images), wait=True)
-            global_PVs['Proc1_Reset_Filter'].put(1, wait=True)
-            global_PVs['Proc1_AutoReset_Filter'].put('Yes', wait=True)
-            global_PVs['Proc1_Filter_Callbacks'].put('Array N only', wait=True)
-            log.info('    *** Recursive Filter Enabled: Done!')
+            puts.put('Proc1_Enable_Background', 'Disable')
+            puts.put('Proc1_Enable_FlatField', 'Disable')
+            puts.put('Proc1_Enable_Offset_Scale', 'Disable')
+            puts.put('Proc1_Enable_Low_Clip', 'Disable')
+            puts.put('Proc1_Enable_High_Clip', 'Disable')
+
+            puts.put('Proc1_Callbacks', 'Enable')
+            puts.put('Proc1_Filter_Enable', 'Enable')
+            puts.put('HDF1_ArrayPort', 'PROC1')
+            puts.put('Proc1_Filter_Type', Recursive_Filter_Type)
+            puts.put('Proc1_Num_Filter', int(params.recursive_filter_n_images))
+            # Reset only once the filter is configured
+            puts.barrier()
+            puts.put('Proc1_Reset_Filter', 1, force=True)
+            puts.put('Proc1_AutoReset_Filter', 'Yes')
+            puts.put('Proc1_Filter_Callbacks', 'Array N only')
         else:
-            global_PVs['Proc1_Filter_Enable'].put('Disable')
-            global_PVs['HDF1_ArrayPort'].put(global_PVs['Cam1_AsynPort'].get(), wait=True)
-        global_PVs['HDF1_AutoSave'].put('Yes')
-        global_PVs['HDF1_DeleteDriverFile'].put('No')
-        global_PVs['HDF1_EnableCallbacks'].put('Enable', wait=True)
-        global_PVs['HDF1_BlockingCallbacks'].put('No')
-
-        totalProj = (int(params.num_projections) 
-                        + int(params.num_dark_images) + int(params.num_white_images))
-
-        global_PVs['HDF1_NumCapture'].put(totalProj, wait=True)
-        global_PVs['HDF1_ExtraDimSizeN'].put(totalProj, wait=True)
-        global_PVs['HDF1_FileWriteMode'].put(str(params.file_write_mode), wait=True)
+            puts.put('Proc1_Filter_Enable', 'Disable')
+            puts.put('HDF1_ArrayPort', global_PVs['Cam1_AsynPort'].get())
+        puts.put('HDF1_AutoSave', 'Yes')
+        puts.put('HDF1_DeleteDriverFile', 'No')
+        puts.put('HDF1_EnableCallbacks', 'Enable')
+        puts.put('HDF1_BlockingCallbacks', 'No')
+
+        totalProj = num_frames
+        if totalProj is None:
+            totalProj = (int(params.num_projections) 
+                            + int(params.num_dark_images) + int(params.num_white_images))
+
+        puts.put('HDF1_NumCapture', totalProj)
+        puts.put('HDF1_ExtraDimSizeN', totalProj)
+        puts.put('HDF1_FileWriteMode', str(params.file_write_mode))
         if fname is not None:
-            global_PVs['HDF1_FileName'].put(str(fname), wait=True)
+            puts.put('HDF1_FileName', str(fname))
+        puts.commit()
+        if params.recursive_filter == True:
+            log.info('    *** Recursive Filter Enabled: Done!')
         global_PVs['HDF1_Capture'].put(1)
         aps7bm.wait_pv(global_PVs['HDF1_Capture'], 1)
         log.info('  *** setup hdf_writer: Done!')
@@ -126,13 +152,13 @@ def _setup_hdf_writer(global_PVs, params, fname=None):
         return
 
 
-def _setup_frame_type(global_PVs, params):
-    global_PVs['Cam1_FrameTypeZRST'].put('/exchange/data')
-    global_PVs['Cam1_FrameTypeONST'].put('/exchange/data_dark')
-    global_PVs['Cam1_FrameTypeTWST'].put('/exchange/data_white')
+def _setup_frame_type(puts):
+    puts.put('Cam1_FrameTypeZRST', '/exchange/data')
+    puts.put('Cam1_FrameTypeONST', '/exchange/data_dark')
+    puts.put('Cam1_FrameTypeTWST', '/exchange/data_white')
 
 
-def acquire(global_PVs, params):
+def acquire(global_PVs, params, plan):
     # Make sure that we aren't acquiring now
     global_PVs['Cam1_Acquire'].put(DetectorIdle)
     aps7bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle)
@@ -140,7 +166,7 @@ def acquire(global_PVs, params):
     global_PVs['Cam1_FrameType'].put(FrameTypeData, wait=True)
     global_PVs['Cam1_ImageMode'].put('Multiple', wait=True)
 
-    num_images = int(params.num_projections)  * params.recursive_filter_n_images   
+    num_images = plan.num_proj * plan.num_images_per_proj
     global_PVs['Cam1_NumImages'].put(num_images, wait=True)
 
     # Set trigger mode
@@ -152,16 +178,23 @@ def acquire(global_PVs, params):
 
     log.info(' ')
     log.info('  *** Fly Scan: Start!')
-    pso.fly(global_PVs, params)
+    ring = live.start(global_PVs, params) if params.live_check else None
+    try:
+        monitor = pso.fly(global_PVs, params, plan, ring)
+    finally:
+        if ring is not None:
+            ring.stop()
+            ring.log_summary()
 
     # if the fly scan wait times out we should call done on the detector
     if aps7bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, 5) == False:
+        log.error('  *** ERROR: DROPPED IMAGES ***')
         log.warning('  *** *** Camera did not finish acquisition')
         global_PVs['Cam1_Acquire'].put(DetectorIdle)
     log.info('  *** Fly Scan: Done!')
     # Set trigger mode to internal for post dark and white
     global_PVs['Cam1_TriggerMode'].put('Internal')
-    return pso.proj_positions
+    return monitor
             
 
 def acquire_flat(global_PVs, params):
@@ -182,6 +215,7 @@ def acquire_flat(global_PVs, params):
     if aps7bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, wait_time):
         log.info('      *** White Fields: Done!')
     else:
+        log.error('  *** ERROR: DROPPED IMAGES ***')
         log.error('     *** *** Timeout.')
         raise Exception    
     log.info('  *** *** set exp time back')
@@ -204,21 +238,61 @@ def acquire_dark(global_PVs, params):
     if aps7bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, wait_time):
         log.info('      *** Dark Fields: Done!')
     else:
+        log.error('  *** ERROR: DROPPED IMAGES ***')
         log.error('     *** *** Timeout.')
         raise Exception    
 
 
 def checkclose_hdf(global_PVs, params):
     ''' Check if the HDF5 file has closed.  Will wait for data to flush to disk.
+    Returns as soon as the file closes.  There is no fixed deadline: we wait
+    as long as the plugin keeps writing frames, and force the file closed
+    only if it writes none for FLUSH_STALL_TIME.
     '''
-    buffer_queue = global_PVs['HDF1_QueueSize'].get() - global_PVs['HDF1_QueueFree'].get()
-    frate = 55.0
-    wait_on_hdd = buffer_queue / frate + 10
-    log.info('  *** Buffer Queue (frames): %d ' % buffer_queue)
-    log.info('  *** Wait HDD (s): %f' % wait_on_hdd)
-    if aps7bm.wait_pv(global_PVs["HDF1_Capture_RBV"], 0, wait_on_hdd) == False: # needs to wait for HDF plugin queue to dump to disk
+    capture_pv = global_PVs['HDF1_Capture_RBV']
+    queue_free_pv = global_PVs['HDF1_QueueFree']
+    num_captured_pv = global_PVs['HDF1_NumCaptured_RBV']
+    changed = threading.Event()
+    callbacks = []
+
+    def on_change(**kw):
+        changed.set()
+
+    closed = False
+    try:
+        for pv in (capture_pv, queue_free_pv, num_captured_pv):
+            callbacks.append((pv, pv.add_callback(on_change, with_ctrlvars=False)))
+        start_time = time.time()
+        queue_free = queue_free_pv.get()
+        first_captured = num_captured = num_captured_pv.get()
+        log.info('  *** Buffer Queue (frames): %d ' % (global_PVs['HDF1_QueueSize'].get() - queue_free))
+        last_progress = start_time
+        while True:
+            changed.clear()
+            if capture_pv.get() == 0:
+                closed = True
+                break
+            now = time.time()
+            new_free, new_captured = queue_free_pv.get(), num_captured_pv.get()
+            if new_free > queue_free or new_captured > num_captured:
+                last_progress = now
+            queue_free, num_captured = new_free, new_captured
+            if now - last_progress >= FLUSH_STALL_TIME:
+                break
+            changed.wait(min(pvs.RECHECK_TIME, last_progress + FLUSH_STALL_TIME - now))
+    finally:
+        for pv, index in callbacks:
+            pv.remove_callback(index)
+    flush_time = time.time() - start_time
+    num_flushed = num_captured - first_captured
+    if num_flushed > 0 and flush_time > 0:
+        log.info('  *** Flushed %d frames in %4.2f s (%5.1f frames/s)' % (num_flushed, flush_time,
+                    num_flushed / flush_time))
+    else:
+        log.info('  *** Wait HDD (s): %4.2f' % flush_time)
+    if not closed:
         global_PVs["HDF1_Capture"].put(0)
-        log.info('  *** File was not closed => forced to close')
+        log.info('  *** No frame written for %4.1f s => forced to close' % FLUSH_STALL_TIME)
         log.info('      *** before %d' % global_PVs["HDF1_Capture_RBV"].get())
         aps7bm.wait_pv(global_PVs["HDF1_Capture_RBV"], 0, 5) 
         log.info('      *** after %d' % global_PVs["HDF1_Capture_RBV"].get())
@@ -226,76 +300,256 @@ def checkclose_hdf(global_PVs, params):
             log.error('  *** ERROR HDF FILE DID NOT CLOSE; add_theta will fail')
 
 
-def add_theta(global_PVs, params):
+def frame_times(hdf_f, first, count):
+    '''Returns the time stamps (POSIX s) of count frames of an open HDF
+    file, starting at frame first, from the NDArray attributes in /defaults.
+    Returns None if the file has no time stamps.
+    '''
+    defaults = hdf_f.get('/defaults')
+    if defaults is None:
+        return None
+    if 'NDArrayEpicsTSSec' in defaults and 'NDArrayEpicsTSnSec' in defaults:
+        times = (validate.read_chunked(defaults['NDArrayEpicsTSSec'], first, count)
+                    + 1e-9 * validate.read_chunked(defaults['NDArrayEpicsTSnSec'], first, count))
+    elif 'NDArrayTimeStamp' in defaults:
+        times = validate.read_chunked(defaults['NDArrayTimeStamp'], first, count)
+    else:
+        return None
+    return np.asarray(times, dtype=np.float64) + pvs.EPICS_EPOCH
+
+
+def add_theta(global_PVs, params, theta_arr, monitor=None, segment_arr=None, fullname=None):
+    '''Adds the projection angles to the HDF file fullname, by default the
+    last one the writer opened.
+    /exchange/theta holds the planned angles.  With the FlyMonitor of the
+    scan, /exchange/timestamp holds the time stamp of each frame and
+    /exchange/theta_measured the rotation readback at that time.
+    With a live check, /process/acquisition/live_stats holds its FrameStats.
+    For evenly spaced angles and a file with UniqueIds, the frames are
+    matched to the projections by validate.check_frames(): /exchange/theta
+    then holds the angle of each stored frame, and /exchange/theta_valid
+    marks the frames that are one projection each.  Raises RuntimeError if
+    more than params.max_missing_frames projections are missing, or any
+    are stored twice.
+    '''
     log.info(' ')
     log.info('  *** add_theta')
     
-    fullname = global_PVs['HDF1_FullFileName_RBV'].get(as_string=True)
-    theta_arr = pso.proj_positions
+    if fullname is None:
+        fullname = global_PVs['HDF1_FullFileName_RBV'].get(as_string=True)
     if theta_arr is None:
         return
+    check = None
     try:
         with h5py.File(fullname, mode='a') as hdf_f:
-            hdf_f.create_dataset('/exchange/theta', data=theta_arr) 
+            datasets = {'/exchange/theta': theta_arr}
+            if segment_arr is not None:
+                datasets['/exchange/segment'] = segment_arr
+            if monitor is not None:
+                datasets['/process/acquisition/fly_timeline'] = monitor.as_array()
+                if monitor.live is not None:
+                    datasets['/process/acquisition/live_stats'] = monitor.live.as_array()
+                num_frames = hdf_f['/exchange/data'].shape[0]
+                timestamps = frame_times(hdf_f, monitor.first_frame, num_frames)
+                if timestamps is None:
+                    log.warning('  *** *** No frame time stamps in the file')
+                else:
+                    datasets['/exchange/timestamp'] = timestamps
+                    datasets['/exchange/theta_measured'] = monitor.angles_at(timestamps)
+                check = _check_frames(hdf_f, monitor, theta_arr, num_frames, timestamps,
+                                      datasets.get('/exchange/theta_measured'))
+                if check is not None:
+                    datasets['/exchange/theta'] = theta_arr[0] + check.pulse * (theta_arr[1] - theta_arr[0])
+                    datasets['/exchange/theta_valid'] = check.valid
+                    if segment_arr is not None:
+                        datasets['/exchange/segment'] = segment_arr[np.clip(check.pulse, 0, len(segment_arr) - 1)]
+            for name, data in datasets.items():
+                hdf_f.create_dataset(name, data=data)
+            hdf_f['/exchange/theta'].attrs['units'] = 'deg'
+            if '/exchange/theta_measured' in datasets:
+                hdf_f['/exchange/theta_measured'].attrs['units'] = 'deg'
+                hdf_f['/exchange/timestamp'].attrs['units'] = 's'
+            if monitor is not None:
+                hdf_f['/process/acquisition/fly_timeline'].attrs['columns'] = ' '.join(pso.TIMELINE_COLUMNS)
+                if monitor.live is not None:
+                    hdf_f['/process/acquisition/live_stats'].attrs['columns'] = ' '.join(live.FrameStats._fields)
+            if check is not None:
+                attrs = hdf_f['/exchange/theta_valid'].attrs
+                attrs['num_missing'] = check.num_missing
+                attrs['num_duplicate'] = check.num_duplicate
+                attrs['ok'] = check.ok(params.max_missing_frames)
+        if '/exchange/theta_measured' in datasets:
+            _log_theta_error(datasets['/exchange/theta'], datasets['/exchange/theta_measured'])
         log.info('  *** add_theta: Done!')
     except Exception as ee:
         traceback.print_exc(file=sys.stdout)
         log.info('  *** add_theta: Failed accessing: %s' % fullname)
         raise ee
+    if check is not None and not check.ok(params.max_missing_frames):
+        raise RuntimeError('%s: %d projections missing, %d stored twice'
+                            % (fullname, check.num_missing, check.num_duplicate))
+
 
+def _check_frames(hdf_f, monitor, theta_arr, num_frames, timestamps, angles):
+    '''Runs validate.check_frames() on the frames of a fly scan file and
+    logs the result.  Returns None if the file or the angles do not allow it.
+    '''
+    if '/defaults/NDArrayUniqueId' not in hdf_f or not validate.uniform(theta_arr) or not num_frames:
+        log.warning('  *** *** Frames not checked against the projections')
+        return None
+    unique_ids = validate.read_chunked(hdf_f['/defaults/NDArrayUniqueId'], monitor.first_frame, num_frames)
+    if len(unique_ids) != num_frames:
+        log.warning('  *** *** UniqueIds for {:d} of {:d} frames; frames not checked'.format(
+                    len(unique_ids), num_frames))
+        return None
+    plan = monitor.plan
+    check = validate.check_frames(unique_ids, timestamps, theta_arr, plan.speed, plan.num_images_per_proj, angles)
+    validate.log_check(check, monitor.frames, len(plan.PSO_positions))
+    return check
+
+
+def _log_theta_error(theta_arr, theta_measured):
+    if len(theta_arr) != len(theta_measured):
+        log.warning('  *** *** {:d} frames for {:d} planned angles'.format(len(theta_measured), len(theta_arr)))
+        return
+    error = theta_measured - theta_arr
+    log.info('  *** *** Measured theta - planned: mean {:8.4f} deg, max {:8.4f} deg'.format(
+                np.nanmean(error), np.nanmax(np.abs(error))))
 
-def take_image(global_PVs, params):
 
-    log.info('  *** taking a single image')
-   
-    nRow = global_PVs['Cam1_SizeY_RBV'].get()
-    nCol = global_PVs['Cam1_SizeX_RBV'].get()
+# numpy type of the image1 array for each DataType_RBV
+IMAGE_DTYPES = {'Int8': np.int8, 'UInt8': np.uint8, 'Int16': np.int16, 'UInt16': np.uint16,
+                'Int32': np.int32, 'UInt32': np.uint32, 'Float32': np.float32, 'Float64': np.float64}
 
-    image_size = nRow * nCol
 
-    global_PVs['Cam1_ImageMode'].put('Single', wait=True)
-    global_PVs['Cam1_NumImages'].put(1, wait=True)
+class ImageReader():
+    '''Reads frames from the image1 plugin.
 
-    global_PVs['Cam1_TriggerMode'].put('Internal', wait=True)
-    wait_time_sec = int(params.exposure_time) + 5
+    The frame shape and type are read once, and again only after the
+    monitor of one of GEOMETRY_PVS reports a change.  A frame comes back
+    as a view of the array Channel Access received it into, with its
+    type reinterpreted in place (CA has no unsigned 16-bit type), or is
+    copied into a buffer given as out.
+    '''
+    GEOMETRY_PVS = ('Cam1_SizeX_RBV', 'Cam1_SizeY_RBV', 'Cam1_BinX', 'Cam1_BinY', 'Cam1_Image_Dtype')
+
+    def __init__(self):
+        self.shape = None
+        self.dtype = None
+        self._stale = True
+        # PV names with our monitor; flir.set() hides the builtin set
+        self._watched = []
+
+    def _on_change(self, **kw):
+        self._stale = True
+
+    def geometry(self, global_PVs):
+        '''Returns the shape and numpy type of the frames.
+        '''
+        for name in self.GEOMETRY_PVS:
+            pv = global_PVs[name]
+            if pv.pvname not in self._watched:
+                self._watched.append(pv.pvname)
+                pv.add_callback(self._on_change, with_ctrlvars=False)
+                self._stale = True
+        if self._stale:
+            self._stale = False
+            rows, cols, link_bytes, hdf_dtype = throughput.frame_format(global_PVs)
+            self.shape = (rows, cols)
+            self.dtype = np.dtype(IMAGE_DTYPES.get(global_PVs['Cam1_Image_Dtype'].get(as_string=True), np.uint16))
+        return self.shape, self.dtype
+
+    def read(self, global_PVs, out=None):
+        '''Returns the last frame, or copies it into out and returns out.
+        '''
+        shape, dtype = self.geometry(global_PVs)
+        raw = global_PVs['Cam1_Image'].get(count=shape[0] * shape[1])
+        if raw.dtype.itemsize == dtype.itemsize and raw.dtype.kind in 'iu' and dtype.kind in 'iu':
+            raw = raw.view(dtype)
+        else:
+            raw = raw.astype(dtype, copy=False)
+        img = raw.reshape(shape)
+        if out is None:
+            return img
+        np.copyto(out, img, casting='unsafe')
+        return out
 
-    global_PVs['Cam1_Acquire'].put(DetectorAcquire, wait=True, timeout=1000.0)
-    time.sleep(0.1)
-    if aps7bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, wait_time_sec) == False: # adjust wait time
-        global_PVs['Cam1_Acquire'].put(DetectorIdle)
-        log.warning('The camera failed to finish acquisition.  Set to done manually.')
-    
-    # Get the image loaded in memory
-    img_vect = global_PVs['Cam1_Image'].get(count=image_size)
-    if global_PVs['Cam1_Image_Dtype'].get(as_string=True) == 'UInt16':
-        img_vect = img_vect.astype(np.uint16)
-    img = np.reshape(img_vect,[nRow, nCol])
 
-    return img
+reader = ImageReader()
+
 
+class FrameAverage():
+    '''Running mean of frames in float32, updated in place as each frame
+    comes, so only the mean is kept in memory.
+    '''
+    def __init__(self, shape):
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.count = 0
+        self._delta = np.empty(shape, dtype=np.float32)
+
+    def add(self, frame):
+        self.count += 1
+        np.subtract(frame, self.mean, out=self._delta)
+        self._delta /= self.count
+        self.mean += self._delta
+
+
+def take_image(global_PVs, params, num_frames=1):
+    '''Takes an image.  With num_frames > 1, takes that many and returns
+    their mean as float32.
+    A single image is a view of the frame as received, a new array each
+    call.
+    '''
+    if num_frames > 1:
+        log.info('  *** taking the mean of %d images' % num_frames)
+    else:
+        log.info('  *** taking a single image')
+    puts = pvs.PutTransaction(global_PVs)
+    puts.put('Cam1_ImageMode', 'Single')
+    puts.put('Cam1_NumImages', 1)
+    puts.put('Cam1_TriggerMode', 'Internal')
+    puts.commit()
+    wait_time_sec = int(params.exposure_time) + 5
 
-def take_flat(global_PVs, params):
+    average = None
+    for i in range(num_frames):
+        global_PVs['Cam1_Acquire'].put(DetectorAcquire, wait=True, timeout=1000.0)
+        time.sleep(0.1)
+        if aps7bm.wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, wait_time_sec) == False: # adjust wait time
+            global_PVs['Cam1_Acquire'].put(DetectorIdle)
+            log.warning('The camera failed to finish acquisition.  Set to done manually.')
+        # Get the image loaded in memory
+        img = reader.read(global_PVs)
+        if num_frames == 1:
+            return img
+        if average is None:
+            average = FrameAverage(img.shape)
+        average.add(img)
+    return average.mean
+
+
+def take_flat(global_PVs, params, num_frames=1):
 
     log.info('  *** acquire white')
     log.info('  *** *** set exp time')
     global_PVs['Cam1_AcquireTime'].put(params.bright_exposure_time, wait=True)
-    output = take_image(global_PVs, params)
+    output = take_image(global_PVs, params, num_frames)
     global_PVs['Cam1_AcquireTime'].put(params.exposure_time, wait=True)
     return output
 
 
-def take_dark(global_PVs, params):
+def take_dark(global_PVs, params, num_frames=1):
     
     log.info('  *** acquire dark')
-    return take_image(global_PVs, params)
+    return take_image(global_PVs, params, num_frames)
 
 
-def take_dark_and_white(global_PVs, params, leave_shutter_open=False):
+def take_dark_and_white(global_PVs, params, leave_shutter_open=False, num_frames=1):
     aps7bm.close_shutters(global_PVs, params)
-    dark_field = take_dark(global_PVs, params)
+    dark_field = take_dark(global_PVs, params, num_frames)
     aps7bm.open_shutters(global_PVs, params)
     scan.move_sample_out(global_PVs, params)
-    white_field = take_flat(global_PVs, params)
+    white_field = take_flat(global_PVs, params, num_frames)
     scan.move_sample_in(global_PVs, params)
     if not leave_shutter_open:
         aps7bm.close_shutters(global_PVs, params)
@@ -303,11 +557,10 @@ def take_dark_and_white(global_PVs, params, leave_shutter_open=False):
 
 
 def calc_max_framerate(global_PVs, params):
-    '''Calculates the maximum possible framerate based on the throughput
-    of the camera data connection.
+    '''Calculates the maximum possible framerate based on the nominal
+    throughput of the camera data connection.
     '''
-    nRow = global_PVs['Cam1_SizeY_RBV'].get()
-    nCol = global_PVs['Cam1_SizeX_RBV'].get()
-    data_per_frame = nRow * nCol * 2
+    nRow, nCol, bytes_per_pixel, dtype = throughput.frame_format(global_PVs)
+    data_per_frame = nRow * nCol * bytes_per_pixel
     USB3_throughput = 360e6
     return USB3_throughput / data_per_frame
@@ -0,0 +1,204 @@
+'''
+    Live checks of the frames of a fly scan.
+
+    Until now we only saw the data once the HDF file had closed.  FrameRing
+    subscribes to the image1 plugin and keeps every decimate-th frame in a
+    ring of preallocated arrays; a worker thread works out the mean, the
+    saturated fraction and the centroid of each of them.  The FlyMonitor
+    of the scan calls check() as it goes, and stops the scan once several
+    frames in a row have lost the beam, saturated or shown the sample
+    drifting vertically, so a bad scan ends after a few percent rather than being
+    found when it is reviewed.
+'''
+import queue
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from tomo7bm import flir
+from tomo7bm import log
+from tomo7bm import pvs
+
+RING_SIZE = 16
+# Pixel stride for the statistics
+STRIDE = 4
+# Full-scale value of each pixel format; a pixel is saturated within
+# SATURATION_FRACTION of it
+FULL_SCALE = {'Mono8': 255, 'Mono12': 4095, 'Mono12Packed': 4095, 'Mono12p': 4095, 'Mono16': 65535}
+SATURATION_FRACTION = 0.99
+# Frames the later ones are compared with, and how many bad frames in a
+# row stop the scan
+REFERENCE_FRAMES = 3
+BAD_FRAMES = 3
+
+# Monitored image1 frame PVs by name, created once and reused by every scan
+image_pvs = {}
+
+
+class FrameStats(namedtuple('FrameStats', ['unique_id', 'mean', 'saturated', 'row', 'col'])):
+    '''Statistics of one frame: mean counts, saturated fraction of the
+    pixels and centroid (row, col) of the absorption, in pixels.
+    '''
+    __slots__ = ()
+
+
+def frame_stats(frame, unique_id, saturation):
+    '''Works out the FrameStats of frame from every STRIDE-th pixel.
+    '''
+    sub = frame[::STRIDE, ::STRIDE]
+    mean = float(sub.mean())
+    saturated = float(np.count_nonzero(sub >= saturation)) / sub.size
+    centroid = []
+    for axis in (1, 0):
+        # Absorption profile: dark sample on bright flat
+        profile = sub.mean(axis=axis)
+        weights = profile.max() - profile
+        total = weights.sum()
+        index = np.arange(profile.size) * STRIDE
+        centroid.append(float((weights * index).sum() / total) if total > 0 else np.nan)
+    return FrameStats(unique_id, mean, saturated, centroid[0], centroid[1])
+
+
+class FrameRing():
+    '''Keeps every decimate-th frame of the image1 plugin in a ring of
+    preallocated arrays, and the FrameStats of each in stats.
+
+    The Channel Access thread only copies the frame into the next free
+    slot; if the worker is so far behind that none is free, the frame is
+    skipped.  image1 posts UniqueId_RBV after ArrayData, so a frame is
+    handed to the worker once its UniqueId arrives.
+    '''
+    def __init__(self, image_pv, unique_id_pv, shape, dtype, saturation, decimate=1, size=RING_SIZE):
+        self.image_pv = image_pv
+        self.unique_id_pv = unique_id_pv
+        self.shape = shape
+        self.saturation = saturation
+        self.decimate = max(int(decimate), 1)
+        self.ring = np.zeros((size,) + tuple(shape), dtype=dtype)
+        self.stats = []
+        self.received = 0
+        self.skipped = 0
+        self._next_slot = 0
+        self._pending = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._subscriptions = []
+        self._worker = None
+
+    def start(self):
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+        self._subscriptions = [(pv, pv.add_callback(callback, with_ctrlvars=False)) for pv, callback in
+                               ((self.image_pv, self._on_image), (self.unique_id_pv, self._on_unique_id))]
+        return self
+
+    def stop(self):
+        '''Unsubscribes and waits for the worker to finish the frames kept.
+        '''
+        for pv, index in self._subscriptions:
+            pv.remove_callback(index)
+        self._subscriptions = []
+        with self._lock:
+            self._hand_over(None)
+        self._queue.put(None)
+        self._worker.join()
+
+    def _hand_over(self, unique_id):
+        if self._pending is not None:
+            self._queue.put((self._pending, unique_id))
+            self._pending = None
+
+    def _on_image(self, value=None, **kw):
+        with self._lock:
+            # A frame whose UniqueId never came goes without one
+            self._hand_over(None)
+            self.received += 1
+            if value is None or (self.received - 1) % self.decimate:
+                return
+            if self._queue.qsize() >= len(self.ring) - 1:
+                self.skipped += 1
+                return
+            slot = self._next_slot
+            # Reinterprets the signed type CA delivers 16-bit frames in
+            np.copyto(self.ring[slot].reshape(-1), value[:self.ring[slot].size], casting='unsafe')
+            self._next_slot = (slot + 1) % len(self.ring)
+            self._pending = slot
+
+    def _on_unique_id(self, value=None, **kw):
+        with self._lock:
+            self._hand_over(value)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            slot, unique_id = item
+            self.stats.append(frame_stats(self.ring[slot], unique_id, self.saturation))
+
+    def as_array(self):
+        '''Returns the stats as an array with the columns of FrameStats;
+        frames without a UniqueId have -1.
+        '''
+        rows = [(-1 if s.unique_id is None else s.unique_id,) + tuple(s[1:]) for s in list(self.stats)]
+        return np.array(rows, dtype=float).reshape(-1, len(FrameStats._fields))
+
+    def check(self, max_drop, max_saturated, max_drift):
+        '''Returns why the scan looks bad, or None.  The first
+        REFERENCE_FRAMES frames kept set the intensity and sample position;
+        the scan is bad once BAD_FRAMES in a row have lost more than
+        max_drop of that intensity, have more than max_saturated of their
+        pixels saturated, or have the sample more than max_drift pixels up
+        or down.  The horizontal centroid is not checked: it swings as an
+        off-center sample rotates.
+        '''
+        stats = list(self.stats)
+        if len(stats) < REFERENCE_FRAMES + BAD_FRAMES:
+            return None
+        reference = stats[:REFERENCE_FRAMES]
+        mean = np.median([s.mean for s in reference])
+        row = np.nanmedian([s.row for s in reference])
+        last = stats[-BAD_FRAMES:]
+        if all(s.mean < (1.0 - max_drop) * mean for s in last):
+            return 'intensity down to {:4.0%} of the start'.format(last[-1].mean / mean)
+        if all(s.saturated > max_saturated for s in last):
+            return '{:5.1%} of the pixels saturated'.format(last[-1].saturated)
+        drift = [abs(s.row - row) for s in last]
+        if all(d > max_drift for d in drift):
+            return 'sample drifted {:5.1f} pixels'.format(drift[-1])
+        return None
+
+    def log_summary(self):
+        if not self.stats:
+            log.warning('  *** *** No live frames from image1')
+            return
+        means = [s.mean for s in self.stats]
+        log.info('  *** *** Live check: {:d} of {:d} frames, mean {:8.1f} to {:8.1f}, {:d} skipped'.format(
+                    len(self.stats), self.received, min(means), max(means), self.skipped))
+
+
+def image_pv(global_PVs):
+    '''Returns the monitored PV of the image1 frames.  Monitors on a large
+    waveform are off by default in pyepics, so this is a PV of its own;
+    it is made on first use and kept, so a series of scans subscribes once.
+    '''
+    pvname = global_PVs['Cam1_Image'].pvname
+    if pvname not in image_pvs:
+        image_pvs[pvname] = pvs.create_pv(pvname, auto_monitor=True)
+    return image_pvs[pvname]
+
+
+def start(global_PVs, params):
+    '''Enables the image1 plugin and starts a FrameRing on it for the fly
+    scan, keeping every params.live_decimate-th frame.
+    '''
+    global_PVs['Image1_Callbacks'].put('Enable', wait=True)
+    shape, dtype = flir.reader.geometry(global_PVs)
+    full_scale = FULL_SCALE.get(global_PVs['Cam1PixelFormat_RBV'].get(as_string=True))
+    if full_scale is None:
+        full_scale = np.iinfo(dtype).max if dtype.kind in 'iu' else np.inf
+    ring = FrameRing(image_pv(global_PVs), global_PVs['Image1_UniqueId'], shape, dtype,
+                     SATURATION_FRACTION * full_scale, params.live_decimate)
+    log.info('  *** *** Live check of 1 in {:d} frames'.format(ring.decimate))
+    return ring.start()
@@ -0,0 +1,105 @@
+'''
+    Tile order for mosaic scans.
+
+    A mosaic is a grid of sample positions, each scanned in turn.  The time
+    spent moving between tiles depends on the order we visit them in, so
+    plan_tiles() times a few orders with the stage velocities and picks the
+    quickest.  Every tile keeps its grid indices for the file name.
+'''
+from collections import namedtuple
+
+import numpy as np
+
+from tomo7bm import log
+from tomo7bm import estimate
+
+ORDERS = ('raster', 'serpentine', 'nearest')
+
+
+class Tile(namedtuple('Tile', ['v', 'h', 'y', 'x'])):
+    '''One mosaic position: grid row v and column h at (y, x) in mm.
+    '''
+    __slots__ = ()
+
+
+def grid(params):
+    '''Returns the tiles of the mosaic in raster order, row by row.
+    Both ends of each range are included.
+    '''
+    ys = np.arange(params.vertical_scan_start, params.vertical_scan_end + params.vertical_scan_step_size,
+                   params.vertical_scan_step_size)
+    xs = np.arange(params.horizontal_scan_start, params.horizontal_scan_end + params.horizontal_scan_step_size,
+                   params.horizontal_scan_step_size)
+    return [Tile(v, h, float(y), float(x)) for v, y in enumerate(ys) for h, x in enumerate(xs)]
+
+
+def serpentine(tiles):
+    '''Raster order with every other row reversed.
+    '''
+    rows = {}
+    for tile in tiles:
+        rows.setdefault(tile.v, []).append(tile)
+    return [tile for v in sorted(rows) for tile in (rows[v] if v % 2 == 0 else rows[v][::-1])]
+
+
+def _move_times(dynamics, from_y, from_x, to_y, to_x):
+    '''Time to move Y and X together between arrays of positions.
+    '''
+    move_time = np.vectorize(estimate.move_time)
+    return np.maximum(move_time(to_y - from_y, *dynamics['Motor_SampleY']),
+                      move_time(to_x - from_x, *dynamics['Motor_SampleX']))
+
+
+def nearest(tiles, dynamics, start):
+    '''Greedy order: from start, always go to the quickest tile to reach.
+    '''
+    positions = np.array([(tile.y, tile.x) for tile in tiles]).reshape(-1, 2)
+    times = _move_times(dynamics, positions[:, None, 0], positions[:, None, 1],
+                        positions[None, :, 0], positions[None, :, 1])
+    left = np.ones(len(tiles), dtype=bool)
+    current = np.argmin(_move_times(dynamics, start[0], start[1], positions[:, 0], positions[:, 1]))
+    order = []
+    while True:
+        order.append(current)
+        left[current] = False
+        if not left.any():
+            break
+        current = np.flatnonzero(left)[np.argmin(times[current, left])]
+    return [tiles[i] for i in order]
+
+
+def travel_time(order, dynamics, start, sample_out=None):
+    '''Time spent moving the sample stages over a whole pass through order,
+    from start and back to it.  With sample_out, a (y, x) position, this
+    includes the trip out and back for the flats at each tile.
+    '''
+    positions = np.array([start] + [(tile.y, tile.x) for tile in order] + [start])
+    total = _move_times(dynamics, positions[:-1, 0], positions[:-1, 1],
+                        positions[1:, 0], positions[1:, 1]).sum()
+    if sample_out is not None:
+        total += 2 * _move_times(dynamics, positions[1:-1, 0], positions[1:-1, 1],
+                                 sample_out[0], sample_out[1]).sum()
+    return float(total)
+
+
+def plan_tiles(params, dynamics, order='auto'):
+    '''Returns the mosaic tiles of params in the order to scan them: the
+    named order, or the quickest of ORDERS for 'auto'.
+    dynamics is {motor name: (VELO, ACCL)} as from estimate.stage_dynamics().
+    '''
+    tiles = grid(params)
+    start = (float(params.vertical_scan_start), float(params.horizontal_scan_start))
+    sample_out = None
+    if not params.sample_move_freeze and params.flat_dark_policy in ('every', 'drift'):
+        # Out of the beam at every tile, for flats or the drift check
+        sample_out = (float(params.sample_out_y), float(params.sample_out_x))
+    orders = {'raster': tiles,
+              'serpentine': serpentine(tiles),
+              'nearest': nearest(tiles, dynamics, start)}
+    times = {name: travel_time(orders[name], dynamics, start, sample_out) for name in ORDERS}
+    for name in ORDERS:
+        log.info('  *** *** {:<10s} order: {:8.1f} s of stage motion'.format(name, times[name]))
+    if order == 'auto':
+        order = min(ORDERS, key=times.get)
+    log.info('  *** *** Scanning {:d} tiles in {:s} order'.format(len(tiles), order))
+    return orders[order]
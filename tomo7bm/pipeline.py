@@ -0,0 +1,132 @@
+'''
+    Background finalization of scan files.
+
+    After the fly motion a scan still waits for the HDF writer to flush and
+    close the file, adds the angles, copies the config file and starts the
+    transfer.  None of this needs the stages, so the Finalizer runs it in a
+    worker thread while the next scan moves to its position and programs the
+    PSO.  The rules that keep this safe:
+
+    * the HDF writer is armed for the next scan only once the previous file
+      has closed, and been checked: flir arms it after wait_closed();
+    * files are finished one step at a time, in the order they were
+      submitted, so flats and darks reused from an earlier file are complete;
+    * whatever reads back a finished file, and the end of a series, waits
+      for all of the work so far with wait_finished().
+
+    A step that fails is logged, and its exception raised from the next
+    wait in the scan thread.  When the close or check of a file fails, the
+    rest of its steps are skipped, so a bad file is not marked done, saved
+    as the config or transferred.  stop_scan() cancels the steps not yet
+    started.
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tomo7bm import log
+
+
+class Finalizer():
+    '''Runs the finishing steps of scan files in order in one worker thread.
+    '''
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # Number of close and check steps queued and not yet done
+        self._num_gates = 0
+        self._gates = threading.Condition()
+        self._futures = []
+        self._errors = []
+        # Set in the worker when the close or check of the current file fails
+        self._file_failed = False
+
+    def _run(self, func, args):
+        '''Runs one step, unless the close or check of its file failed.
+        Returns whether it ran and succeeded.
+        '''
+        if self._file_failed:
+            log.warning('  *** Skip finishing step %s: the file failed its checks' % func.__name__)
+            return False
+        try:
+            func(*args)
+        except Exception as ee:
+            log.error('  *** Finishing step %s failed: %s' % (func.__name__, ee))
+            self._errors.append(ee)
+            return False
+        return True
+
+    def submit(self, func, *args):
+        '''Queues func(*args).
+        '''
+        self._futures.append(self._executor.submit(self._run, func, args))
+
+    def _gate_done(self, future):
+        # Also called for a gate that was cancelled before it ran
+        with self._gates:
+            self._num_gates -= 1
+            self._gates.notify_all()
+
+    def _submit_gate(self, func, args, new_file):
+        with self._gates:
+            self._num_gates += 1
+
+        def gate():
+            if new_file:
+                self._file_failed = False
+            if not self._run(func, args):
+                self._file_failed = True
+        future = self._executor.submit(gate)
+        future.add_done_callback(self._gate_done)
+        self._futures.append(future)
+
+    def submit_close(self, func, *args):
+        '''Queues func(*args), which waits for the open HDF file to close.
+        Until it returns, wait_closed() blocks.  This starts the steps of a
+        new file.
+        '''
+        self._submit_gate(func, args, True)
+
+    def submit_check(self, func, *args):
+        '''Queues func(*args), a check of the file just closed that the next
+        scan must not start without.  Until it returns, wait_closed() blocks.
+        '''
+        self._submit_gate(func, args, False)
+
+    def _raise_errors(self):
+        if self._errors:
+            error = self._errors[0]
+            self._errors = []
+            raise error
+
+    def wait_closed(self):
+        '''Waits until the last file submitted has closed and been checked.
+        '''
+        with self._gates:
+            if self._num_gates:
+                log.info('  *** Wait for the previous file to close')
+                self._gates.wait_for(lambda: self._num_gates == 0)
+        self._raise_errors()
+
+    def wait_finished(self):
+        '''Waits for all of the steps submitted so far.
+        '''
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+        self._raise_errors()
+
+    def cancel(self):
+        '''Cancels the steps not yet started and waits for the one running.
+        Returns the errors not yet raised, and clears them.
+        '''
+        futures, self._futures = self._futures, []
+        num_cancelled = sum(future.cancel() for future in futures)
+        if num_cancelled:
+            log.warning('  *** Cancelled %d finishing steps' % num_cancelled)
+        for future in futures:
+            if not future.cancelled():
+                future.result()
+        errors, self._errors = self._errors, []
+        return errors
+
+
+finalizer = Finalizer()
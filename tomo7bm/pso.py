@@ -4,228 +4,575 @@ Alan Kastengren, XSD, APS
 
 Started: February 13, 2015
 '''
-import epics
 import numpy as np
 import time
 import math
+import functools
+import threading
+from collections import namedtuple
 
 from tomo7bm import log
+from tomo7bm import pvs
 
-#Parameters for positioning
-req_start = None 
-req_end = None
-actual_end = None
-delta_encoder_counts = None
-delta_egu = None
-num_proj = None 
-num_images_per_proj = None
-PSO_positions = None
-proj_positions = None
-overall_sense = None
-motor_start = None
-speed = None
-user_direction = None
+# Rotation stage used for fly scans.  The driver is created by init_driver()
+# on first use, so importing this module does not need the IOC.
+ROTATION_DRIVER = dict(motor='7bmb1:aero:m3', asynRec='7bmb1:PSOFly3:cmdWriteRead', axis='A',
+                        PSOInput=3, encoder_multiply=float(2**15)/0.36)
+# Encoder direction compared to dial coordinates.  Hard code this; could ask controller
+ENCODER_DIRECTION = -1
+driver = None
+
+# Ensemble ASCII replies start with % on success, ! for a bad command, # on a fault
+PSO_REPLY_OK = '%'
+PSO_REPLY_ERRORS = {'!': 'command error', '#': 'controller fault'}
+PSO_COMMAND_TIMEOUT = 5.0
+PSO_MOVE_TIMEOUT = 300.0
+
+# Fly scan monitoring
+FLY_STALL_PERIODS = 10.0
+FLY_TIMEOUT_FACTOR = 1.5
+FLY_TIMEOUT_MARGIN = 5.0
+FLY_TIMELINE_PERIOD = 1.0
+FRAMERATE_TIME_CONSTANT = 1.0
+TIMELINE_COLUMNS = ('time_s', 'angle_deg', 'frames', 'framerate_hz')
+
+# Shift of each turn of a golden-ratio interlaced scan, in projection spacings
+GOLDEN_FRACTION = (3.0 - math.sqrt(5.0)) / 2.0
+
+
+class StageDescription(namedtuple('StageDescription',
+                        ['encoder_multiply', 'acceleration', 'direction', 'encoder_direction'])):
+    '''The rotation stage properties a fly scan plan depends on.
+    acceleration is the motor record ACCL time (s); direction is DIR.
+    '''
+    __slots__ = ()
+
+
+class FlyScanPlan(namedtuple('FlyScanPlan',
+                    ['req_start', 'req_end', 'num_proj', 'num_images_per_proj', 'speed',
+                     'user_direction', 'overall_sense', 'delta_encoder_counts', 'delta_egu',
+                     'taxi_dist', 'motor_start', 'motor_end', 'actual_end',
+                     'PSO_positions', 'proj_positions', 'window_start', 'window_end',
+                     'time_estimate'])):
+    '''Immutable description of one fly scan: where the motor starts and
+    ends, where the PSO pulses fall, and how long the rotation takes.
+    The PSO window is in encoder counts relative to the arm position,
+    PSO_positions[0].  Make plans with plan_fly_scan().
+    '''
+    __slots__ = ()
+
+
+class ScanOption(namedtuple('ScanOption',
+                    ['num_proj', 'delta_encoder_counts', 'scan_range', 'range_error', 'scan_time'])):
+    '''A projection count with an integral PSO spacing, from solve_spacing().
+    scan_range is the range this spacing covers exactly, range_error its
+    difference from the requested range and scan_time the rotation time.
+    '''
+    __slots__ = ()
 
 
 class AerotechDriver():
     def __init__(self, motor='7bmb1:aero:m1', asynRec='7bmb1:PSOFly1:cmdWriteRead', axis='Z', PSOInput=3,encoder_multiply=1e5):
-        self.motor = epics.Motor(motor)
-        self.asynRec = epics.PV(asynRec + '.BOUT')
+        self.motor = pvs.create_motor(motor)
+        self.asynRec = pvs.create_pv(asynRec + '.BOUT')
+        self.asynReply = pvs.create_pv(asynRec + '.BINP')
         self.axis = axis
         self.PSOInput = PSOInput
         self.encoder_multiply = encoder_multiply
 
-    def program_PSO(self):
-        '''Performs programming of PSO output on the Aerotech driver.
+    def describe(self):
+        '''Reads the stage properties that fly scan planning needs.
+        '''
+        return StageDescription(self.encoder_multiply, self.motor.acceleration,
+                                self.motor.direction, ENCODER_DIRECTION)
+
+    def pso_commands(self, plan):
+        '''Returns the ASCII commands that configure the PSO output for plan,
+        everything but arming.  Checks the plan first, so a bad plan never
+        leaves the controller half configured.
+        '''
+        if plan.delta_encoder_counts <= 0:
+            raise RuntimeError('PSO distance must be at least one encoder count, not %s'
+                                % plan.delta_encoder_counts)
+        if plan.window_start >= plan.window_end:
+            raise RuntimeError('PSO window start %d is not below its end %d'
+                                % (plan.window_start, plan.window_end))
+        return [
+            #Make sure the PSO control is off
+            'PSOCONTROL %s RESET' % self.axis,
+            ## initPSO: commands to the Ensemble to control PSO output.
+            #Set the output to occur from the I/O terminal on the controller
+            'PSOOUTPUT %s CONTROL 1' % self.axis,
+            #Set a pulse 10 us long, 20 us total duration, so 10 us on, 10 us off
+            'PSOPULSE %s TIME 20,10' % self.axis,
+            #Set the pulses to only occur in a specific window
+            'PSOOUTPUT %s PULSE WINDOW MASK' % self.axis,
+            #Set which encoder we will use.  3 = the MXH (encoder multiplier) input, which is what we generally want
+            'PSOTRACK %s INPUT %d' % (self.axis, self.PSOInput),
+            #Set the distance between pulses.  Do this in encoder counts.
+            'PSODISTANCE %s FIXED %d' % (self.axis, plan.delta_encoder_counts),
+            #Which encoder is being used to calculate whether we are in the window.  1 for single axis
+            'PSOWINDOW %s 1 INPUT %d' % (self.axis, self.PSOInput),
+            #The window is in encoder counts, referenced from where we arm the PSO
+            'PSOWINDOW %s 1 RANGE %d,%d' % (self.axis, plan.window_start-5, plan.window_end+5),
+            ]
+
+    def command(self, command):
+        '''Sends one ASCII command and reads the controller reply.
+        Returns (ok, reply).
+        '''
+        status = self.asynRec.put(command, wait=True, timeout=PSO_COMMAND_TIMEOUT)
+        if status is None:
+            return False, 'not connected'
+        if status < 0:
+            return False, 'timed out'
+        reply = self.asynReply.get(as_string=True) or ''
+        if not reply:
+            return False, 'no reply'
+        if reply[0] != PSO_REPLY_OK:
+            return False, PSO_REPLY_ERRORS.get(reply[:1], 'unexpected reply %r' % reply)
+        return True, reply
+
+    def send(self, command):
+        '''Sends one ASCII command.  Raises RuntimeError unless the
+        controller acknowledges it.
+        '''
+        ok, reply = self.command(command)
+        if not ok:
+            raise RuntimeError('PSO command "%s" failed: %s' % (command, reply))
+        return reply
+
+    def start_move(self, position):
+        '''Starts a move without waiting.
+        Returns an Event that is set when the move completes.
+        '''
+        if not self.motor.within_limits(position):
+            raise RuntimeError('Rotation position %f is outside the motor limits' % position)
+        moved = threading.Event()
+        self.motor.PV('VAL').put(position, callback=lambda **kw: moved.set())
+        return moved
+
+    def program_PSO(self, plan):
+        '''Performs programming of PSO output on the Aerotech driver
+        for a FlyScanPlan.
+        The configuration commands go out while the motor moves to the
+        position where the first PSO pulse should be triggered.  We arm
+        once it gets there, and the reply to the ARM command confirms it.
         '''
-        #Place the motor at the position where the first PSO pulse should be triggered
-        self.motor.move(PSO_positions[0], wait=True)
-
-        #Make sure the PSO control is off
-        self.asynRec.put('PSOCONTROL %s RESET' % self.axis, wait=True, timeout=300.0)
-        time.sleep(0.05)
-      
-        ## initPSO: commands to the Ensemble to control PSO output.
-        # Everything but arming and setting the positions for which pulses will occur.
-        #Set the output to occur from the I/O terminal on the controller
-        self.asynRec.put('PSOOUTPUT %s CONTROL 1' % self.axis, wait=True, timeout=300.0)
-        time.sleep(0.05)
-        #Set a pulse 10 us long, 20 us total duration, so 10 us on, 10 us off
-        self.asynRec.put('PSOPULSE %s TIME 20,10' % self.axis, wait=True, timeout=300.0)
-        time.sleep(0.05)
-        #Set the pulses to only occur in a specific window
-        self.asynRec.put('PSOOUTPUT %s PULSE WINDOW MASK' % self.axis, wait=True, timeout=300.0)
-        time.sleep(0.05)
-        #Set which encoder we will use.  3 = the MXH (encoder multiplier) input, which is what we generally want
-        self.asynRec.put('PSOTRACK %s INPUT %d' % (self.axis, self.PSOInput), wait=True, timeout=300.0)
-        time.sleep(0.05)
-        #Set the distance between pulses.  Do this in encoder counts.
-        self.asynRec.put('PSODISTANCE %s FIXED %d' % (self.axis, delta_encoder_counts), wait=True, timeout=300.0)
-        time.sleep(0.05)
-        #Which encoder is being used to calculate whether we are in the window.  1 for single axis
-        self.asynRec.put('PSOWINDOW %s 1 INPUT %d' % (self.axis, self.PSOInput), wait=True, timeout=300.0)
-        time.sleep(0.05)
-
-        #Calculate window function parameters.  Must be in encoder counts, and is 
-        #referenced from the stage location where we arm the PSO.  We are at that point now.
-        #We want pulses to start at start - delta/2, end at end + delta/2.  
-        range_start = -round(delta_encoder_counts / 2) * overall_sense
-        range_length = PSO_positions.shape[0] * delta_encoder_counts
-        #The start of the PSO window must be < end.  Handle this.
-        if overall_sense > 0:
-            window_start = range_start
-            window_end = window_start + range_length
-        else:
-            window_end = range_start
-            window_start = window_end - range_length
-        #Remember, the window settings must be in encoder counts
-        self.asynRec.put('PSOWINDOW %s 1 RANGE %d,%d' % (self.axis, window_start-5, window_end+5), wait=True, timeout=300.0)
-        #print('PSOWINDOW %s 1 RANGE %d,%d' % (self.axis, window_start, window_end))
+        commands = self.pso_commands(plan)
+        moved = self.start_move(plan.PSO_positions[0])
+        for command in commands:
+            self.send(command)
+        if not moved.wait(PSO_MOVE_TIMEOUT):
+            raise RuntimeError('Rotation stage did not reach the PSO start position')
         #Arm the PSO
-        time.sleep(0.05)
-        self.asynRec.put('PSOCONTROL %s ARM' % self.axis, wait=True, timeout=300.0)
+        self.send('PSOCONTROL %s ARM' % self.axis)
         #Move to the actual start position and set the motor speed
-        self.motor.move(motor_start, wait=True)
-        self.motor.put('VELO', speed, wait=True)
+        self.motor.move(plan.motor_start, wait=True)
+        self.motor.put('VELO', plan.speed, wait=True)
 
     def cleanup_PSO(self):
-        '''Cleanup activities after a PSO scan. 
+        '''Cleanup activities after a PSO scan.
         Turns off PSO and sets the speed back to default.
         '''
         log.info('Cleaning up PSO programming and setting to retrace speed.')
-        self.asynRec.put('PSOWINDOW %s OFF' % self.axis, wait=True)
-        self.asynRec.put('PSOCONTROL %s OFF' % self.axis, wait=True)
+        for command in ('PSOWINDOW %s OFF' % self.axis, 'PSOCONTROL %s OFF' % self.axis):
+            ok, reply = self.command(command)
+            if not ok:
+                log.warning('  *** PSO command "%s" failed: %s' % (command, reply))
         self.motor.put('VELO', self.default_speed, wait=True)
- 
 
-driver = AerotechDriver(motor='7bmb1:aero:m3', asynRec='7bmb1:PSOFly3:cmdWriteRead', axis='A', PSOInput=3, encoder_multiply=float(2**15)/0.36)
+
+def init_driver():
+    '''Creates the rotation stage driver if we don't have it yet.
+    '''
+    global driver
+    if driver is None:
+        driver = AerotechDriver(**ROTATION_DRIVER)
+    return driver
+
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
 
 
-def _compute_senses():
-    '''Computes the senses of motion: encoder direction, motor direction,
-    user direction, overall sense.
+@functools.lru_cache(maxsize=None)
+def compute_plan(req_start, req_end, num_proj, num_images_per_proj, speed, stage):
+    '''Computes the FlyScanPlan for a scan on a stage (a StageDescription).
+    These calculations are for tomography scans, where for N images we need N pulses.
+    Moreover, we base these on the number of images, not the delta between.
+    Plans are cached on their inputs, so a series of scans with the same
+    settings is planned only once.
     '''
-    # Encoder direction compared to dial coordinates.  Hard code this; could ask controller
-    encoderDir = -1
     #Get motor direction (dial vs. user)
-    motor_dir = -1 if driver.motor.direction else 1
+    motor_dir = -1 if stage.direction else 1
     #Figure out whether motion is in positive or negative direction in user coordinates
-    global user_direction
     user_direction = 1 if req_end > req_start else -1
     #Figure out overall sense: +1 if motion in + encoder direction, -1 otherwise
-    global overall_sense
-    overall_sense = user_direction * motor_dir * encoderDir
+    overall_sense = user_direction * motor_dir * stage.encoder_direction
 
-    
-def compute_positions():
-    '''Computes several parameters describing the fly scan motion.
-    These calculations are for tomography scans, where for N images we need N pulses.
-    Moreover, we base these on the number of images, not the delta between.
-    '''
-    global actual_end, delta_egu, delta_encoder_counts, motor_start, motor_end, PSO_positions
-    global proj_positions
-    _compute_senses()
     #Get the distance needed for acceleration = 1/2 a t^2 = 1/2 * v * t
-    motor_accl_time = driver.motor.acceleration    #Acceleration time in s
-    accel_dist = motor_accl_time * speed / 2.0  
+    accel_dist = stage.acceleration * speed / 2.0
 
     #Compute the actual delta to keep things at an integral number of encoder counts
-    raw_delta_encoder_counts = (abs(req_end - req_start) 
-                                    / ((num_proj - 1) * num_images_per_proj) * driver.encoder_multiply)
+    raw_delta_encoder_counts = (abs(req_end - req_start)
+                                    / ((num_proj - 1) * num_images_per_proj) * stage.encoder_multiply)
     delta_encoder_counts = round(raw_delta_encoder_counts)
     if abs(raw_delta_encoder_counts - delta_encoder_counts) > 1e-4:
         log.warning('  *** *** *** Requested scan would have used a non-integer number of encoder pulses.')
         log.warning('  *** *** *** Calculated # of encoder pulses per step = {0:9.4f}'.format(raw_delta_encoder_counts))
         log.warning('  *** *** *** Instead, using {0:d}'.format(delta_encoder_counts))
-    delta_egu = delta_encoder_counts / driver.encoder_multiply
-                
+    delta_egu = delta_encoder_counts / stage.encoder_multiply
+
     #Make taxi distance an integral number of measurement deltas >= accel distance
     #Add 1/2 of a delta to ensure that we are really up to speed.
     taxi_dist = (math.ceil(accel_dist / delta_egu) + 0.5) * delta_egu
     motor_start = req_start - taxi_dist * user_direction
     motor_end = req_end + taxi_dist * user_direction
-    
+
     #Where will the last point actually be?
     actual_end = req_start + (num_proj * num_images_per_proj- 1) * delta_egu * user_direction
     end_proj = req_start + (num_proj - 1) * delta_egu * user_direction * num_images_per_proj
     PSO_positions = np.linspace(req_start, actual_end, num_proj * num_images_per_proj)
-    proj_positions = np.linspace(req_start, end_proj, num_proj) 
-    log_info()
+    proj_positions = np.linspace(req_start, end_proj, num_proj)
+
+    #Calculate window function parameters.  Must be in encoder counts, and is
+    #referenced from the stage location where we arm the PSO.
+    #We want pulses to start at start - delta/2, end at end + delta/2.
+    range_start = -round(delta_encoder_counts / 2) * overall_sense
+    range_length = PSO_positions.shape[0] * delta_encoder_counts
+    #The start of the PSO window must be < end.  Handle this.
+    if overall_sense > 0:
+        window_start = range_start
+        window_end = window_start + range_length
+    else:
+        window_end = range_start
+        window_start = window_end - range_length
+
+    #Constant speed over the whole move, plus one acceleration time
+    time_estimate = abs(motor_end - motor_start) / speed + stage.acceleration
+    return FlyScanPlan(req_start, req_end, num_proj, num_images_per_proj, speed,
+                        user_direction, overall_sense, delta_encoder_counts, delta_egu,
+                        taxi_dist, motor_start, motor_end, actual_end,
+                        _read_only(PSO_positions), _read_only(proj_positions),
+                        window_start, window_end, time_estimate)
+
+
+def solve_spacing(scan_range, num_proj, window, encoder_multiply, frame_rate,
+                  num_images_per_proj=1, time_budget=0.0, closed=True, max_options=10):
+    '''Lists the projection counts within window of num_proj, each with
+    the integral PSO spacings just below and above the ideal one.
+    closed scans include both ends of the range, so n projections span
+    n - 1 spacings; continuous scans span n.  scan_time is at frame_rate
+    images per second, and options over a time_budget (if > 0) are dropped.
+    Returns up to max_options ScanOptions, exact ranges first, then the
+    smallest range error, the nearest projection count and the shortest time.
+    '''
+    num = np.arange(max(num_proj - window, 2), num_proj + window + 1)
+    intervals = (num - 1 if closed else num) * num_images_per_proj
+    raw_counts = abs(scan_range) * encoder_multiply / intervals
+    options = np.unique(np.concatenate([np.column_stack([num, intervals, np.floor(raw_counts)]),
+                                        np.column_stack([num, intervals, np.ceil(raw_counts)])]),
+                        axis=0)
+    num, intervals, counts = options[options[:, 2] >= 1].T
+    exact_range = counts * intervals / encoder_multiply
+    range_error = exact_range - abs(scan_range)
+    scan_time = intervals / frame_rate
+    keep = scan_time <= time_budget if time_budget > 0 else np.ones(num.shape, dtype=bool)
+    order = np.lexsort((scan_time, np.abs(num - num_proj), np.round(np.abs(range_error), 9)))
+    return [ScanOption(int(num[i]), int(counts[i]), float(exact_range[i]), float(range_error[i]),
+                       float(scan_time[i])) for i in order if keep[i]][:max_options]
+
+
+def _images_per_projection(params):
+    if params.recursive_filter:
+        return int(params.recursive_filter_n_images)
+    return 1
+
+
+def plan_fly_scan(params, stage):
+    '''Returns the FlyScanPlan for params on a stage (a StageDescription).
+    '''
+    return compute_plan(float(params.sample_rotation_start), float(params.sample_rotation_end),
+                        int(params.num_projections), _images_per_projection(params),
+                        float(params.slew_speed), stage)
+
+
+def frame_rate_limits(params, im_half_width, camera_max_framerate=np.inf, disk_max_framerate=np.inf):
+    '''Returns the angle (deg) between images of params and the highest
+    frame rate (Hz) each limit allows, as {limit: frame rate}: the exposure
+    and readout time, the camera link and the disk write rate and, unless
+    params.auto_slew_speed is 'acquisition' or projections are averaged,
+    the motion blur at im_half_width pixels from the rotation axis.
+    '''
+    num_images = _images_per_projection(params)
+    delta_angle = abs(params.sample_rotation_end - params.sample_rotation_start) / (params.num_projections - 1) / num_images
+    limits = {'acquisition time': 1.0 / (params.exposure_time + params.ccd_readout),
+              'camera link': camera_max_framerate, 'disk write rate': disk_max_framerate}
+    if params.auto_slew_speed != 'acquisition' and num_images == 1:
+        max_blur_angle = np.degrees(np.arcsin(params.permitted_blur / im_half_width))
+        limits['blur'] = max_blur_angle / params.exposure_time / delta_angle
+    return delta_angle, limits
+
+
+def interlace_fraction(mode, num_segments):
+    '''Returns the fraction of the projection spacing by which each turn
+    of an interlaced scan is shifted: the golden ratio fraction, 1/N for
+    a uniform interlace of N turns, or 0 for no interlacing.
+    '''
+    if mode == 'golden':
+        return GOLDEN_FRACTION
+    if mode == 'uniform':
+        return 1.0 / num_segments
+    return 0.0
+
+
+def plan_continuous_scan(params, stage, num_segments, fraction=0.0):
+    '''Returns one FlyScanPlan for num_segments back-to-back scans of
+    params, taken in a single rotation at constant speed.
+    The projections are spaced by the range over num_projections + fraction,
+    rounded to whole encoder counts as the PSO needs.  With no fraction,
+    segment k starts k ranges after the first one and every segment
+    measures the same angles, modulo the range.  A fraction shifts the
+    angles of each turn by that part of the spacing, which interlaces the
+    turns with a fixed PSO distance.  If the range is not a whole number of
+    spacings, each turn drifts by the difference; the drift at the last
+    segment is logged.
+    '''
+    req_start = float(params.sample_rotation_start)
+    scan_range = float(params.sample_rotation_end) - req_start
+    num_proj = int(params.num_projections)
+    num_images = _images_per_projection(params)
+    counts = max(round(abs(scan_range) * stage.encoder_multiply / ((num_proj + fraction) * num_images)), 1)
+    spacing = math.copysign(counts * num_images / stage.encoder_multiply, scan_range)
+    drift = (num_segments - 1) * ((num_proj + fraction) * abs(spacing) - abs(scan_range))
+    if abs(drift) > 1e-9:
+        log.warning('  *** *** *** Spacing rounded to {:d} encoder counts; the last segment is {:.6f} deg '
+                    'off the first, modulo the range'.format(counts, drift))
+    total_proj = int(math.ceil(num_segments * (num_proj + fraction) - 1e-9))
+    return compute_plan(req_start, req_start + spacing * (total_proj - 1),
+                        total_proj, num_images,
+                        float(params.slew_speed), stage)
+
+
+def subscan_index(plan, scan_range):
+    '''Returns the turn each projection of plan falls in, counting turns
+    of scan_range from the start angle.
+    '''
+    offset = (plan.proj_positions - plan.req_start) * plan.user_direction
+    return np.floor(offset / abs(scan_range) + 1e-9).astype(int)
+
+
+def reverse_plan(plan, stage):
+    '''Returns the plan for the same projections as plan, taken in the
+    opposite direction.  The reverse pass starts at the last projection
+    angle of plan, so both passes measure the same angles.
+    '''
+    return compute_plan(float(plan.proj_positions[-1]), plan.req_start, plan.num_proj,
+                        plan.num_images_per_proj, plan.speed, stage)
+
 
-    
 def set_default_speed(speed):
     log.info('Setting retrace speed on motor to {0:f} deg/s'.format(float(speed)))
-    driver.default_speed = speed
+    init_driver().default_speed = speed
 
 
-def program_PSO():
-    '''Cause the Aerotech driver to program its PSO.
+def program_PSO(plan):
+    '''Cause the Aerotech driver to program its PSO for a FlyScanPlan.
     '''
     log.info('  *** *** Programming motor')
-    driver.program_PSO()
+    driver.program_PSO(plan)
 
 
 def cleanup_PSO():
+    if driver is None:
+        return
     driver.cleanup_PSO()
 
-def log_info():
+def log_info(plan):
     log.warning('  *** *** Positions for fly scan.')
-    log.info('  *** *** *** Motor start = {0:f}'.format(req_start))
-    log.info('  *** *** *** Motor end = {0:f}'.format(actual_end))
-    log.info('  *** *** *** # Points = {0:4d}'.format(num_proj))
-    log.info('  *** *** *** Degrees per image = {0:f}'.format(delta_egu))
-    log.info('  *** *** *** Degrees per projection = {0:f}'.format(delta_egu / num_images_per_proj))
-    log.info('  *** *** *** Encoder counts per image = {0:d}'.format(delta_encoder_counts))
+    log.info('  *** *** *** Motor start = {0:f}'.format(plan.req_start))
+    log.info('  *** *** *** Motor end = {0:f}'.format(plan.actual_end))
+    log.info('  *** *** *** # Points = {0:4d}'.format(plan.num_proj))
+    log.info('  *** *** *** Degrees per image = {0:f}'.format(plan.delta_egu))
+    log.info('  *** *** *** Degrees per projection = {0:f}'.format(plan.delta_egu / plan.num_images_per_proj))
+    log.info('  *** *** *** Encoder counts per image = {0:d}'.format(plan.delta_encoder_counts))
 
 
-def pso_init(params):
+def pso_init(params, reverse=False, num_segments=1):
     '''Initialize calculations.
+    Returns the FlyScanPlan for params, run from the end back to the
+    start if reverse is set, or continuously over num_segments scans.
     '''
-    global req_start, req_end, num_proj, num_images_per_proj, speed
-    req_start = params.sample_rotation_start
-    req_end = params.sample_rotation_end
-    num_proj = params.num_projections
-    if params.recursive_filter:
-        num_images_per_proj = params.recursive_filter_n_images
-    else:
-        num_images_per_proj = 1
-    speed = params.slew_speed
-    driver.default_speed = params.retrace_speed
-    compute_positions()
-
-
-def fly(global_PVs, params):
-    angular_range =  params.sample_rotation_end -  params.sample_rotation_start
-    flyscan_time_estimate = angular_range / params.slew_speed
-    log.warning('  *** Fly Scan Time Estimate: %4.2f minutes' % (flyscan_time_estimate/60.))
-    #Trigger fly motion to start.  Don't wait for it, since it takes time.
-    start_time = time.time()
-    driver.motor.move(motor_end, wait=False)
-    time.sleep(1)
-    old_image_counter = 0
-    expected_framerate = driver.motor.slew_speed / delta_egu
-    #Monitor the motion to make sure we aren't stuck.
-    i = 0
-    while time.time() - start_time < 1.5 * flyscan_time_estimate:
-        i += 1
-        if i % 10 == 0:
-            log.info('  *** *** Sample rotation at angle {:f}'.format(driver.motor.readback))
-        time.sleep(1)
-        if not driver.motor.moving:
-            log.info('  *** *** Sample rotation stopped moving.')
-            if abs(driver.motor.drive - motor_end) > 1e-2:
-                log.error('  *** *** Sample rotation ended but not at right position!')
-                raise ValueError
-            else:
-                log.info('  *** *** Stopped at correct position.')
-                break
-        #Make sure we're actually getting frames.
-        current_image_counter = global_PVs['Cam1_NumImagesCounter'].get()
-        if current_image_counter - old_image_counter < 0.2 * expected_framerate:
-            log.error('  *** *** Not collecting frames!')
-            raise ValueError 
-        else:
-            old_image_counter = current_image_counter
+    init_driver().default_speed = params.retrace_speed
+    stage = driver.describe()
+    if num_segments > 1:
+        log.info('  *** *** Continuous scan of {:d} segments'.format(num_segments))
+        fraction = interlace_fraction(params.interlace, num_segments)
+        if fraction:
+            log.info('  *** *** Turns interlaced by {:5.3f} of the projection spacing'.format(fraction))
+        plan = plan_continuous_scan(params, stage, num_segments, fraction)
     else:
-        log.warning('  *** *** Fly motion timed out!')
-        raise ValueError
+        plan = plan_fly_scan(params, stage)
+    if reverse:
+        log.info('  *** *** Reverse pass')
+        plan = reverse_plan(plan, stage)
+    log_info(plan)
+    return plan
+
+
+class FlyMonitor():
+    '''Follows a fly scan through monitors on the rotation motor (RBV and
+    DMOV) and on the camera image counter.
+
+    Keeps a running frame rate, flags a stall once no frame has come for
+    stall_periods frame periods, and returns as soon as the motion is done.
+    timeline holds one (time, angle, frames, frame rate) row per second;
+    readback logs every (time stamp, angle) update of the rotation RBV.
+    first_frame is the index in the HDF file of the first fly scan frame.
+    With live, a live.FrameRing, and its limits (max_drop, max_saturated,
+    max_drift), the scan also stops once the frames look bad.
+    '''
+    def __init__(self, motor, image_counter, plan, stall_periods=FLY_STALL_PERIODS, first_frame=0,
+                 live=None, live_limits=None):
+        self.motor = motor
+        self.live = live
+        self.live_limits = live_limits
+        self.image_counter = image_counter
+        self.plan = plan
+        self.first_frame = first_frame
+        self.expected_frames = plan.num_proj * plan.num_images_per_proj
+        self.expected_framerate = plan.speed / plan.delta_egu
+        self.stall_time = stall_periods / self.expected_framerate
+        self.angle = None
+        self.frames = 0
+        self.framerate = 0.0
+        self.timeline = []
+        self.readback = []
+        self.start_time = None
+        self.last_frame_time = None
+        self._was_moving = False
+        self._moved = threading.Event()
+        self._changed = threading.Event()
+
+    def _on_angle(self, value=None, timestamp=None, **kw):
+        self.angle = value
+        if self.start_time is not None:
+            self.readback.append((timestamp or time.time(), value))
+
+    def _on_done_moving(self, value=None, **kw):
+        if value == 0:
+            self._was_moving = True
+        elif self._was_moving:
+            self._finish()
+
+    def _on_frames(self, value=None, **kw):
+        if value is None or self.start_time is None or value <= self.frames:
+            return
+        now = time.time()
+        dt = now - (self.last_frame_time or self.start_time)
+        if dt > 0:
+            weight = 1.0 - math.exp(-dt / FRAMERATE_TIME_CONSTANT)
+            self.framerate += weight * ((value - self.frames) / dt - self.framerate)
+        self.frames = value
+        self.last_frame_time = now
+        self._changed.set()
+
+    def _finish(self, **kw):
+        self._moved.set()
+        self._changed.set()
+
+    def _sample(self, now):
+        self.timeline.append((now - self.start_time, self.angle, self.frames, self.framerate))
+        if len(self.timeline) % 10 == 0:
+            log.info('  *** *** Sample rotation at angle {:f}'.format(self.angle))
+
+    def run(self, timeout):
+        '''Starts the rotation to the end of the plan and follows it.
+        Raises ValueError if frames stop coming, the motion times out or
+        it ends in the wrong place.
+        '''
+        subscriptions = [(pv, pv.add_callback(callback, with_ctrlvars=False)) for pv, callback in
+                         ((self.motor.PV('RBV'), self._on_angle),
+                          (self.motor.PV('DMOV'), self._on_done_moving),
+                          (self.image_counter, self._on_frames))]
+        try:
+            self.angle = self.motor.readback
+            self.frames = self.image_counter.get()
+            # The first pulse comes once we are through the taxi distance
+            accel_time = self.motor.acceleration
+            first_frame_due = accel_time + (self.plan.taxi_dist - self.plan.speed * accel_time / 2.0) / self.plan.speed
+            self.start_time = time.time()
+            self.readback.append((self.start_time, self.angle))
+            first_frame_due += self.start_time
+            next_sample = self.start_time
+            #Trigger fly motion to start.  Don't wait for it, since it takes time.
+            self.motor.PV('VAL').put(self.plan.motor_end, callback=self._finish)
+            while True:
+                self._changed.clear()
+                now = time.time()
+                if now >= next_sample:
+                    self._sample(now)
+                    next_sample += FLY_TIMELINE_PERIOD
+                if self._moved.is_set():
+                    break
+                if now - self.start_time > timeout:
+                    log.warning('  *** *** Fly motion timed out!')
+                    raise ValueError
+                wake_time = min(next_sample, self.start_time + timeout)
+                #Make sure we're actually getting frames.
+                if self.frames < self.expected_frames:
+                    frame_due = max(self.last_frame_time or first_frame_due, first_frame_due)
+                    if now - frame_due > self.stall_time:
+                        log.error('  *** *** Not collecting frames!')
+                        raise ValueError
+                    wake_time = min(wake_time, frame_due + self.stall_time)
+                if self.live is not None:
+                    reason = self.live.check(*self.live_limits)
+                    if reason is not None:
+                        log.error('  *** *** Bad scan: %s' % reason)
+                        raise ValueError(reason)
+                self._changed.wait(max(wake_time - now, 0.0))
+            self._sample(time.time())
+            self.readback.append((time.time(), self.motor.readback))
+        finally:
+            for pv, index in subscriptions:
+                pv.remove_callback(index)
+        log.info('  *** *** Sample rotation stopped moving.')
+        if abs(self.motor.drive - self.plan.motor_end) > 1e-2:
+            log.error('  *** *** Sample rotation ended but not at right position!')
+            raise ValueError
+        log.info('  *** *** Stopped at correct position.')
+        log.info('  *** *** {:d} frames in {:5.2f} s'.format(int(self.frames), time.time() - self.start_time))
+        return self
+
+    def as_array(self):
+        '''Returns the timeline as an array with columns
+        time (s), angle (deg), frames and frame rate (Hz).
+        '''
+        return np.array(self.timeline, dtype=float).reshape(-1, 4)
+
+    def angles_at(self, times):
+        '''Returns the rotation angle at each of times (POSIX seconds),
+        interpolated in the readback log; NaN outside the logged motion.
+        '''
+        log_times, angles = np.array(sorted(self.readback), dtype=float).reshape(-1, 2).T
+        return np.interp(times, log_times, angles, left=np.nan, right=np.nan)
+
+    def save(self, file_name):
+        '''Writes the timeline to a text file.
+        '''
+        np.savetxt(file_name, self.as_array(), header=' '.join(TIMELINE_COLUMNS))
+
+
+def fly(global_PVs, params, plan, live=None):
+    '''Runs the fly motion for plan, watching it with a FlyMonitor, and
+    with live, a live.FrameRing, checking the frames.
+    Returns the monitor, which holds the timeline of the scan.
+    '''
+    log.warning('  *** Fly Scan Time Estimate: %4.2f minutes' % (plan.time_estimate/60.))
+    monitor = FlyMonitor(driver.motor, global_PVs['Cam1_NumImagesCounter'], plan,
+                         params.fly_stall_periods, int(global_PVs['HDF1_NumCaptured_RBV'].get()),
+                         live, (params.live_intensity_drop, params.live_max_saturation, params.live_max_drift))
+    return monitor.run(max(FLY_TIMEOUT_FACTOR * plan.time_estimate, plan.time_estimate + FLY_TIMEOUT_MARGIN))
@@ -0,0 +1,193 @@
+'''
+    Declarative PV tables and a lazily-connected PV dictionary.
+
+    The camera templates below are shared by the 7-BM and 2-BM definitions
+    in aps7bm and aps2bm.  Each entry maps the name used throughout
+    scan.py, flir.py and align.py to a PV suffix under the camera IOC prefix.
+'''
+import os
+import json
+import atexit
+from collections import OrderedDict
+
+from tomo7bm import log
+from tomo7bm import pvs
+
+# Point Grey / FLIR areaDetector PVs, appended to the camera IOC prefix
+CAMERA_PVS = OrderedDict([
+    # general PV's
+    ('Cam1_SerialNumber', 'cam1:SerialNumber'),
+    ('Cam1_AsynPort', 'cam1:PortName_RBV'),
+    ('Cam1_ImageMode', 'cam1:ImageMode'),
+    ('Cam1_ArrayCallbacks', 'cam1:ArrayCallbacks'),
+    ('Cam1_AcquirePeriod', 'cam1:AcquirePeriod'),
+    ('Cam1_TriggerMode', 'cam1:TriggerMode'),
+    ('Cam1_SoftwareTrigger', 'cam1:SoftwareTrigger'),  ### ask Mark is this is exposed in the medm screen
+    ('Cam1_AcquireTime', 'cam1:AcquireTime'),
+    ('Cam1_FrameType', 'cam1:FrameType'),
+    ('Cam1_NumImages', 'cam1:NumImages'),
+    ('Cam1_NumImagesCounter', 'cam1:NumImagesCounter_RBV'),
+    ('Cam1_Acquire', 'cam1:Acquire'),
+    ('Cam1_AttributeFile', 'cam1:NDAttributesFile'),
+    ('Cam1_FrameTypeZRST', 'cam1:FrameType.ZRST'),
+    ('Cam1_FrameTypeONST', 'cam1:FrameType.ONST'),
+    ('Cam1_FrameTypeTWST', 'cam1:FrameType.TWST'),
+    ('Cam1_Display', 'image1:EnableCallbacks'),
+
+    ('Cam1_SizeX', 'cam1:SizeX'),
+    ('Cam1_SizeY', 'cam1:SizeY'),
+    ('Cam1_SizeX_RBV', 'cam1:SizeX_RBV'),
+    ('Cam1_SizeY_RBV', 'cam1:SizeY_RBV'),
+    ('Cam1_MaxSizeX_RBV', 'cam1:MaxSizeX_RBV'),
+    ('Cam1_MaxSizeY_RBV', 'cam1:MaxSizeY_RBV'),
+    ('Cam1PixelFormat_RBV', 'cam1:PixelFormat_RBV'),
+    ('Cam1_BinX', 'cam1:BinX'),
+    ('Cam1_BinY', 'cam1:BinY'),
+    ('Cam1_Image_Dtype', 'image1:DataType_RBV'),
+    ('Cam1_Image', 'image1:ArrayData'),
+
+    # hdf5 writer PV's
+    ('HDF1_AutoSave', 'HDF1:AutoSave'),
+    ('HDF1_DeleteDriverFile', 'HDF1:DeleteDriverFile'),
+    ('HDF1_EnableCallbacks', 'HDF1:EnableCallbacks'),
+    ('HDF1_BlockingCallbacks', 'HDF1:BlockingCallbacks'),
+    ('HDF1_FileWriteMode', 'HDF1:FileWriteMode'),
+    ('HDF1_NumCapture', 'HDF1:NumCapture'),
+    ('HDF1_Capture', 'HDF1:Capture'),
+    ('HDF1_Capture_RBV', 'HDF1:Capture_RBV'),
+    ('HDF1_NumCaptured_RBV', 'HDF1:NumCaptured_RBV'),
+    ('HDF1_FilePath', 'HDF1:FilePath'),
+    ('HDF1_FileName', 'HDF1:FileName'),
+    ('HDF1_FullFileName_RBV', 'HDF1:FullFileName_RBV'),
+    ('HDF1_FileTemplate', 'HDF1:FileTemplate'),
+    ('HDF1_ArrayPort', 'HDF1:NDArrayPort'),
+    ('HDF1_FileNumber', 'HDF1:FileNumber'),
+    ('HDF1_XMLFileName', 'HDF1:XMLFileName'),
+    ('HDF1_ExtraDimSizeN', 'HDF1:ExtraDimSizeN'),
+    ('HDF1_QueueSize', 'HDF1:QueueSize'),
+    ('HDF1_QueueFree', 'HDF1:QueueFree'),
+
+    # proc1 PV's
+    ('Image1_Callbacks', 'image1:EnableCallbacks'),
+    ('Image1_UniqueId', 'image1:UniqueId_RBV'),
+    ('Proc1_Callbacks', 'Proc1:EnableCallbacks'),
+    ('Proc1_ArrayPort', 'Proc1:NDArrayPort'),
+    ('Proc1_Filter_Enable', 'Proc1:EnableFilter'),
+    ('Proc1_Filter_Type', 'Proc1:FilterType'),
+    ('Proc1_Num_Filter', 'Proc1:NumFilter'),
+    ('Proc1_Reset_Filter', 'Proc1:ResetFilter'),
+    ('Proc1_AutoReset_Filter', 'Proc1:AutoResetFilter'),
+    ('Proc1_Filter_Callbacks', 'Proc1:FilterCallbacks'),
+    ('Proc1_Enable_Background', 'Proc1:EnableBackground'),
+    ('Proc1_Enable_FlatField', 'Proc1:EnableFlatField'),
+    ('Proc1_Enable_Offset_Scale', 'Proc1:EnableOffsetScale'),
+    ('Proc1_Enable_Low_Clip', 'Proc1:EnableLowClip'),
+    ('Proc1_Enable_High_Clip', 'Proc1:EnableHighClip'),
+    ])
+
+# Extra PVs on the FLIR Spinnaker IOCs
+SPINNAKER_PVS = OrderedDict([
+    ('Cam1_AcquireTimeAuto', 'cam1:AcquireTimeAuto'),
+    ('Cam1_FrameRateOnOff', 'cam1:FrameRateEnable'),
+    ('Cam1_TriggerSource', 'cam1:TriggerSource'),
+    ('Cam1_TriggerOverlap', 'cam1:TriggerOverlap'),
+    ('Cam1_ExposureMode', 'cam1:ExposureMode'),
+    ('Cam1_TriggerSelector', 'cam1:TriggerSelector'),
+    ('Cam1_TriggerActivation', 'cam1:TriggerActivation'),
+    ])
+
+
+class PVRegistry(dict):
+    '''Dictionary of PV objects that are only created when first used.
+
+    Names are declared with define() and connect on first access, so a
+    command only pays for the channels it touches.  The names each command
+    uses are saved to usage_file at exit, and preconnect() can then connect
+    them in bulk the next time the same command runs.
+    '''
+    def __init__(self, command=None, usage_file=None):
+        super().__init__()
+        self.templates = OrderedDict()
+        self.used = set()
+        self.command = command
+        self.usage_file = usage_file
+        if command is not None and usage_file is not None:
+            atexit.register(self.save_usage)
+
+    def define(self, name, pvname, motor=False):
+        '''Declares a PV.  Motors are created as motor objects, not plain PVs.
+        '''
+        self.templates[name] = (pvname, motor)
+
+    def define_all(self, table, prefix='', motor=False):
+        '''Declares every {name: suffix} entry in table under prefix.
+        '''
+        for name, suffix in table.items():
+            self.define(name, prefix + suffix, motor)
+
+    def __getitem__(self, name):
+        pv = super().__getitem__(name)
+        self.used.add(name)
+        return pv
+
+    def __missing__(self, name):
+        if name not in self.templates:
+            raise KeyError(name)
+        self._create([name])
+        return dict.__getitem__(self, name)
+
+    def _create(self, names):
+        motors = OrderedDict()
+        for name in names:
+            pvname, motor = self.templates[name]
+            if motor:
+                motors[name] = pvname
+            else:
+                dict.__setitem__(self, name, pvs.create_pv(pvname))
+        pvs.create_motors(self, motors)
+
+    def preconnect(self, names=None, timeout=pvs.CONNECTION_TIMEOUT):
+        '''Creates and connects a group of PVs in bulk.
+        Defaults to every defined PV.
+        Returns the list of names that did not connect.
+        '''
+        if names is None:
+            names = self.templates.keys()
+        names = [name for name in names if name in self.templates]
+        self._create([name for name in names if not dict.__contains__(self, name)])
+        return pvs.connect_pvs(OrderedDict((name, dict.__getitem__(self, name)) for name in names),
+                                timeout)
+
+    def recorded_usage(self):
+        '''Returns the names this command used on previous runs, or None.
+        '''
+        if self.command is None or self.usage_file is None:
+            return None
+        return load_usage(self.usage_file).get(self.command)
+
+    def save_usage(self):
+        '''Adds the names used in this run to the record for this command.
+        '''
+        used = set(name for name in self.used if name in self.templates)
+        if not used:
+            return
+        usage = load_usage(self.usage_file)
+        usage[self.command] = sorted(used.union(usage.get(self.command, [])))
+        try:
+            with open(self.usage_file, 'w') as f:
+                json.dump(usage, f, indent=2)
+        except OSError:
+            log.warning('  *** Could not record PV usage in %s' % self.usage_file)
+
+
+def load_usage(usage_file):
+    '''Reads the {command: [PV names]} record written by PVRegistry.
+    '''
+    if not os.path.exists(usage_file):
+        return {}
+    try:
+        with open(usage_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        log.warning('  *** Could not read PV usage from %s' % usage_file)
+        return {}
@@ -0,0 +1,364 @@
+'''
+    Helpers for working with groups of EPICS PVs.
+
+    The functions here only rely on the pyepics PV interface (get, put,
+    add_callback, remove_callback), so they work the same for the Sector
+    7-BM and 2-BM PV dictionaries, and for the simulated beamline in sim.py.
+'''
+import math
+import time
+import threading
+
+import epics
+
+from tomo7bm import log
+
+EPSILON = 0.1
+SETTLE_TIME = 0.01
+RECHECK_TIME = 1.0
+CONNECTION_TIMEOUT = 5.0
+PUT_TIMEOUT = 30.0
+MOTOR_WAIT_FIELDS = ('VAL', 'RBV', 'DMOV')
+MOVE_TOLERANCE = 1e-3
+MOVE_TIMEOUT = 300.0
+# POSIX time of the EPICS epoch, 1990-01-01 UTC, for IOC time stamps
+EPICS_EPOCH = 631152000.0
+
+# Object providing PV() and Motor() in place of pyepics; None for the IOCs
+backend = None
+
+
+def set_backend(new_backend):
+    '''Creates all PVs and motors made from now on through new_backend,
+    e.g. a sim.Beamline.  None goes back to real EPICS channels.
+    '''
+    global backend
+    backend = new_backend
+
+
+def create_pv(pvname, **kw):
+    '''Creates a PV object for pvname on the current backend.
+    Keywords go to epics.PV, e.g. auto_monitor.
+    '''
+    if backend is not None:
+        return backend.PV(pvname, **kw)
+    return epics.PV(pvname, **kw)
+
+
+def create_motor(name):
+    '''Creates a single motor object for the motor record name.
+    '''
+    return create_motors({}, {'motor': name})['motor']
+
+
+def _matches(pv_val, wait_val, tolerance):
+    '''Checks a PV value against a target, with a tolerance for floats.
+    '''
+    if isinstance(pv_val, float):
+        try:
+            if abs(pv_val - wait_val) < tolerance:
+                return True
+        except TypeError:
+            pass
+    return pv_val == wait_val
+
+
+def wait_pvs(pv_values, max_timeout_sec=-1, tolerance=EPSILON):
+    ''' Wait on several PVs to reach their values.
+    pv_values is a list of (pv, wait_val) pairs.
+    max_timeout_sec is an optional timeout time.
+    Uses monitor callbacks, so we wake up as soon as the last PV matches,
+    rather than polling each PV.  The PVs are re-read every RECHECK_TIME
+    in case a monitor update gets lost.
+    '''
+    time.sleep(SETTLE_TIME)
+    startTime = time.time()
+    changed = threading.Event()
+    latest = [None] * len(pv_values)
+    callbacks = []
+
+    def make_callback(i):
+        def on_change(value=None, **kw):
+            latest[i] = value
+            changed.set()
+        return on_change
+
+    try:
+        # Register callbacks before reading, so no change can slip in between
+        for i, (pv, wait_val) in enumerate(pv_values):
+            callbacks.append((pv, pv.add_callback(make_callback(i), with_ctrlvars=False)))
+        for i, (pv, wait_val) in enumerate(pv_values):
+            latest[i] = pv.get()
+        while True:
+            changed.clear()
+            pending = [i for i, (pv, wait_val) in enumerate(pv_values)
+                        if not _matches(latest[i], wait_val, tolerance)]
+            if not pending:
+                return True
+            wait_time = RECHECK_TIME
+            if max_timeout_sec > -1:
+                diffTime = time.time() - startTime
+                if diffTime >= max_timeout_sec:
+                    for i in pending:
+                        pv, wait_val = pv_values[i]
+                        log.error('  *** %s did not reach %s within %5.2f s'
+                                    % (pv.pvname, str(wait_val), max_timeout_sec))
+                    return False
+                wait_time = min(wait_time, max_timeout_sec - diffTime)
+            if not changed.wait(wait_time):
+                for i in pending:
+                    latest[i] = pv_values[i][0].get()
+    finally:
+        for pv, index in callbacks:
+            pv.remove_callback(index)
+
+
+def wait_pv(pv, wait_val, max_timeout_sec=-1, tolerance=EPSILON):
+    ''' Wait on a PV to reach a value.
+    max_timeout_sec is an optional timeout time.
+    Returns True if the value was reached, False on timeout.
+    '''
+    return wait_pvs([(pv, wait_val)], max_timeout_sec, tolerance)
+
+
+def move_motors(global_PVs, targets, timeout=MOVE_TIMEOUT, tolerance=MOVE_TOLERANCE):
+    '''Moves several motors together and waits for all of them.
+    targets is {name in global_PVs: position}.  Every move starts at once,
+    with a put callback on VAL that completes when that motor is done;
+    the readbacks are then checked in one pass.
+    Returns the names of the motors that timed out or ended more than
+    tolerance from their target, after logging them.
+    '''
+    done = threading.Event()
+    pending = set(targets)
+    lock = threading.Lock()
+
+    def on_complete(data=None, **kw):
+        with lock:
+            pending.discard(data)
+            if not pending:
+                done.set()
+
+    for name, position in targets.items():
+        if global_PVs[name].PV('VAL').put(position, callback=on_complete, callback_data=name) is None:
+            on_complete(data=name)
+    if not done.wait(timeout):
+        with lock:
+            for name in sorted(pending):
+                log.error('  *** move of {:s} to {:f} timed out after {:4.1f} s'.format(
+                            name, targets[name], timeout))
+    failed = []
+    for name, position in targets.items():
+        readback = global_PVs[name].readback
+        if abs(readback - position) > tolerance:
+            log.error('  *** {:s} at {:f}, not {:f}'.format(name, readback, position))
+            failed.append(name)
+    return failed
+
+
+def _channels(pv):
+    '''Returns the channels we need connected for an entry of global_PVs.
+    '''
+    if hasattr(pv, 'PV'):
+        # epics.Motor, or a simulated motor
+        return [pv.PV(field, connect=False) for field in MOTOR_WAIT_FIELDS]
+    return [pv]
+
+
+def create_motors(global_PVs, motor_names):
+    '''Creates epics.Motor objects for a dict of {key: motor PV prefix}.
+    Motor() blocks on its own RTYP read, so we first request every field of
+    every motor; the motors then connect in parallel rather than in series.
+    '''
+    prefixes = {}
+    for key, name in motor_names.items():
+        if name.endswith('.VAL'):
+            name = name[:-4]
+        prefixes[key] = name
+        if backend is not None:
+            continue
+        for field in epics.Motor._init_list:
+            epics.get_pv('%s.%s' % (name, field), connect=False)
+    for key, name in prefixes.items():
+        if backend is not None:
+            global_PVs[key] = backend.Motor(name)
+        else:
+            global_PVs[key] = epics.Motor(name)
+    return global_PVs
+
+
+def connect_pvs(global_PVs, timeout=CONNECTION_TIMEOUT):
+    '''Waits for all PVs in global_PVs to connect, with one overall timeout.
+    Creating a PV does not block, so all of the connection requests are
+    already in flight and we only pay for the slowest one.
+    Logs a table of the PVs that did not connect.
+    Returns the list of names that did not connect.
+    '''
+    start_time = time.time()
+    deadline = start_time + timeout
+    failed = []
+    for name, pv in global_PVs.items():
+        for channel in _channels(pv):
+            if not channel.wait_for_connection(max(deadline - time.time(), 1e-3)):
+                failed.append((name, channel.pvname))
+    connect_time = time.time() - start_time
+    num_channels = sum(len(_channels(pv)) for pv in global_PVs.values())
+    log.info('  *** Connected {:d} of {:d} PVs in {:5.3f} s'.format(
+                num_channels - len(failed), num_channels, connect_time))
+    if failed:
+        log.error('  *** {:d} PVs did not connect within {:4.1f} s:'.format(len(failed), timeout))
+        log.error('  ***   {:<30s} {:s}'.format('Name', 'PV'))
+        for name, pvname in failed:
+            log.error('  ***   {:<30s} {:s}'.format(name, pvname))
+    return [name for name, pvname in failed]
+
+
+def _same(cached, value):
+    '''Compares a cached PV value to one we are about to write.
+    Strings must match exactly; numbers to within rounding.
+    '''
+    if cached is None:
+        return False
+    if isinstance(cached, str) or isinstance(value, str):
+        return isinstance(cached, str) and isinstance(value, str) and cached == value
+    try:
+        return math.isclose(float(cached), float(value), rel_tol=1e-9)
+    except (TypeError, ValueError):
+        return False
+
+
+class PVCache():
+    '''Last confirmed value of each PV we write to, keyed by PV name.
+
+    Values come from completed puts and from the PV monitors, so changes
+    made outside this program are seen too.  A PV is forgotten when it
+    disconnects; call invalidate() after an IOC restart to be sure.
+    '''
+    def __init__(self):
+        self.values = {}
+        self._watched = set()
+
+    def watch(self, pv):
+        '''Starts tracking a PV through its monitor and connection callbacks.
+        '''
+        if pv.pvname in self._watched:
+            return
+        self._watched.add(pv.pvname)
+        pv.connection_callbacks.append(self._on_connection)
+        pv.add_callback(self._on_change, run_now=True, with_ctrlvars=False)
+
+    def _on_change(self, pvname=None, value=None, char_value=None, **kw):
+        self.values[pvname] = (value, char_value)
+
+    def _on_connection(self, pvname=None, conn=None, **kw):
+        if not conn:
+            self.invalidate(pvname)
+
+    def confirm(self, pvname, value):
+        '''Records a value that a completed put has written.
+        '''
+        self.values[pvname] = (value, None)
+
+    def matches(self, pvname, value):
+        '''True if the PV is known to hold value already.
+        '''
+        return any(_same(cached, value) for cached in self.values.get(pvname, ()))
+
+    def invalidate(self, pvname=None):
+        '''Forgets one PV, or every PV if no name is given.
+        '''
+        if pvname is None:
+            self.values.clear()
+        else:
+            self.values.pop(pvname, None)
+
+
+cache = PVCache()
+
+
+class PutTransaction():
+    '''Group of PV writes that are sent together and waited on together.
+
+    Puts to different PVs are independent and go out in the same stage.
+    A second put to the same PV waits for the stage holding the first one,
+    so sequences like Internal/Overlapped/Internal keep their order.
+    barrier() makes every later put wait for everything queued so far.
+    Puts of a value the PV already holds, according to cache, are skipped
+    unless force is set; use force for PVs where the write itself is the
+    action, such as resets.
+    '''
+    def __init__(self, global_PVs, timeout=PUT_TIMEOUT, cache=cache):
+        self.global_PVs = global_PVs
+        self.timeout = timeout
+        self.cache = cache
+        self.stages = []
+        self.skipped = 0
+        self._floor = 0
+        self._last_stage = {}
+
+    def put(self, name, value, force=False):
+        '''Queues a put of value to global_PVs[name].
+        '''
+        stage = max(self._floor, self._last_stage.get(name, -1) + 1)
+        while len(self.stages) <= stage:
+            self.stages.append([])
+        self.stages[stage].append((name, value, force))
+        self._last_stage[name] = stage
+
+    def barrier(self):
+        '''Makes later puts wait for all of the puts queued so far.
+        '''
+        self._floor = len(self.stages)
+
+    def _run_stage(self, stage, deadline):
+        done = threading.Event()
+        pending = set(range(len(stage)))
+        lock = threading.Lock()
+        failed = []
+
+        def on_complete(data=None, pvname=None, confirmed=True, **kw):
+            with lock:
+                if data not in pending:
+                    return
+                pending.discard(data)
+                if confirmed and self.cache is not None:
+                    self.cache.confirm(pvname, stage[data][1])
+                if not pending:
+                    done.set()
+
+        for i, (name, value, force) in enumerate(stage):
+            try:
+                pv = self.global_PVs[name]
+                if self.cache is not None:
+                    self.cache.watch(pv)
+                    if not force and self.cache.matches(pv.pvname, value):
+                        self.skipped += 1
+                        on_complete(data=i, confirmed=False)
+                        continue
+                if pv.put(value, callback=on_complete, callback_data=i) is None:
+                    failed.append((name, value, 'not connected'))
+                    on_complete(data=i, confirmed=False)
+            except Exception as ee:
+                failed.append((name, value, str(ee)))
+                on_complete(data=i, confirmed=False)
+        if not done.wait(max(deadline - time.time(), 0.)):
+            with lock:
+                failed.extend((stage[i][0], stage[i][1], 'timed out') for i in sorted(pending))
+                pending.clear()
+        return failed
+
+    def commit(self):
+        '''Sends all queued puts, stage by stage, and waits for completion.
+        Logs the writes that failed or timed out and returns them as a list
+        of (name, value, reason).
+        '''
+        deadline = time.time() + self.timeout
+        failed = []
+        for stage in self.stages:
+            failed.extend(self._run_stage(stage, deadline))
+        self.stages = []
+        self._floor = 0
+        self._last_stage = {}
+        for name, value, reason in failed:
+            log.error('  *** put {:s} = {:s} failed: {:s}'.format(name, str(value), reason))
+        return failed
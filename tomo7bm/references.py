@@ -0,0 +1,133 @@
+'''
+    Flats and darks for series of scans.
+
+    In a vertical or mosaic series, or repeated scans, the beam and detector
+    often do not change from one scan to the next.  ReferencePolicy decides
+    which scans take their own flats and darks; the others get the last set,
+    copied into their file or as an HDF external link to it.
+'''
+import os
+
+import h5py
+import numpy as np
+
+from tomo7bm import log
+
+REFERENCE_DATASETS = ('/exchange/data_white', '/exchange/data_dark')
+REFERENCE_FILE = '/process/acquisition/flat_dark_file'
+
+# Pixel stride for mean intensities
+STRIDE = 8
+
+
+def mean_intensity(frames):
+    '''Mean of every STRIDE-th pixel of an image, a stack of images or an
+    HDF dataset of them.  None if there are no frames.
+    '''
+    if frames.shape[0] == 0:
+        return None
+    return float(np.mean(frames[..., ::STRIDE, ::STRIDE]))
+
+
+class ReferencePolicy():
+    '''Keeps track of the last set of flats and darks in a series and
+    decides whether the next scan needs new ones.
+
+    file_name is the file holding the last set, taken at time, with mean
+    flat and dark intensities white and dark; num_scans counts the scans
+    since, including the one that took it.
+    '''
+    def __init__(self, params):
+        self.policy = params.flat_dark_policy
+        self.every = int(params.flat_dark_every)
+        self.interval = 60.0 * float(params.flat_dark_minutes)
+        self.threshold = float(params.flat_drift_threshold)
+        self.reuse = params.flat_dark_reuse
+        self.file_name = None
+        self.time = None
+        self.white = None
+        self.dark = 0.0
+        self.num_scans = 0
+
+    def needs_check(self):
+        '''Whether due() needs the intensity of a flat taken now.
+        '''
+        return self.policy == 'drift' and self.file_name is not None
+
+    def drift(self, intensity):
+        '''Relative change of the dark-corrected flat intensity since the last set.
+        '''
+        if intensity is None or self.white is None or self.white == self.dark:
+            return np.inf
+        return abs((intensity - self.dark) / (self.white - self.dark) - 1.0)
+
+    def due(self, now, intensity=None):
+        '''Whether the scan starting at time now takes flats and darks.
+        '''
+        if self.file_name is None or self.policy == 'every':
+            return True
+        if self.policy == 'once':
+            return False
+        if self.policy == 'every-n':
+            return self.num_scans >= self.every
+        if self.policy == 'every-minutes':
+            return now - self.time >= self.interval
+        drift = self.drift(intensity)
+        log.info('  *** *** Flat intensity drift {:6.2%} (threshold {:6.2%})'.format(drift, self.threshold))
+        return drift > self.threshold
+
+    def taken(self, file_name, now, white=None, dark=None):
+        '''Records a new set of flats and darks in file_name.
+        '''
+        self.file_name = file_name
+        self.time = now
+        self.white = white
+        self.dark = dark or 0.0
+        self.num_scans = 1
+
+    def skipped(self):
+        self.num_scans += 1
+
+    def update(self, file_name, acquired, now):
+        '''Records the scan started at time now into file_name, with its own
+        flats and darks if acquired.  Returns the file its flats and darks
+        are in, for finish().
+        '''
+        if acquired:
+            self.taken(file_name, now)
+        else:
+            self.skipped()
+        return self.file_name
+
+    def finish(self, file_name, source):
+        '''Once file_name has closed: reads the intensities of its flats and
+        darks if it has its own, that is if source is file_name; otherwise
+        gives it those of source.
+        '''
+        with h5py.File(file_name, mode='a') as hdf_f:
+            if source == file_name:
+                if self.file_name == file_name:
+                    self.white = mean_intensity(hdf_f['/exchange/data_white'])
+                    self.dark = mean_intensity(hdf_f['/exchange/data_dark']) or 0.0
+                return
+            reuse(hdf_f, source, self.reuse)
+        log.info('  *** Flats and darks from %s (%s)' % (source, self.reuse))
+
+
+def reuse(hdf_f, source, mode='copy'):
+    '''Replaces the empty flats and darks of the open file hdf_f with those
+    of the file source: copies them, or for mode 'link' adds HDF external
+    links to them.  Links name source without its directory, so they hold
+    as long as both files are kept side by side.
+    '''
+    for name in REFERENCE_DATASETS:
+        if name in hdf_f:
+            del hdf_f[name]
+    if mode == 'link':
+        for name in REFERENCE_DATASETS:
+            hdf_f[name] = h5py.ExternalLink(os.path.basename(source), name)
+    else:
+        with h5py.File(source, mode='r') as source_f:
+            for name in REFERENCE_DATASETS:
+                hdf_f.copy(source_f[name], name)
+    hdf_f.create_dataset(REFERENCE_FILE, data=os.path.basename(source))
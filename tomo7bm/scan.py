@@ -3,6 +3,8 @@
     
 '''
 import sys
+import copy
+import math
 import time
 import signal
 import numpy as np
@@ -13,6 +15,13 @@ from tomo7bm import flir
 from tomo7bm import aps7bm
 from tomo7bm import config
 from tomo7bm import pso
+from tomo7bm import pvs
+from tomo7bm import mosaic
+from tomo7bm import estimate
+from tomo7bm import references
+from tomo7bm import pipeline
+from tomo7bm import checkpoint
+from tomo7bm import throughput
 
 global_PVs = {}
 
@@ -38,30 +47,42 @@ def fly_scan(params):
             return False
         # Set the slew speed, possibly based on blur and acquisition parameters
         set_slew_speed(global_PVs, params)
+        choose_projections(global_PVs, params)
         # init camera
         flir.init(global_PVs, params)
 
+        if params.continuous or params.interlace != 'none':
+            set_file_name(global_PVs, params)
+            tomo_continuous_scan(global_PVs, params, int(params.sleep_steps))
+            log.info(' ')
+            log.info('  *** Data file: %s' % global_PVs['HDF1_FullFileName_RBV'].get(as_string=True))
+            log.info('  *** Total scan time: %s minutes' % str((time.time() - tic)/60.))
+            global_PVs['Cam1_ImageMode'].put('Continuous')
+            log.info('  *** Done!')
+            return
         log.info(' ')
         log.info("  *** Running %d sleep scans" % params.sleep_steps)
+        refs = references.ReferencePolicy(params)
         for i in np.arange(params.sleep_steps):
             tic_01 =  time.time()
-            # set sample file name
-            params.file_path = global_PVs['HDF1_FilePath'].get(as_string=True)
-            params.file_name = str('{:03}'.format(global_PVs['HDF1_FileNumber'].get())) + '_' + global_PVs['Sample_Name'].get(as_string=True)
             log.info(' ')
             log.info('  *** Start scan {:d} of {:d}'.format(int(i+1), int(params.sleep_steps)))
-            tomo_fly_scan(global_PVs, params)
+            # Zig-zag scans run every other scan backwards and skip the retrace
+            last_scan = (i+1) == params.sleep_steps
+            file_name = tomo_fly_scan(global_PVs, params, reverse=params.zigzag and i % 2 == 1,
+                                        retrace=last_scan or not params.zigzag, refs=refs)
             if ((i+1)!= params.sleep_steps):
                 log.warning('  *** Wait (s): %s ' % str(params.sleep_time))
                 time.sleep(params.sleep_time) 
 
             log.info(' ')
-            log.info('  *** Data file: %s' % global_PVs['HDF1_FullFileName_RBV'].get(as_string=True))
+            log.info('  *** Data file: %s' % file_name)
             log.info('  *** Total scan time: %s minutes' % str((time.time() - tic_01)/60.))
             log.info('  *** Scan Done!')
 
             #dm.scp(global_PVs, params)
 
+        pipeline.finalizer.wait_finished()
         log.info('  *** Total loop scan time: %s minutes' % str((time.time() - tic)/60.))
         global_PVs['Cam1_ImageMode'].put('Continuous')
         log.info('  *** Done!')
@@ -76,7 +97,7 @@ def fly_scan_vertical(params):
 
     tic =  time.time()
     # aps7bm.update_variable_dict(params)
-    global_PVsx = aps7bm.init_general_PVs(global_PVs, params)
+    global_PVs = aps7bm.init_general_PVs(params)
     try: 
         detector_sn = global_PVs['Cam1_SerialNumber'].get()
         if ((detector_sn == None) or (detector_sn == 'Unknown')):
@@ -88,9 +109,8 @@ def fly_scan_vertical(params):
             
             # calling global_PVs['Cam1_AcquireTime'] to replace the default 'ExposureTime' with the one set in the camera
             params.exposure_time = global_PVs['Cam1_AcquireTime'].get()
-            # calling calc_blur_pixel() to replace the default 'SlewSpeed' 
-            blur_pixel, rot_speed, scan_time = calc_blur_pixel(global_PVs, params)
-            params.slew_speed = rot_speed
+            # Set the slew speed, possibly based on blur and acquisition parameters
+            set_slew_speed(global_PVs, params)
 
             start_y = params.vertical_scan_start
             end_y = params.vertical_scan_end
@@ -103,38 +123,44 @@ def fly_scan_vertical(params):
             log.info("  *** Running %d scans" % params.sleep_steps)
             log.info(' ')
             log.info('  *** Vertical Positions (mm): %s' % np.arange(start_y, end_y, step_size_y))
+            refs = references.ReferencePolicy(params)
+            positions = np.arange(start_y, end_y, step_size_y)
+            tasks = [checkpoint.task(len(positions) * ii + v, ii, v, 0, float(y))
+                        for ii in range(int(params.sleep_steps)) for v, y in enumerate(positions)]
+            series = checkpoint.start_series(global_PVs, params, 'vertical', tasks)
 
             for ii in np.arange(0, params.sleep_steps, 1):
+                pending = series.pending(ii)
+                if not pending:
+                    continue
                 log.info(' ')
                 log.info('  *** Start scan %d' % ii)
-                for i in np.arange(start_y, end_y, step_size_y):
+                for task in pending:
                     tic_01 =  time.time()
-                    # set sample file name
-                    params.file_path = global_PVs['HDF1_FilePath'].get(as_string=True)
-                    params.file_name = str('{:03}'.format(global_PVs['HDF1_FileNumber'].get())) + '_' + global_PVs['Sample_Name'].get(as_string=True)
-
                     log.info(' ')
-                    log.info('  *** The sample vertical position is at %s mm' % (i))
-                    global_PVs['Motor_SampleY'].put(i, wait=True, timeout=1000.0)
-                    tomo_fly_scan(global_PVs, params)
+                    log.info('  *** The sample vertical position is at %s mm' % (task['y']))
+                    global_PVs['Motor_SampleY'].move(task['y'], wait=True)
+                    file_name = tomo_fly_scan(global_PVs, params, refs=refs)
+                    pipeline.finalizer.submit(series.finished, task, file_name)
 
                     log.info(' ')
-                    log.info('  *** Data file: %s' % global_PVs['HDF1_FullFileName_RBV'].get(as_string=True))
+                    log.info('  *** Data file: %s' % file_name)
                     log.info('  *** Total scan time: %s minutes' % str((time.time() - tic_01)/60.))
                     log.info('  *** Scan Done!')
         
-                    dm.scp(global_PVs, params)
+                    pipeline.finalizer.submit(dm.scp, global_PVs, params, file_name)
 
                 log.info('  *** Moving vertical stage to start position')
-                global_PVs['Motor_SampleY'].put(start_y, wait=True, timeout=1000.0)
+                global_PVs['Motor_SampleY'].move(start_y, wait=True)
 
                 if ((ii+1)!=params.sleep_steps):
                     log.warning('  *** Wait (s): %s ' % str(params.sleep_time))
                     time.sleep(params.sleep_time) 
 
+            pipeline.finalizer.wait_finished()
             log.info('  *** Total loop scan time: %s minutes' % str((time.time() - tic)/60.))
             log.info('  *** Moving rotary stage to start position')
-            global_PVs["Motor_SampleRot"].put(0, wait=True, timeout=600.0)
+            global_PVs["Motor_SampleRot"].move(0, wait=True)
             log.info('  *** Moving rotary stage to start position: Done!')
 
             global_PVs['Cam1_ImageMode'].put('Continuous')
@@ -144,13 +170,17 @@ def fly_scan_vertical(params):
     except  KeyError:
         log.error('  *** Some PV assignment failed!')
         pass
+    except Exception as ee:
+        stop_scan(global_PVs, params)
+        log.error('  Exception recorded: ' + str(ee))
+        raise
 
 
 def fly_scan_mosaic(params):
 
     tic =  time.time()
     # aps7bm.update_variable_dict(params)
-    global_PVsx = aps7bm.init_general_PVs(global_PVs, params)
+    global_PVs = aps7bm.init_general_PVs(params)
     try: 
         detector_sn = global_PVs['Cam1_SerialNumber'].get()
         if ((detector_sn == None) or (detector_sn == 'Unknown')):
@@ -162,73 +192,62 @@ def fly_scan_mosaic(params):
             
             # calling global_PVs['Cam1_AcquireTime'] to replace the default 'ExposureTime' with the one set in the camera
             params.exposure_time = global_PVs['Cam1_AcquireTime'].get()
-            # calling calc_blur_pixel() to replace the default 'SlewSpeed' 
-            blur_pixel, rot_speed, scan_time = calc_blur_pixel(global_PVs, params)
-            params.slew_speed = rot_speed
+            # Set the slew speed, possibly based on blur and acquisition parameters
+            set_slew_speed(global_PVs, params)
 
             start_y = params.vertical_scan_start
-            end_y = params.vertical_scan_end
-            step_size_y = params.vertical_scan_step_size
-
-
             start_x = params.horizontal_scan_start
-            end_x = params.horizontal_scan_end
-            step_size_x = params.horizontal_scan_step_size
-
-            # set scan stop so also ends are included
-            stop_x = end_x + step_size_x
-            stop_y = end_y + step_size_y
 
             # init camera
             flir.init(global_PVs, params)
 
             log.info(' ')
+            tiles = mosaic.plan_tiles(params, estimate.stage_dynamics(params, global_PVs), params.mosaic_order)
+            refs = references.ReferencePolicy(params)
+            tasks = [checkpoint.task(len(tiles) * ii + i, ii, tile.v, tile.h, tile.y, tile.x,
+                                     '_y' + str(tile.v) + '_x' + str(tile.h))
+                        for ii in range(int(params.sleep_steps)) for i, tile in enumerate(tiles)]
+            series = checkpoint.start_series(global_PVs, params, 'mosaic', tasks)
             log.info("  *** Running %d sleep scans" % params.sleep_steps)
             for ii in np.arange(0, params.sleep_steps, 1):
+                pending = series.pending(ii)
+                if not pending:
+                    continue
                 tic_01 =  time.time()
 
                 log.info(' ')
-                log.info("  *** Running %d mosaic scans" % (len(np.arange(start_x, stop_x, step_size_x)) * len(np.arange(start_y, stop_y, step_size_y))))
+                log.info("  *** Running %d mosaic scans" % len(pending))
                 log.info(' ')
-                log.info('  *** Horizontal Positions (mm): %s' % np.arange(start_x, stop_x, step_size_x))
-                log.info('  *** Vertical Positions (mm): %s' % np.arange(start_y, stop_y, step_size_y))
+                log.info('  *** (y, x) positions (mm): %s' % ' '.join('(%s, %s)' % (task['y'], task['x']) for task in pending))
 
-                h = 0
-                v = 0
-                
-                for i in np.arange(start_y, stop_y, step_size_y):
+                for task in pending:
                     log.info(' ')
-                    log.error('  *** The sample vertical position is at %s mm' % (i))
-                    global_PVs['Motor_SampleY'].put(i, wait=True)
-                    for j in np.arange(start_x, stop_x, step_size_x):
-                        log.error('  *** The sample horizontal position is at %s mm' % (j))
-                        params.sample_in_position = j
-                        # set sample file name
-                        params.file_path = global_PVs['HDF1_FilePath'].get(as_string=True)
-                        params.file_name = str('{:03}'.format(global_PVs['HDF1_FileNumber'].get())) + '_' + global_PVs['Sample_Name'].get(as_string=True) + '_y' + str(v) + '_x' + str(h)
-                        tomo_fly_scan(global_PVs, params)
-                        h = h + 1
-                        dm.scp(global_PVs, params)
+                    log.error('  *** The sample position is at (x, y) = (%s, %s) mm' % (task['x'], task['y']))
+                    failed = pvs.move_motors(global_PVs, {'Motor_SampleX': task['x'], 'Motor_SampleY': task['y']})
+                    if failed:
+                        # The tile stays pending for --resume
+                        raise RuntimeError('move to tile %s failed: %s' % (task['suffix'], ', '.join(failed)))
+                    file_name = tomo_fly_scan(global_PVs, params, refs=refs, file_suffix=task['suffix'])
+                    pipeline.finalizer.submit(series.finished, task, file_name)
+                    pipeline.finalizer.submit(dm.scp, global_PVs, params, file_name)
                     log.info(' ')
                     log.info('  *** Total scan time: %s minutes' % str((time.time() - tic)/60.))
-                    log.info('  *** Data file: %s' % global_PVs['HDF1_FullFileName_RBV'].get(as_string=True))
-                    v = v + 1
-                    h = 0
+                    log.info('  *** Data file: %s' % file_name)
 
-                log.info('  *** Moving vertical stage to start position')
-                global_PVs['Motor_SampleY'].put(start_y, wait=True, timeout=1000.0)
-
-                log.info('  *** Moving horizontal stage to start position')
-                global_PVs['Motor_SampleX'].put(start_x, wait=True, timeout=1000.0)
+                log.info('  *** Moving sample stages to start position')
+                failed = pvs.move_motors(global_PVs, {'Motor_SampleX': start_x, 'Motor_SampleY': start_y})
+                if failed:
+                    raise RuntimeError('move to the start position failed: %s' % ', '.join(failed))
 
                 log.info('  *** Moving rotary stage to start position')
-                global_PVs["Motor_SampleRot"].put(0, wait=True, timeout=600.0)
+                global_PVs["Motor_SampleRot"].move(0, wait=True)
                 log.info('  *** Moving rotary stage to start position: Done!')
 
                 if ((ii+1)!=params.sleep_steps):
                     log.warning('  *** Wait (s): %s ' % str(params.sleep_time))
                     time.sleep(params.sleep_time) 
 
+                pipeline.finalizer.wait_finished()
                 global_PVs['Cam1_ImageMode'].put('Continuous')
 
                 log.info('  *** Done!')
@@ -236,32 +255,48 @@ def fly_scan_mosaic(params):
     except  KeyError:
         log.error('  *** Some PV assignment failed!')
         pass
+    except Exception as ee:
+        stop_scan(global_PVs, params)
+        log.error('  Exception recorded: ' + str(ee))
+        raise
 
 
 def dummy_scan(params):
     tic =  time.time()
     # aps7bm.update_variable_dict(params)
-    global_PVs = aps7bm.init_general_PVs(global_PVs, params)
+    global_PVs = aps7bm.init_general_PVs(params)
     try: 
-        detector_sn = global_PVs['Cam1_SerialNumber'].get()
-        if ((detector_sn == None) or (detector_sn == 'Unknown')):
-            log.info('*** The Point Grey Camera with EPICS IOC prefix %s is down' % params.camera_ioc_prefix)
-            log.info('  *** Failed!')
-        else:
-            log.info('*** The Point Grey Camera with EPICS IOC prefix %s and serial number %s is on' \
-                        % (params.camera_ioc_prefix, detector_sn))
+        check_camera_IOC(global_PVs, params)
     except  KeyError:
         log.error('  *** Some PV assignment failed!')
         pass
 
 
+def set_file_name(global_PVs, params, suffix=''):
+    '''Names the next file from the HDF file number and the sample name.
+    Closing a file advances the file number, so this waits for the last one.
+    '''
+    pipeline.finalizer.wait_closed()
+    params.file_path = global_PVs['HDF1_FilePath'].get(as_string=True)
+    params.file_name = str('{:03}'.format(global_PVs['HDF1_FileNumber'].get())) + '_' + global_PVs['Sample_Name'].get(as_string=True) + suffix
+
+
 def set_image_factor(global_PVs, params):
     if (params.recursive_filter == False):
         params.recursive_filter_n_images = 1 
     return params.recursive_filter_n_images
 
    
-def tomo_fly_scan(global_PVs, params):
+def tomo_fly_scan(global_PVs, params, reverse=False, retrace=True, refs=None, file_suffix=''):
+    '''Collects flats, darks and one fly scan into an HDF file.
+    reverse runs the rotation from the end angle back to the start;
+    retrace moves the stage back to the start angle afterwards.
+    refs is the references.ReferencePolicy of a series of scans; when it
+    says the flats and darks are not due, the file gets the last set.
+    The file is named by set_file_name() with file_suffix.  Returns its
+    full name as soon as the rotation is done; the file is finished by
+    pipeline.finalizer, see pipeline.
+    '''
     log.info(' ')
     log.info('  *** start_scan')
     #Set things up so Ctrl+C will cause scan to clean up.
@@ -270,12 +305,120 @@ def tomo_fly_scan(global_PVs, params):
         sys.exit(0)
     signal.signal(signal.SIGINT, cleanup)
     set_image_factor(global_PVs, params)
-    pso.pso_init(params)
-    pso.program_PSO()
+    start_time = time.time()
+    take_references = references_due(global_PVs, params, refs, start_time)
+    plan = pso.pso_init(params, reverse)
+    pso.program_PSO(plan)
+    log.info('  *** *** PSO programming DONE!')
+    set_file_name(global_PVs, params, file_suffix)
+    log.info('  *** File name prefix: %s' % params.file_name)
+    if take_references:
+        flir.set(global_PVs, params)
+        acquire_flat_and_dark(global_PVs, params)
+    else:
+        flir.set(global_PVs, params, int(params.num_projections))
+    aps7bm.open_shutters(global_PVs, params)
+    monitor = flir.acquire(global_PVs, params, plan)
+    file_name = global_PVs['HDF1_FullFileName_RBV'].get(as_string=True)
+    aps7bm.close_shutters(global_PVs, params)
+    time.sleep(0.5)
+
+    # If requested, move rotation stage back to zero
+    pso.cleanup_PSO()
+    if retrace:
+        pso.driver.motor.move(plan.req_end if reverse else plan.req_start, wait=False)
+
+    # Finish the file in the background; the next scan arms the HDF writer once it has closed
+    pipeline.finalizer.submit_close(flir.checkclose_hdf, global_PVs, params)
+    pipeline.finalizer.submit_check(flir.add_theta, global_PVs, params, plan.proj_positions, monitor, None, file_name)
+    if refs is not None:
+        source = refs.update(file_name, take_references, start_time)
+        pipeline.finalizer.submit(refs.finish, file_name, source)
+    # update config file, as it was for this scan
+    pipeline.finalizer.submit(config.update_config, config_params(params))
+    return file_name
+
+
+def tomo_continuous_scan(global_PVs, params, num_segments):
+    '''Collects num_segments back-to-back scans in one continuous rotation.
+    The PSO is programmed once and all segments go into one HDF file, with
+    flats and darks only before and after the series.  Each frame gets its
+    angle in /exchange/theta and its segment number in /exchange/segment.
+    With params.interlace, every turn is a sub-scan shifted from the one
+    before, and the segment number is the turn the frame was taken in.
+    '''
+    log.info(' ')
+    log.info('  *** start continuous scan of %d segments' % num_segments)
+    #Set things up so Ctrl+C will cause scan to clean up.
+    def cleanup(signal, frame):
+        stop_scan(global_PVs, params)
+        sys.exit(0)
+    signal.signal(signal.SIGINT, cleanup)
+    if params.sleep_time:
+        log.warning('  *** Continuous scan ignores sleep time %s s' % str(params.sleep_time))
+    set_image_factor(global_PVs, params)
+    plan = pso.pso_init(params, num_segments=num_segments)
+    pso.program_PSO(plan)
     log.info('  *** *** PSO programming DONE!')
     log.info('  *** File name prefix: %s' % params.file_name)
-    flir.set(global_PVs, params) 
+    num_frames = plan.num_proj + 2 * (int(params.num_dark_images) + int(params.num_white_images))
+    flir.set(global_PVs, params, num_frames)
 
+    acquire_flat_and_dark(global_PVs, params)
+    aps7bm.open_shutters(global_PVs, params)
+    monitor = flir.acquire(global_PVs, params, plan)
+    aps7bm.close_shutters(global_PVs, params)
+    acquire_flat_and_dark(global_PVs, params)
+    flir.checkclose_hdf(global_PVs, params)
+    if params.interlace == 'none':
+        segments = np.arange(plan.num_proj) // int(params.num_projections)
+    else:
+        segments = pso.subscan_index(plan, params.sample_rotation_end - params.sample_rotation_start)
+    flir.add_theta(global_PVs, params, plan.proj_positions, monitor, segments)
+
+    pso.cleanup_PSO()
+    pso.driver.motor.move(plan.req_start, wait=False)
+    config.update_config(config_params(params))
+
+
+def config_params(params):
+    '''Returns a copy of params to save in the config file, with the
+    projection count and end angle asked for rather than those
+    choose_projections() scanned with.
+    '''
+    saved = copy.copy(params)
+    if hasattr(params, 'requested_projections'):
+        saved.num_projections, saved.sample_rotation_end = params.requested_projections
+    return saved
+
+
+def references_due(global_PVs, params, refs, now):
+    '''Whether a scan starting at time now takes its own flats and darks
+    under the policy refs; always without one.  For the drift policy this
+    takes one flat to compare with the last set.
+    '''
+    if refs is None:
+        return True
+    intensity = None
+    if refs.needs_check():
+        # Needs the intensities of the last set
+        pipeline.finalizer.wait_finished()
+        log.info('  *** Check the flat intensity')
+        move_sample_out(global_PVs, params)
+        aps7bm.open_shutters(global_PVs, params)
+        intensity = references.mean_intensity(flir.take_flat(global_PVs, params))
+        aps7bm.close_shutters(global_PVs, params)
+        move_sample_in(global_PVs, params)
+    due = refs.due(now, intensity)
+    if not due:
+        log.info('  *** Skip flats and darks (%s policy)' % refs.policy)
+    return due
+
+
+def acquire_flat_and_dark(global_PVs, params):
+    '''Takes flats with the sample out, then darks, and moves the sample
+    back in.  Leaves the shutters closed.
+    '''
     move_sample_out(global_PVs, params)
     aps7bm.open_shutters(global_PVs, params)
     flir.acquire_flat(global_PVs, params)
@@ -283,18 +426,17 @@ def tomo_fly_scan(global_PVs, params):
     time.sleep(0.5)
     flir.acquire_dark(global_PVs, params)
     move_sample_in(global_PVs, params)
-    aps7bm.open_shutters(global_PVs, params)
-    theta = flir.acquire(global_PVs, params)
-    aps7bm.close_shutters(global_PVs, params)
-    time.sleep(0.5)
-    flir.checkclose_hdf(global_PVs, params)
-    flir.add_theta(global_PVs, params)
 
-    # If requested, move rotation stage back to zero
-    pso.cleanup_PSO()
-    pso.driver.motor.move(pso.req_start, wait=False)
-    # update config file
-    config.update_config(params)
+
+def image_half_width(global_PVs):
+    '''Returns the distance (pixels) from the rotation axis to the farthest
+    edge of the image, assuming SampleX is at zero when the rotation axis
+    is centered.
+    '''
+    overall_res = float(global_PVs['PixelSizeMicrons'].get()) / float(global_PVs['Lens_Magnification'].get())
+    rot_axis_offset = abs(global_PVs['Motor_SampleX'].drive * 1e3 / overall_res)
+    log.info('  *** *** rotation axis offset {0:f} pixels'.format(rot_axis_offset))
+    return global_PVs['Cam1_SizeX'].get() / 2.0 + rot_axis_offset
 
 
 def set_slew_speed(global_PVs, params):
@@ -306,50 +448,47 @@ def set_slew_speed(global_PVs, params):
     * Base on acquisition parameters (data throughput and exposure).
         Show how much blur this is.
     * Base on both blur and data throughput.
+    Data throughput is the camera link and disk write rates measured by
+    throughput.max_framerates(); pso.frame_rate_limits() has the limits.
     '''
     log.info('  *** Calculate slew speed and blur')
-    scan_range = abs(params.sample_rotation_start - params.sample_rotation_end)
     set_image_factor(global_PVs, params)
-    delta_angle = scan_range / (params.num_projections - 1) / params.recursive_filter_n_images 
-    data_max_framerate = flir.calc_max_framerate(global_PVs, params)
-    acq_max_framerate = 1.0 / (params.exposure_time + params.ccd_readout)
-    #Compute the distance from the rotation axis to the farthest edge of the image
-    #Assume SampleX motor is at zero when rotation axis is centered
-    overall_res = float(global_PVs['PixelSizeMicrons'].get()) / float(global_PVs['Lens_Magnification'].get())
-    rot_axis_offset = abs(global_PVs['Motor_SampleX'].drive * 1e3 / overall_res)
-    log.info('  *** *** rotation axis offset {0:f} pixels'.format(rot_axis_offset))
-    im_half_width = global_PVs['Cam1_SizeX'].get() / 2.0 + rot_axis_offset
-    blur_max_framerate = 1e6
+    camera_max_framerate, disk_max_framerate = throughput.max_framerates(global_PVs, params)
+    im_half_width = image_half_width(global_PVs)
+    delta_angle, limits = pso.frame_rate_limits(params, im_half_width, camera_max_framerate, disk_max_framerate)
 
     if params.auto_slew_speed == 'manual':
         log.info('  *** *** Using manual slew speed')
         req_framerate = params.slew_speed / delta_angle
         log.info('  *** *** Requested framerate is {:6.3} Hz'.format(req_framerate))
-        if acq_max_framerate < req_framerate:
+        if limits['acquisition time'] < req_framerate:
             log.warning('  *** *** Requested framerate too fast for exposure time given.')
             log.warning('  *** *** You will miss frames!')
-        if data_max_framerate < req_framerate:
-            log.warning('  *** *** Requested framerate too fast for data transfer.')
+        if camera_max_framerate < req_framerate:
+            log.warning('  *** *** Requested framerate too fast for the camera link.')
             log.warning('  *** *** You will miss frames!')
-        return finish_set_slew_speed(global_PVs, params)
-    elif params.auto_slew_speed == 'acqusition':
+        if disk_max_framerate < req_framerate:
+            log.warning('  *** *** Requested framerate too fast for the disk to keep up.')
+            log.warning('  *** *** You will miss frames!')
+        return finish_set_slew_speed(global_PVs, params, delta_angle, im_half_width)
+    elif params.auto_slew_speed == 'acquisition':
         log.info('  *** *** Calc slew speed from data throughput and exposure limits.')
     elif params.recursive_filter_n_images > 1:
         log.warning('  *** *** Blur calculation makes less sense with averaging in each projection.')
     else:
         log.info('  *** *** Calc slew speed based on blur and acquisition parameters.')
-        max_blur_angle = np.degrees(np.arcsin(params.permitted_blur / im_half_width))
-        blur_max_framerate = max_blur_angle /  (params.exposure_time) / delta_angle
-    framerates = np.array([data_max_framerate, acq_max_framerate, blur_max_framerate])
-    params.slew_speed = np.min(framerates) * delta_angle
-    log.info('  *** *** Max framerate for data transfer is {:6.3f} Hz'.format(data_max_framerate))
-    log.info('  *** *** Max framerate for exposure time is {:6.3f} Hz'.format(acq_max_framerate))
-    if blur_max_framerate == np.min(framerates):
-        log.info('  *** *** Limited by blur to {:6.3f} Hz'.format(blur_max_framerate))
-    elif data_max_framerate == np.min(framerates):
-        log.info('  *** *** Limited by data throughput to {:6.3f} Hz'.format(data_max_framerate))
-    else:
-        log.info('  *** *** Limited by acquisition time to {:6.3f} Hz'.format(acq_max_framerate))
+    limit = min(limits, key=limits.get)
+    params.slew_speed = limits[limit] * delta_angle
+    log.info('  *** *** Max framerate for camera link is {:6.3f} Hz'.format(camera_max_framerate))
+    log.info('  *** *** Max framerate for disk write rate is {:6.3f} Hz'.format(disk_max_framerate))
+    log.info('  *** *** Max framerate for exposure time is {:6.3f} Hz'.format(limits['acquisition time']))
+    log.info('  *** *** Limited by {:s} to {:6.3f} Hz'.format(limit, limits[limit]))
+    return finish_set_slew_speed(global_PVs, params, delta_angle, im_half_width)
+
+
+def finish_set_slew_speed(global_PVs, params, delta_angle, im_half_width):
+    '''Logs the motion blur at params.slew_speed and sets the rotation speed.
+    '''
     blur = np.sin(np.radians(params.slew_speed * params.exposure_time)) * im_half_width 
     if params.recursive_filter_n_images > 1:
         blur = np.sin(np.radians(delta_angle)) * im_half_width    
@@ -362,6 +501,69 @@ def set_slew_speed(global_PVs, params):
     return params.slew_speed
 
 
+def choose_projections(global_PVs, params):
+    '''Looks for projection counts near params.num_projections whose PSO
+    spacing is a whole number of encoder counts, and logs the best ones.
+    With params.auto_projections, switches to the best one, keeping the
+    frame rate, so the scan covers exactly the range it reports.
+    '''
+    if not params.projection_window:
+        return
+    if params.interlace != 'none':
+        log.info('  *** *** Interlaced scans have no exact spacing to look for')
+        return
+    log.info('  *** Look for an integral PSO spacing')
+    scan_range = params.sample_rotation_end - params.sample_rotation_start
+    num_images = set_image_factor(global_PVs, params)
+    closed = not params.continuous
+    intervals = (params.num_projections - (1 if closed else 0)) * num_images
+    frame_rate = params.slew_speed * intervals / abs(scan_range)
+    encoder_multiply = pso.init_driver().encoder_multiply
+    options = pso.solve_spacing(scan_range, int(params.num_projections), int(params.projection_window),
+                                encoder_multiply, frame_rate, num_images, params.scan_time_budget, closed)
+    if not options:
+        log.warning('  *** *** No projection count fits in the time budget')
+        return
+    log.info('  *** *** {:>6s} {:>8s} {:>12s} {:>10s} {:>8s}'.format(
+                'proj', 'counts', 'range (deg)', 'error', 'time (s)'))
+    for option in options:
+        log.info('  *** *** {:6d} {:8d} {:12.6f} {:10.6f} {:8.2f}'.format(*option))
+    if not params.auto_projections:
+        return
+    best = options[0]
+    # Scan with the solved values, but keep the requested ones for the config file
+    params.requested_projections = (params.num_projections, params.sample_rotation_end)
+    params.num_projections = best.num_proj
+    params.sample_rotation_end = params.sample_rotation_start + math.copysign(best.scan_range, scan_range)
+    params.slew_speed = frame_rate * best.delta_encoder_counts / encoder_multiply
+    log.info('  *** *** Using {:d} projections over {:f} deg at {:6.3f} deg/s'.format(
+                best.num_proj, best.scan_range, params.slew_speed))
+    global_PVs['Sample_Rotation_Speed'].put(params.slew_speed, wait=True)
+
+
+# Time allowed for the sample (and furnace) moves for flats and darks
+SAMPLE_MOVE_TIMEOUT = 10
+
+
+def furnace_targets(global_PVs, params, position):
+    '''The furnace moves out of the beam with the sample for the flats
+    when it is in use and the sample moves horizontally.  Returns
+    {motor name: position} for it, empty if it stays.
+    '''
+    if not params.use_furnace or params.white_field_motion != 'horizontal':
+        return {}
+    try:
+        global_PVs['Motor_FurnaceY']
+    except KeyError:
+        log.warning('        *** *** No furnace motor at this station')
+        return {}
+    return {'Motor_FurnaceY': position}
+
+
+def within_limits(global_PVs, targets):
+    return all(global_PVs[name].within_limits(position) for name, position in targets.items())
+
+
 def move_sample_out(global_PVs, params):
 
     log.info('      *** Sample out')
@@ -376,21 +578,19 @@ def move_sample_out(global_PVs, params):
         out_x = params.sample_out_x
         out_y = params.sample_out_y
         log.info('      *** Moving to (x,y) = ({0:6.4f}, {1:6.4f})'.format(out_x, out_y))
-        if not (global_PVs['Motor_SampleX'].within_limits(out_x)
-               and global_PVs['Motor_SampleY'].within_limits(out_y)):
+        targets = {'Motor_SampleX': out_x, 'Motor_SampleY': out_y}
+        targets.update(furnace_targets(global_PVs, params, params.furnace_out_position))
+        if not within_limits(global_PVs, targets):
             log.error('        *** *** Sample out position past motor limits.')
             return
-        global_PVs['Motor_SampleX'].move(out_x, wait=True, timeout=10)
-        global_PVs['Motor_SampleY'].move(out_y, wait=True, timeout=10)
-        #Check if we ever got there
-        time.sleep(0.2)
-        if (abs(global_PVs['Motor_SampleX'].readback - out_x) > 1e-3 
-            or abs(global_PVs['Motor_SampleY'].readback - out_y) > 1e-3):
+        #Move all axes together and check if we ever got there
+        if pvs.move_motors(global_PVs, targets, SAMPLE_MOVE_TIMEOUT):
             log.error('        *** *** Sample out motion failed!')
     except Exception as ee:
         log.error('EXCEPTION DURING SAMPLE OUT MOTION!')
-        global_PVs['Motor_SampleX'].move(params.original_x, wait=True, timeout=10)
-        global_PVs['Motor_SampleY'].move(params.original_y, wait=True, timeout=10)
+        targets = {'Motor_SampleX': params.original_x, 'Motor_SampleY': params.original_y}
+        targets.update(furnace_targets(global_PVs, params, params.furnace_in_position))
+        pvs.move_motors(global_PVs, targets, SAMPLE_MOVE_TIMEOUT)
         raise ee
 
 def move_sample_in(global_PVs, params):
@@ -408,16 +608,14 @@ def move_sample_in(global_PVs, params):
             params.original_y = global_PVs['Motor_SampleY'].drive 
         log.info('      *** Moving to (x,y) = ({0:6.4f}, {1:6.4f})'.format(
                     params.original_x, params.original_y))
+        targets = {'Motor_SampleX': params.original_x, 'Motor_SampleY': params.original_y}
+        targets.update(furnace_targets(global_PVs, params, params.furnace_in_position))
         #Check the limits
-        if not (global_PVs['Motor_SampleX'].within_limits(params.original_x)
-               and global_PVs['Motor_SampleY'].within_limits(params.original_y)):
+        if not within_limits(global_PVs, targets):
             log.error('        *** *** Sample in position past motor limits.')
             return
-        global_PVs['Motor_SampleX'].move(params.original_x, wait=True, timeout=10)
-        global_PVs['Motor_SampleY'].move(params.original_y, wait=True, timeout=10)
-        #Check if we ever got there
-        if (abs(global_PVs['Motor_SampleX'].readback - params.original_x) > 1e-3 
-            or abs(global_PVs['Motor_SampleY'].readback - params.original_y) > 1e-3):
+        #Move all axes together and check if we ever got there
+        if pvs.move_motors(global_PVs, targets, SAMPLE_MOVE_TIMEOUT):
             log.error('        *** *** Sample in motion failed!')
     except Exception as ee:
         log.error('EXCEPTION DURING SAMPLE IN MOTION!')
@@ -431,6 +629,12 @@ def stop_scan(global_PVs, params):
     global_PVs['Motor_SampleRot'].stop()
     global_PVs['HDF1_Capture'].put(0)
     aps7bm.wait_pv(global_PVs['HDF1_Capture'], 0)
+    # Finish no more files, and report what went wrong finishing them now
+    # rather than at the next scan
+    for error in pipeline.finalizer.cancel():
+        log.error('  *** Finishing error: %s' % error)
     pso.cleanup_PSO()
+    # The IOC may have been restarted; don't trust cached PV values
+    pvs.cache.invalidate()
     flir.init(global_PVs, params)
     log.error('  *** Stopping scan: Done!')
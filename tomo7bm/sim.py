@@ -0,0 +1,867 @@
+'''
+    Simulated 7-BM-B beamline, for running scans and benchmarks without IOCs.
+
+    Beamline holds in-process stand-ins for everything this package talks to:
+    the ExpInfo PVs, the shutter, the sample stack motors, the areaDetector
+    camera with its HDF writer, and the Aerotech PSO command record.  Select
+    it before any PVs are created, with install() or tomo --simulate:
+
+        from tomo7bm import sim
+        beamline = sim.install()
+
+    Everything runs in real time.  The camera makes frames from the current
+    shutter, sample and rotation positions, so flats, darks and the
+    alignment sphere behave roughly like the real thing.
+'''
+import os
+import math
+import time
+import queue
+import tempfile
+import threading
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+from tomo7bm import log
+from tomo7bm import pvs
+from tomo7bm import pso
+from tomo7bm import aps7bm
+from tomo7bm.pv_registry import CAMERA_PVS
+
+TICK = 0.005
+SHUTTER_TIME = 0.2
+MAX_FRAME_RATE = 160.0
+CAMERA_PREFIX = '7bm_pg4:'
+DARK_LEVEL = 100
+NOISE_LEVEL = 5.0
+BRIGHT_RATE = 2e4           # counts/s on the open beam
+SPHERE_RADIUS = 0.1         # mm
+SPHERE_ORBIT = 0.15         # mm from the rotation axis
+SPHERE_TRANSMISSION = 0.3
+
+ENABLE = ('Disable', 'Enable')
+YES_NO = ('No', 'Yes')
+
+# Enum strings of the camera PVs, by suffix
+CAMERA_ENUMS = {
+    'cam1:ImageMode': ('Single', 'Multiple', 'Continuous'),
+    'cam1:TriggerMode': ('Internal', 'Ext. Standard', 'Bulb', 'Skip Frames', 'Multi Exposure',
+                         'Multi Exposure Pulse', 'Low Smear', 'Overlapped'),
+    'cam1:Acquire': ('Done', 'Acquire'),
+    'cam1:ArrayCallbacks': ENABLE,
+    'cam1:FrameType': ('Normal', 'Background', 'FlatField'),
+    'image1:EnableCallbacks': ENABLE,
+    'image1:DataType_RBV': ('Int8', 'UInt8', 'Int16', 'UInt16', 'Int32', 'UInt32', 'Float32', 'Float64'),
+    'HDF1:AutoSave': YES_NO,
+    'HDF1:AutoIncrement': YES_NO,
+    'HDF1:DeleteDriverFile': YES_NO,
+    'HDF1:EnableCallbacks': ENABLE,
+    'HDF1:BlockingCallbacks': YES_NO,
+    'HDF1:FileWriteMode': ('Single', 'Capture', 'Stream'),
+    'HDF1:Capture': ('Done', 'Capture'),
+    'HDF1:Capture_RBV': ('Done', 'Capture'),
+    'Proc1:EnableCallbacks': ENABLE,
+    'Proc1:EnableFilter': ENABLE,
+    'Proc1:FilterType': ('RecursiveAve', 'Average', 'Sum', 'Difference', 'RecursiveAveDiff', 'CopyToFilter'),
+    'Proc1:AutoResetFilter': YES_NO,
+    'Proc1:FilterCallbacks': ('Every array', 'Array N only'),
+    'Proc1:EnableBackground': ENABLE,
+    'Proc1:EnableFlatField': ENABLE,
+    'Proc1:EnableOffsetScale': ENABLE,
+    'Proc1:EnableLowClip': ENABLE,
+    'Proc1:EnableHighClip': ENABLE,
+    }
+
+# Starting values of the camera PVs, by suffix; the rest start at 0
+CAMERA_DEFAULTS = {
+    'cam1:SerialNumber': 'SIM00001',
+    'cam1:PortName_RBV': 'PG1',
+    'cam1:ImageMode': 2,
+    'cam1:AcquirePeriod': 0.1,
+    'cam1:AcquireTime': 0.1,
+    'cam1:NumImages': 1,
+    'cam1:ArrayCallbacks': 1,
+    'cam1:FrameType.ZRST': 'Normal',
+    'cam1:FrameType.ONST': 'Background',
+    'cam1:FrameType.TWST': 'FlatField',
+    'cam1:SizeX': 612,
+    'cam1:SizeY': 512,
+    'cam1:SizeX_RBV': 612,
+    'cam1:SizeY_RBV': 512,
+    'cam1:MaxSizeX_RBV': 2448,
+    'cam1:MaxSizeY_RBV': 2048,
+    'cam1:PixelFormat_RBV': 'Mono16',
+    'cam1:BinX': 1,
+    'cam1:BinY': 1,
+    'image1:DataType_RBV': 3,
+    'image1:EnableCallbacks': 1,
+    'image1:ArrayData': np.zeros(0, dtype=np.uint16),
+    'HDF1:FileName': 'sim',
+    'HDF1:FileTemplate': '%s%s_%3.3d.h5',
+    'HDF1:FileNumber': 1,
+    'HDF1:AutoIncrement': 1,
+    'HDF1:FileWriteMode': 2,
+    'HDF1:NDArrayPort': 'PG1',
+    'HDF1:NumCapture': 1,
+    'HDF1:QueueSize': 100,
+    'HDF1:QueueFree': 100,
+    'Proc1:NDArrayPort': 'PG1',
+    'Proc1:NumFilter': 1,
+    }
+
+# Camera PVs that the IOC has but the rest of the package does not use yet
+CAMERA_EXTRA_PVS = ('cam1:ArrayCounter_RBV', 'image1:UniqueId_RBV', 'HDF1:AutoIncrement')
+
+# Starting values of the ExpInfo PVs, by name in aps7bm.EXPINFO_PVS
+EXPINFO_DEFAULTS = {
+    'Station': '7-BM-B',
+    'Camera_IOC_Prefix': CAMERA_PREFIX,
+    'Sample_Name': 'sim',
+    'PixelSizeMicrons': 3.45,
+    'Lens_Magnification': 2.0,
+    'Num_White_Images': 20,
+    'Bright_Exp_Time': 0.1,
+    'Num_Projections': 1500,
+    'Sample_Rotation_End': 180.0,
+    'Sample_Rotation_Speed': 1.0,
+    'Sample_Retrace_Speed': 30.0,
+    'Sample_Out_Position_Y': 1.0,
+    'Scan_Replicates': 1,
+    }
+
+# Speeds (EGU/s), acceleration times (s) and limits of the station motors
+MOTOR_SETTINGS = {
+    'Motor_SampleX': dict(velocity=5.0, acceleration=0.2, limits=(-25.0, 25.0)),
+    'Motor_SampleY': dict(velocity=5.0, acceleration=0.2, limits=(-25.0, 25.0)),
+    'Motor_SampleRot': dict(velocity=30.0, acceleration=0.5, limits=(-1e5, 1e5)),
+    'Motor_Focus': dict(velocity=1.0, acceleration=0.2, limits=(-10.0, 10.0)),
+    }
+
+
+class SimPV():
+    '''In-process stand-in for an epics.PV.
+
+    A put stores the value and runs the monitor callbacks at once.  If
+    on_put is set, it is then called with the new value and may return a
+    threading.Event; the put only completes (for wait and callback) once the
+    event is set, the way areaDetector holds Acquire and Capture puts.
+    '''
+    def __init__(self, pvname, value=0, enum_strs=None, on_put=None):
+        self.pvname = pvname
+        self.enum_strs = enum_strs
+        self.on_put = on_put
+        self.connected = True
+        self.connection_callbacks = []
+        self.callbacks = {}
+        self._value = value
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return self._value
+
+    @property
+    def char_value(self):
+        return self._as_string(self._value)
+
+    def _as_string(self, value):
+        if (self.enum_strs is not None and isinstance(value, (int, np.integer))
+                and 0 <= value < len(self.enum_strs)):
+            return self.enum_strs[value]
+        return str(value)
+
+    def wait_for_connection(self, timeout=None):
+        return True
+
+    def get(self, count=None, as_string=False, timeout=None, **kw):
+        value = self._value
+        if as_string:
+            return self._as_string(value)
+        if count is not None and isinstance(value, np.ndarray):
+            return value[:count]
+        return value
+
+    def update(self, value):
+        '''Sets the value from the IOC side and runs the monitor callbacks.
+        '''
+        self._value = value
+        char_value = self._as_string(value)
+        with self._lock:
+            callbacks = list(self.callbacks.values())
+        timestamp = time.time()
+        for callback in callbacks:
+            callback(pvname=self.pvname, value=value, char_value=char_value, timestamp=timestamp)
+
+    def put(self, value, wait=False, timeout=30.0, callback=None, callback_data=None, **kw):
+        if self.enum_strs is not None and isinstance(value, str) and value in self.enum_strs:
+            value = self.enum_strs.index(value)
+        self.update(value)
+        done = self.on_put(value) if self.on_put is not None else None
+        if done is None:
+            if callback is not None:
+                callback(pvname=self.pvname, data=callback_data)
+            return 1
+        if wait:
+            if not done.wait(timeout):
+                return -1
+            if callback is not None:
+                callback(pvname=self.pvname, data=callback_data)
+            return 1
+        if callback is not None:
+            def complete():
+                done.wait()
+                callback(pvname=self.pvname, data=callback_data)
+            threading.Thread(target=complete, daemon=True).start()
+        return 1
+
+    def add_callback(self, callback, index=None, run_now=False, with_ctrlvars=True, **kw):
+        with self._lock:
+            if index is None:
+                self._next_index += 1
+                index = self._next_index
+            self.callbacks[index] = callback
+        if run_now:
+            callback(pvname=self.pvname, value=self._value, char_value=self.char_value,
+                     timestamp=time.time())
+        return index
+
+    def remove_callback(self, index=None):
+        with self._lock:
+            self.callbacks.pop(index, None)
+
+
+def _travel(t, distance, velocity, accel_time):
+    '''Distance covered t seconds into a trapezoidal move, and the move time.
+    accel_time is the time to reach velocity, as in the motor record ACCL.
+    '''
+    if distance <= 0:
+        return 0.0, 0.0
+    if accel_time <= 0:
+        duration = distance / velocity
+        return min(velocity * t, distance), duration
+    accel = velocity / accel_time
+    if velocity * accel_time > distance:
+        # Never reaches full speed
+        t_accel = math.sqrt(distance / accel)
+        peak = accel * t_accel
+    else:
+        t_accel = accel_time
+        peak = velocity
+    d_accel = 0.5 * accel * t_accel**2
+    duration = 2 * t_accel + (distance - 2 * d_accel) / peak
+    if t >= duration:
+        return distance, duration
+    if t < t_accel:
+        return 0.5 * accel * t**2, duration
+    if t < duration - t_accel:
+        return d_accel + peak * (t - t_accel), duration
+    return distance - 0.5 * accel * (duration - t)**2, duration
+
+
+class SimMotor():
+    '''Stand-in for an epics.Motor.
+
+    The record fields are SimPVs on the beamline, so a put to NAME.VAL moves
+    the motor just as move() does.  Moves follow a trapezoidal profile from
+    VELO and ACCL, and RBV is updated every TICK while moving.
+    '''
+    _alias = {'drive': 'VAL', 'readback': 'RBV', 'moving': 'MOVN', 'done_moving': 'DMOV',
+              'velocity': 'VELO', 'slew_speed': 'VELO', 'acceleration': 'ACCL',
+              'direction': 'DIR', 'high_limit': 'HLM', 'low_limit': 'LLM',
+              'description': 'DESC', 'units': 'EGU', 'precision': 'PREC',
+              'tweak_val': 'TWV', 'offset': 'OFF', 'set': 'SET'}
+
+    def __init__(self, beamline, name, position=0.0, velocity=10.0, acceleration=0.2,
+                 limits=(-1000.0, 1000.0)):
+        self.beamline = beamline
+        self._prefix = name
+        self.pvname = name
+        fields = OrderedDict([('VAL', position), ('RBV', position), ('DMOV', 1), ('MOVN', 0),
+                              ('VELO', velocity), ('ACCL', acceleration), ('LLM', limits[0]),
+                              ('HLM', limits[1]), ('DIR', 0), ('OFF', 0.0), ('SET', 0),
+                              ('STOP', 0), ('LVIO', 0), ('HLS', 0), ('LLS', 0), ('SPMG', 3),
+                              ('DESC', ''), ('EGU', ''), ('RTYP', 'motor'), ('PREC', 4),
+                              ('TWV', 1.0), ('STAT', 0)])
+        self._pvs = OrderedDict()
+        for field, value in fields.items():
+            self._pvs[field] = beamline.add_pv('%s.%s' % (name, field), value)
+        self._pvs['VAL'].on_put = self._start_move
+        self._pvs['STOP'].on_put = self._stop_move
+        self._lock = threading.Lock()
+        self._halt = threading.Event()
+        self._thread = None
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        attr = self._alias.get(attr, attr)
+        if attr in self._pvs:
+            return self._pvs[attr].get()
+        raise AttributeError('SimMotor has no attribute %s' % attr)
+
+    def PV(self, attr, connect=True, **kw):
+        attr = self._alias.get(attr, attr)
+        if attr not in self._pvs:
+            self._pvs[attr] = self.beamline.add_pv('%s.%s' % (self._prefix, attr))
+        return self._pvs[attr]
+
+    def get(self, attr, as_string=False, **kw):
+        return self.PV(attr).get(as_string=as_string)
+
+    def put(self, attr, value, wait=False, use_complete=False, timeout=10, **kw):
+        return self.PV(attr).put(value, wait=wait, timeout=timeout)
+
+    def add_callback(self, attr='VAL', callback=None, **kw):
+        return self.PV(attr).add_callback(callback, **kw)
+
+    def remove_callback(self, attr='VAL', index=None):
+        self.PV(attr).remove_callback(index)
+
+    def within_limits(self, val, dial=False):
+        return self.get('LLM') <= val <= self.get('HLM')
+
+    def move(self, val=None, relative=False, wait=False, timeout=300.0,
+             ignore_limits=False, confirm_move=False, **kw):
+        '''Moves the motor, with the return codes of epics.Motor.move().
+        '''
+        try:
+            val = float(val)
+        except TypeError:
+            return -13
+        if relative:
+            val += self.get('VAL')
+        if not ignore_limits and not self.within_limits(val):
+            return -12
+        stat = self.put('VAL', val, wait=wait, timeout=timeout)
+        if wait:
+            if stat == -1:
+                return -8 if self.get('DMOV') == 0 else -7
+            return 0
+        return 1 if confirm_move else 0
+
+    def stop(self):
+        self.put('STOP', 1)
+
+    def _start_move(self, target):
+        with self._lock:
+            self._halt.set()
+            if self._thread is not None and self._thread is not threading.current_thread():
+                self._thread.join()
+            if not self.within_limits(target):
+                self._pvs['LVIO'].update(1)
+                self._pvs['VAL'].update(self._pvs['RBV'].get())
+                return None
+            self._pvs['LVIO'].update(0)
+            self._halt = threading.Event()
+            done = threading.Event()
+            self._pvs['DMOV'].update(0)
+            self._pvs['MOVN'].update(1)
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            args=(self._pvs['RBV'].get(), target, self._halt, done))
+            self._thread.start()
+            return done
+
+    def _stop_move(self, value):
+        self._halt.set()
+        self._pvs['STOP'].update(0)
+        return None
+
+    def _run(self, start, target, halt, done):
+        distance = abs(target - start)
+        sense = 1 if target >= start else -1
+        velocity = max(abs(self._pvs['VELO'].get()), 1e-6)
+        accel_time = self._pvs['ACCL'].get()
+        rbv = self._pvs['RBV']
+        start_time = time.perf_counter()
+        last_time, last_pos = start_time, start
+        try:
+            while True:
+                now = time.perf_counter()
+                covered, duration = _travel(now - start_time, distance, velocity, accel_time)
+                position = start + sense * covered
+                rbv.update(position)
+                self.beamline.motor_moved(self, last_pos, position, last_time, now)
+                last_time, last_pos = now, position
+                if covered >= distance or halt.wait(TICK):
+                    break
+        finally:
+            if halt.is_set():
+                # Stopped: the drive field follows the readback
+                self._pvs['VAL'].update(rbv.get())
+            self._pvs['MOVN'].update(0)
+            self._pvs['DMOV'].update(1)
+            done.set()
+
+
+class SimHDFWriter():
+    '''NDFileHDF5 stand-in that writes the mct3.xml layout.
+
+    Frames go to the /exchange dataset named by the camera FrameType string;
+    the unique ID and time stamps of each frame go to /defaults, like the
+    NDAttributes of the real plugin, with times since the EPICS epoch.
+
+    With a disk_rate (frames/s), frames wait in a queue of QueueSize and a
+    writer thread stores them at that rate, updating QueueFree; frames that
+    arrive with the queue full are dropped.  Otherwise they are stored as
+    they come.
+    '''
+    DATASETS = (('data', 'ImageData'), ('data_dark', 'DarkData'), ('data_white', 'WhiteData'))
+    DEFAULTS = (('NDArrayUniqueId', np.int32), ('NDArrayTimeStamp', np.float64),
+                ('NDArrayEpicsTSSec', np.uint32), ('NDArrayEpicsTSnSec', np.uint32))
+
+    def __init__(self, camera, disk_rate=None):
+        self.camera = camera
+        self.disk_rate = disk_rate
+        self.file = None
+        self.num_captured = 0
+        self._done = None
+        self._lock = threading.RLock()
+        self._queue = queue.Queue()
+        if disk_rate:
+            threading.Thread(target=self._drain, daemon=True).start()
+
+    def on_capture(self, value):
+        if value:
+            return self._open()
+        self.close()
+        return None
+
+    def _open(self):
+        camera = self.camera
+        with self._lock:
+            if self.file is not None:
+                return self._done
+            full_name = camera.get('HDF1:FileTemplate', as_string=True) % (
+                            camera.get('HDF1:FilePath', as_string=True),
+                            camera.get('HDF1:FileName', as_string=True),
+                            int(camera.get('HDF1:FileNumber')))
+            shape = (int(camera.get('cam1:SizeY_RBV')), int(camera.get('cam1:SizeX_RBV')))
+            try:
+                self.file = h5py.File(full_name, 'w')
+            except OSError as ee:
+                log.error('  *** Simulated HDF writer could not open %s: %s' % (full_name, ee))
+                camera.pv('HDF1:Capture').update(0)
+                return None
+            exchange = self.file.create_group('exchange')
+            for name, description in self.DATASETS:
+                dset = exchange.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape,
+                                               chunks=(1,) + shape, dtype=np.uint16)
+                dset.attrs['description'] = description
+                dset.attrs['axes'] = 'theta:y:x'
+                dset.attrs['units'] = 'counts'
+            defaults = self.file.create_group('defaults')
+            for name, dtype in self.DEFAULTS:
+                defaults.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype)
+            self.num_captured = 0
+            self._done = threading.Event()
+            camera.pv('HDF1:NumCaptured_RBV').update(0)
+            camera.pv('HDF1:FullFileName_RBV').update(full_name)
+            camera.pv('HDF1:Capture_RBV').update(1)
+            return self._done
+
+    def write(self, image, unique_id, time_stamp):
+        '''Appends one frame to the open file, or to the queue.
+        '''
+        camera = self.camera
+        with self._lock:
+            if self.file is None or not camera.get('HDF1:EnableCallbacks'):
+                return
+            path = camera.get('cam1:FrameType', as_string=True)
+            if not self.disk_rate:
+                return self._store(path, image, unique_id, time_stamp)
+            queue_free = int(camera.get('HDF1:QueueFree'))
+            if queue_free <= 0:
+                log.warning('  *** Simulated HDF queue full: frame %d dropped' % unique_id)
+                return
+            camera.pv('HDF1:QueueFree').update(queue_free - 1)
+            self._queue.put((self.file, path, image, unique_id, time_stamp))
+
+    def _drain(self):
+        '''Writer thread: stores the queued frames at disk_rate.
+        '''
+        while True:
+            hdf_file, path, image, unique_id, time_stamp = self._queue.get()
+            time.sleep(1.0 / self.disk_rate)
+            with self._lock:
+                self.camera.pv('HDF1:QueueFree').update(int(self.camera.get('HDF1:QueueFree')) + 1)
+                # Frames queued for a file closed since are lost
+                if self.file is hdf_file:
+                    self._store(path, image, unique_id, time_stamp)
+
+    def _store(self, path, image, unique_id, time_stamp):
+        camera = self.camera
+        with self._lock:
+            if path not in self.file or not isinstance(self.file[path], h5py.Dataset):
+                path = '/exchange/data'
+            time_stamp -= pvs.EPICS_EPOCH
+            seconds = math.floor(time_stamp)
+            values = (unique_id, time_stamp, seconds, int((time_stamp - seconds) * 1e9))
+            for dset, value in [(self.file[path], image)] + [
+                                (self.file['/defaults/' + name], value)
+                                for (name, dtype), value in zip(self.DEFAULTS, values)]:
+                dset.resize(dset.shape[0] + 1, axis=0)
+                dset[-1] = value
+            self.num_captured += 1
+            camera.pv('HDF1:NumCaptured_RBV').update(self.num_captured)
+            if self.num_captured >= camera.get('HDF1:NumCapture'):
+                self.close()
+
+    def close(self):
+        camera = self.camera
+        with self._lock:
+            if self.file is None:
+                return
+            self.file.close()
+            self.file = None
+            if camera.get('HDF1:AutoIncrement'):
+                camera.pv('HDF1:FileNumber').update(int(camera.get('HDF1:FileNumber')) + 1)
+            camera.pv('HDF1:Capture_RBV').update(0)
+            camera.pv('HDF1:Capture').update(0)
+            self._done.set()
+
+
+class SimCamera():
+    '''areaDetector camera stand-in: cam1, image1, Proc1 and HDF1.
+
+    In Internal trigger mode frames come every AcquirePeriod (never faster
+    than max_frame_rate).  In any other mode each PSO pulse triggers a
+    frame; pulses that arrive while the camera is still busy are dropped,
+    and counted in dropped_frames.
+    '''
+    def __init__(self, beamline, prefix=CAMERA_PREFIX, max_frame_rate=MAX_FRAME_RATE,
+                 file_path=None, disk_rate=None):
+        self.beamline = beamline
+        self.prefix = prefix
+        self.max_frame_rate = max_frame_rate
+        self.dropped_frames = 0
+        self.hdf = SimHDFWriter(self, disk_rate)
+        if file_path is None:
+            file_path = os.path.join(tempfile.gettempdir(), 'tomo7bm_sim')
+        os.makedirs(file_path, exist_ok=True)
+        defaults = dict(CAMERA_DEFAULTS)
+        defaults['HDF1:FilePath'] = os.path.join(file_path, '')
+        for suffix in list(CAMERA_PVS.values()) + list(CAMERA_EXTRA_PVS):
+            if self.prefix + suffix not in beamline.pvs:
+                beamline.add_pv(self.prefix + suffix, defaults.get(suffix, 0), CAMERA_ENUMS.get(suffix))
+        self.pv('cam1:Acquire').on_put = self._on_acquire
+        self.pv('HDF1:Capture').on_put = self.hdf.on_capture
+        self.pv('Proc1:ResetFilter').on_put = self._reset_filter
+        for suffix in ('SizeX', 'SizeY'):
+            self.pv('cam1:' + suffix).on_put = self._size_setter(suffix)
+        for i, field in enumerate(('ZRST', 'ONST', 'TWST')):
+            self.pv('cam1:FrameType.' + field).on_put = self._frame_type_setter(i)
+        self._triggers = queue.Queue()
+        self._acquiring = False
+        self._halt = threading.Event()
+        self._done = None
+        self._filter = []
+        self._unique_id = 0
+        self._lock = threading.Lock()
+
+    def pv(self, suffix):
+        return self.beamline.pvs[self.prefix + suffix]
+
+    def get(self, suffix, as_string=False):
+        return self.pv(suffix).get(as_string=as_string)
+
+    def _size_setter(self, suffix):
+        def on_put(value):
+            maximum = self.get('cam1:Max%s_RBV' % suffix)
+            self.pv('cam1:%s_RBV' % suffix).update(int(min(max(value, 1), maximum)))
+        return on_put
+
+    def _frame_type_setter(self, index):
+        def on_put(value):
+            names = list(self.pv('cam1:FrameType').enum_strs)
+            names[index] = str(value)
+            self.pv('cam1:FrameType').enum_strs = tuple(names)
+        return on_put
+
+    def _reset_filter(self, value):
+        self._filter = []
+
+    def trigger(self, trigger_time):
+        '''Queues an external trigger (a PSO pulse) at trigger_time.
+        '''
+        if self._acquiring:
+            self._triggers.put(trigger_time)
+
+    def _on_acquire(self, value):
+        with self._lock:
+            if not value:
+                self._halt.set()
+                return None
+            if self._acquiring:
+                return self._done
+            self._acquiring = True
+            self._halt = threading.Event()
+            self._done = threading.Event()
+            threading.Thread(target=self._acquire, args=(self._halt, self._done), daemon=True).start()
+            return self._done
+
+    def _acquire(self, halt, done):
+        mode = self.get('cam1:ImageMode', as_string=True)
+        if mode == 'Single':
+            num_images = 1
+        elif mode == 'Multiple':
+            num_images = int(self.get('cam1:NumImages'))
+        else:
+            num_images = math.inf
+        external = self.get('cam1:TriggerMode', as_string=True) != 'Internal'
+        min_period = 1.0 / self.max_frame_rate
+        period = max(self.get('cam1:AcquirePeriod'), self.get('cam1:AcquireTime'), min_period)
+        while not self._triggers.empty():
+            self._triggers.get_nowait()
+        self.pv('cam1:NumImagesCounter_RBV').update(0)
+        count = 0
+        last_frame = -math.inf
+        next_frame = time.perf_counter()
+        while count < num_images and not halt.is_set():
+            if external:
+                try:
+                    frame_time = self._triggers.get(timeout=TICK)
+                except queue.Empty:
+                    continue
+                if frame_time - last_frame < min_period:
+                    self.dropped_frames += 1
+                    continue
+            else:
+                next_frame += period
+                if halt.wait(max(next_frame - time.perf_counter(), 0)):
+                    break
+                frame_time = next_frame
+            last_frame = frame_time
+            self._frame()
+            count += 1
+            self.pv('cam1:NumImagesCounter_RBV').update(count)
+        with self._lock:
+            self._acquiring = False
+            self.pv('cam1:Acquire').update(0)
+            done.set()
+
+    def _frame(self):
+        shape = (int(self.get('cam1:SizeY_RBV')), int(self.get('cam1:SizeX_RBV')))
+        image = self.beamline.render(shape, self.get('cam1:AcquireTime'))
+        self._unique_id += 1
+        time_stamp = time.time()
+        self.pv('cam1:ArrayCounter_RBV').update(self._unique_id)
+        if not self.get('cam1:ArrayCallbacks'):
+            return
+        if self.get('image1:EnableCallbacks'):
+            self.pv('image1:ArrayData').update(image.ravel())
+            self.pv('image1:UniqueId_RBV').update(self._unique_id)
+        if self.get('HDF1:NDArrayPort', as_string=True) == 'PROC1':
+            image = self._process(image)
+            if image is None:
+                return
+        self.hdf.write(image, self._unique_id, time_stamp)
+
+    def _process(self, image):
+        '''Proc1 filter: averages NumFilter frames, passing on only the
+        last one if FilterCallbacks is "Array N only".
+        '''
+        if not (self.get('Proc1:EnableCallbacks') and self.get('Proc1:EnableFilter')):
+            return image
+        num_filter = max(int(self.get('Proc1:NumFilter')), 1)
+        self._filter.append(image)
+        average = np.mean(self._filter, axis=0).astype(np.uint16)
+        if len(self._filter) < num_filter:
+            if self.get('Proc1:FilterCallbacks', as_string=True) == 'Array N only':
+                return None
+            return average
+        if self.get('Proc1:AutoResetFilter'):
+            self._filter = []
+        else:
+            self._filter = self._filter[1:]
+        return average
+
+
+class SimPSO():
+    '''Aerotech Ensemble PSO behind its asyn command record.
+
+    Parses the ASCII commands written to the .BOUT field and answers in
+    .BINP ("%" for success, "!" for a command we don't understand).  Once
+    armed, a pulse fires each time the encoder position crosses a multiple
+    of the PSO distance from the arm point inside the PSO window, and each
+    pulse triggers the camera.
+    '''
+    def __init__(self, beamline, motor, asynRec, axis, encoder_multiply,
+                 encoder_direction=pso.ENCODER_DIRECTION, **kw):
+        self.beamline = beamline
+        self.motor = beamline.Motor(motor)
+        self.axis = axis
+        self.encoder_multiply = encoder_multiply
+        self.encoder_direction = encoder_direction
+        self.command_pv = beamline.add_pv(asynRec + '.BOUT', '', on_put=self._command)
+        self.reply_pv = beamline.add_pv(asynRec + '.BINP', '')
+        self.commands = []
+        self.reset()
+
+    def reset(self):
+        self.armed = False
+        self.distance = 0
+        self.window = None
+        self.arm_position = 0.0
+        self.pulses = 0
+
+    def _counts(self, position):
+        motor_dir = -1 if self.motor.direction else 1
+        return ((position - self.arm_position) * motor_dir
+                    * self.encoder_direction * self.encoder_multiply)
+
+    def _command(self, value):
+        command = str(value).strip()
+        self.commands.append(command)
+        words = command.replace(',', ' ').upper().split()
+        ok = len(words) >= 3 and words[1] == self.axis.upper()
+        if ok:
+            name, args = words[0], words[2:]
+            try:
+                if name == 'PSOCONTROL' and args[0] in ('RESET', 'OFF'):
+                    if args[0] == 'RESET':
+                        self.reset()
+                    self.armed = False
+                elif name == 'PSOCONTROL' and args[0] == 'ARM':
+                    self.arm_position = self.motor.readback
+                    self.pulses = 0
+                    self.armed = True
+                elif name == 'PSODISTANCE' and args[0] == 'FIXED':
+                    self.distance = abs(float(args[1]))
+                elif name == 'PSOWINDOW' and args[0] == 'OFF':
+                    self.window = None
+                elif name == 'PSOWINDOW' and args[1] == 'RANGE':
+                    self.window = (float(args[2]), float(args[3]))
+                elif name not in ('PSOOUTPUT', 'PSOPULSE', 'PSOTRACK', 'PSOWINDOW'):
+                    ok = False
+            except (IndexError, ValueError):
+                ok = False
+        self.reply_pv.update('%' if ok else '!')
+        return None
+
+    def track(self, old, new, old_time, new_time):
+        '''Fires the pulses for a move of the motor from old to new.
+        '''
+        if not self.armed or self.distance <= 0 or old == new:
+            return
+        start, end = self._counts(old), self._counts(new)
+        if end > start:
+            steps = range(math.floor(start / self.distance) + 1, math.floor(end / self.distance) + 1)
+        else:
+            steps = range(math.ceil(start / self.distance) - 1, math.ceil(end / self.distance) - 1, -1)
+        for step in steps:
+            counts = step * self.distance
+            if self.window is not None and not self.window[0] <= counts <= self.window[1]:
+                continue
+            self.pulses += 1
+            fraction = (counts - start) / (end - start)
+            self.beamline.camera.trigger(old_time + fraction * (new_time - old_time))
+
+
+class Beamline():
+    '''The simulated 7-BM-B station, usable as a pvs backend.
+
+    PV() and Motor() hand out the simulated objects by PV name; names we
+    don't simulate become plain SimPVs starting at 0.
+    '''
+    def __init__(self, max_frame_rate=MAX_FRAME_RATE, file_path=None, station='7-BM-B',
+                 disk_rate=None):
+        self.pvs = {}
+        self.motors = {}
+        self._lock = threading.RLock()
+        for name, suffix in aps7bm.EXPINFO_PVS.items():
+            self.add_pv(aps7bm.EXPINFO_PREFIX + suffix, EXPINFO_DEFAULTS.get(name, 0))
+        self.PV(aps7bm.EXPINFO_PREFIX + aps7bm.EXPINFO_PVS['Station']).update(station)
+        self.shutter_status = self.add_pv(aps7bm.SHUTTER_PVS['ShutterA_Move_Status'],
+                                          aps7bm.ShutterA_Close_Value)
+        self.add_pv(aps7bm.SHUTTER_PVS['ShutterA_Open'],
+                    on_put=self._shutter_mover(aps7bm.ShutterA_Open_Value))
+        self.add_pv(aps7bm.SHUTTER_PVS['ShutterA_Close'],
+                    on_put=self._shutter_mover(aps7bm.ShutterA_Close_Value))
+        self.stage = {}
+        for name, prefix in aps7bm.STATION_MOTORS[station].items():
+            self.stage[name] = self.Motor(prefix, **MOTOR_SETTINGS.get(name, {}))
+        self.camera = SimCamera(self, CAMERA_PREFIX, max_frame_rate, file_path, disk_rate)
+        self.pso = SimPSO(self, **pso.ROTATION_DRIVER)
+        self._noise = None
+
+    def add_pv(self, pvname, value=0, enum_strs=None, on_put=None):
+        with self._lock:
+            pv = SimPV(pvname, value, enum_strs, on_put)
+            self.pvs[pvname] = pv
+            return pv
+
+    def PV(self, pvname, **kw):
+        with self._lock:
+            if pvname not in self.pvs:
+                return self.add_pv(pvname)
+            return self.pvs[pvname]
+
+    def Motor(self, name, **settings):
+        if name.endswith('.VAL'):
+            name = name[:-4]
+        with self._lock:
+            if name not in self.motors:
+                self.motors[name] = SimMotor(self, name, **settings)
+                self.pvs[name] = self.motors[name].PV('VAL')
+            return self.motors[name]
+
+    def _shutter_mover(self, status):
+        def on_put(value):
+            if value:
+                threading.Timer(SHUTTER_TIME, self.shutter_status.update, (status,)).start()
+        return on_put
+
+    @property
+    def shutter_open(self):
+        return self.shutter_status.get() == aps7bm.ShutterA_Open_Value
+
+    def motor_moved(self, motor, old, new, old_time, new_time):
+        if motor is self.pso.motor:
+            self.pso.track(old, new, old_time, new_time)
+
+    def render(self, shape, exposure):
+        '''Returns one uint16 frame for the present shutter, sample and
+        rotation stage positions.
+        '''
+        ny, nx = shape
+        if self._noise is None or self._noise.shape[0] < 2 * ny or self._noise.shape[1] < 2 * nx:
+            self._noise = np.random.normal(0, NOISE_LEVEL, (2 * ny, 2 * nx)).astype(np.float32)
+        i, j = np.random.randint(ny), np.random.randint(nx)
+        image = self._noise[i:i + ny, j:j + nx] + DARK_LEVEL
+        if self.shutter_open:
+            beam = np.full(shape, BRIGHT_RATE * exposure, dtype=np.float32)
+            self._draw_sphere(beam)
+            image += beam
+        return np.clip(image, 0, 65535).astype(np.uint16)
+
+    def _draw_sphere(self, beam):
+        ny, nx = beam.shape
+        expinfo = aps7bm.EXPINFO_PREFIX
+        pixel_mm = (float(self.PV(expinfo + aps7bm.EXPINFO_PVS['PixelSizeMicrons']).get())
+                    / float(self.PV(expinfo + aps7bm.EXPINFO_PVS['Lens_Magnification']).get()) * 1e-3)
+        theta = math.radians(self.stage['Motor_SampleRot'].readback)
+        x = nx / 2 + (self.stage['Motor_SampleX'].readback + SPHERE_ORBIT * math.cos(theta)) / pixel_mm
+        y = ny / 2 - self.stage['Motor_SampleY'].readback / pixel_mm
+        r = SPHERE_RADIUS / pixel_mm
+        x0, x1 = max(int(x - r), 0), min(int(x + r) + 1, nx)
+        y0, y1 = max(int(y - r), 0), min(int(y + r) + 1, ny)
+        if x0 >= x1 or y0 >= y1:
+            return
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        inside = (xx - x)**2 + (yy - y)**2 < r**2
+        beam[y0:y1, x0:x1][inside] *= SPHERE_TRANSMISSION
+
+
+def install(max_frame_rate=MAX_FRAME_RATE, file_path=None, disk_rate=None):
+    '''Creates a simulated beamline and makes it the PV backend.
+    Call this before any PVs are created.  disk_rate (frames/s) limits how
+    fast the HDF writer stores frames; by default it keeps up.
+    '''
+    beamline = Beamline(max_frame_rate, file_path, disk_rate=disk_rate)
+    pvs.set_backend(beamline)
+    log.warning('  *** Using the simulated beamline; data go to %s'
+                    % beamline.camera.get('HDF1:FilePath', as_string=True))
+    return beamline
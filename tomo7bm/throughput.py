@@ -0,0 +1,232 @@
+'''
+    Measured camera and disk throughput, for the frame rate limits.
+
+    How fast we can take frames depends on the camera link, for the ROI,
+    binning and pixel format in use, and on how fast the HDF writer can
+    store them in the data directory.  Both are measured rather than
+    assumed: the camera by running it free with a short exposure, the disk
+    by writing a chunked HDF5 file like a scan file.  The results are kept
+    in config.THROUGHPUT_FILE and measured again once older than
+    params.throughput_max_age hours.
+
+    The HDF writer runs on the IOC host, so the disk test writes to
+    params.throughput_disk_path, where that disk is mounted here.  Without
+    it, or if the test fails, the disk gets the nominal
+    params.throughput_disk_rate.
+'''
+import os
+import json
+import time
+import threading
+
+import h5py
+import numpy as np
+
+from tomo7bm import aps7bm
+from tomo7bm import config
+from tomo7bm import flir
+from tomo7bm import log
+from tomo7bm import pipeline
+
+# Bytes per pixel on the camera link for each pixel format
+LINK_BYTES_PER_PIXEL = {'Mono8': 1, 'Mono12Packed': 1.5, 'Mono12p': 1.5, 'Mono12': 2, 'Mono16': 2}
+CAMERA_TEST_FRAMES = 100
+CAMERA_TEST_EXPOSURE = 1e-3
+# Size of the test file for the disk, and limits on its number of frames
+DISK_TEST_BYTES = 256e6
+DISK_TEST_FRAMES = (20, 1000)
+
+
+def load_table(file_name=config.THROUGHPUT_FILE):
+    '''Reads the {key: measurement} table of past measurements.
+    '''
+    if not os.path.exists(file_name):
+        return {}
+    try:
+        with open(file_name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        log.warning('  *** Could not read throughput table %s' % file_name)
+        return {}
+
+
+def save_table(table, file_name=config.THROUGHPUT_FILE):
+    temp_name = file_name + '.tmp'
+    try:
+        with open(temp_name, 'w') as f:
+            json.dump(table, f, indent=2)
+        os.replace(temp_name, file_name)
+    except OSError:
+        log.warning('  *** Could not save throughput table %s' % file_name)
+
+
+def frame_format(global_PVs):
+    '''Returns the rows and columns of the frames, the bytes per pixel on
+    the camera link and the numpy type the HDF writer stores them as.
+    '''
+    bin_x = max(int(global_PVs['Cam1_BinX'].get()), 1)
+    bin_y = max(int(global_PVs['Cam1_BinY'].get()), 1)
+    rows = int(global_PVs['Cam1_SizeY_RBV'].get()) // bin_y
+    cols = int(global_PVs['Cam1_SizeX_RBV'].get()) // bin_x
+    pixel_format = global_PVs['Cam1PixelFormat_RBV'].get(as_string=True)
+    link_bytes = LINK_BYTES_PER_PIXEL.get(pixel_format, 2)
+    dtype = np.uint8 if global_PVs['Cam1_Image_Dtype'].get(as_string=True) in ('Int8', 'UInt8') else np.uint16
+    return rows, cols, link_bytes, dtype
+
+
+def camera_key(global_PVs, params):
+    return 'camera {:s} {:d}x{:d} bin {:d}x{:d} {:s}'.format(
+                params.camera_ioc_prefix, int(global_PVs['Cam1_SizeX_RBV'].get()),
+                int(global_PVs['Cam1_SizeY_RBV'].get()), max(int(global_PVs['Cam1_BinX'].get()), 1),
+                max(int(global_PVs['Cam1_BinY'].get()), 1),
+                global_PVs['Cam1PixelFormat_RBV'].get(as_string=True))
+
+
+def disk_key(params):
+    return 'disk ' + params.throughput_disk_path
+
+
+def measure_camera(global_PVs, params, num_frames=CAMERA_TEST_FRAMES):
+    '''Runs the camera free for num_frames with a short exposure and returns
+    the frame rate it kept up, from the frame counter, leaving out the
+    first tenth of the frames while it starts up.  The camera settings are
+    restored afterwards.  Returns None if it took too few frames.
+    '''
+    names = ('Cam1_TriggerMode', 'Cam1_ImageMode', 'Cam1_NumImages', 'Cam1_AcquireTime', 'Cam1_AcquirePeriod')
+    saved = [(name, global_PVs[name].get()) for name in names]
+    counter = global_PVs['Cam1_NumImagesCounter']
+    frames = []
+    lock = threading.Lock()
+
+    def on_frame(value=None, **kw):
+        with lock:
+            frames.append((value, time.perf_counter()))
+
+    index = counter.add_callback(on_frame, with_ctrlvars=False)
+    try:
+        global_PVs['Cam1_TriggerMode'].put('Internal', wait=True)
+        global_PVs['Cam1_ImageMode'].put('Multiple', wait=True)
+        global_PVs['Cam1_NumImages'].put(num_frames, wait=True)
+        global_PVs['Cam1_AcquireTime'].put(CAMERA_TEST_EXPOSURE, wait=True)
+        global_PVs['Cam1_AcquirePeriod'].put(CAMERA_TEST_EXPOSURE, wait=True)
+        global_PVs['Cam1_Acquire'].put(flir.DetectorAcquire)
+        if not aps7bm.wait_pv(global_PVs['Cam1_Acquire'], flir.DetectorIdle, num_frames + 5):
+            global_PVs['Cam1_Acquire'].put(flir.DetectorIdle)
+    finally:
+        counter.remove_callback(index)
+        for name, value in saved:
+            global_PVs[name].put(value, wait=True)
+    with lock:
+        frames = [(value, t) for value, t in frames if value]
+    frames = frames[len(frames) // 10:]
+    if len(frames) < 2 or frames[-1][1] == frames[0][1]:
+        return None
+    return (frames[-1][0] - frames[0][0]) / (frames[-1][1] - frames[0][1])
+
+
+def measure_disk(directory, rows, cols, dtype, num_frames):
+    '''Writes num_frames frames to a chunked HDF5 file in directory, one
+    chunk per frame like the HDF writer, syncs it to disk and deletes it.
+    Returns the bytes written per second.
+    '''
+    file_name = os.path.join(directory, '.tomo7bm_throughput_%d.h5' % os.getpid())
+    frame = np.random.default_rng().integers(0, np.iinfo(dtype).max, (rows, cols), dtype=dtype)
+    try:
+        start = time.perf_counter()
+        with h5py.File(file_name, 'w') as hdf_f:
+            dset = hdf_f.create_dataset('/exchange/data', shape=(num_frames, rows, cols),
+                                        chunks=(1, rows, cols), dtype=dtype)
+            for i in range(num_frames):
+                dset[i] = frame
+        with open(file_name, 'rb') as f:
+            os.fsync(f.fileno())
+        elapsed = time.perf_counter() - start
+    finally:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    return num_frames * frame.nbytes / elapsed
+
+
+def _cached(table, key, max_age, now):
+    entry = table.get(key)
+    if entry is None or now - entry['time'] > max_age:
+        return None
+    return entry
+
+
+def max_framerates(global_PVs, params):
+    '''Returns the camera frame rates (Hz) the camera link and the disk can
+    sustain for this scan, measured or from the table.  With
+    params.throughput_calibration 'off', the nominal link model of
+    flir.calc_max_framerate and the nominal disk write rate.
+
+    The writer queue absorbs what the disk cannot keep up with, so the
+    disk only limits scans with more frames than the queue holds: at most
+    the frame rate at which the backlog just fills the queue.
+    '''
+    if params.throughput_calibration == 'off':
+        return (flir.calc_max_framerate(global_PVs, params),
+                disk_limit(global_PVs, params, 1e6 * params.throughput_disk_rate))
+    rows, cols, link_bytes, dtype = frame_format(global_PVs)
+    table = load_table()
+    now = time.time()
+    max_age = 3600.0 * params.throughput_max_age
+    recalibrate = params.throughput_calibration == 'recalibrate'
+    if recalibrate:
+        # Only this once: do not keep it in the config file
+        params.throughput_calibration = 'auto'
+        max_age = -1.0
+
+    key = camera_key(global_PVs, params)
+    camera = _cached(table, key, max_age, now)
+    if camera is None:
+        log.info('  *** *** Measure the camera frame rate for %s' % key)
+        pipeline.finalizer.wait_closed()
+        frame_rate = measure_camera(global_PVs, params)
+        if frame_rate is None:
+            log.warning('  *** *** The camera took no frames; use the nominal link speed')
+            camera = {'frame_rate': flir.calc_max_framerate(global_PVs, params)}
+        else:
+            camera = table[key] = {'frame_rate': frame_rate, 'bytes_per_s': frame_rate * rows * cols * link_bytes,
+                                   'time': now}
+    log.info('  *** *** Camera link: {:6.1f} Hz, {:6.1f} MB/s'.format(camera['frame_rate'],
+                camera['frame_rate'] * rows * cols * link_bytes / 1e6))
+
+    disk = None
+    if params.throughput_disk_path:
+        key = disk_key(params)
+        disk = _cached(table, key, max_age, now)
+        if disk is None:
+            frame_bytes = rows * cols * np.dtype(dtype).itemsize
+            num_frames = int(np.clip(DISK_TEST_BYTES / frame_bytes, *DISK_TEST_FRAMES))
+            log.info('  *** *** Measure the write rate of %s' % key)
+            pipeline.finalizer.wait_closed()
+            try:
+                disk = table[key] = {'bytes_per_s': measure_disk(params.throughput_disk_path,
+                                                                 rows, cols, dtype, num_frames),
+                                     'time': now}
+            except OSError as ee:
+                log.error('  *** *** Could not measure the disk write rate: %s' % ee)
+    elif recalibrate:
+        log.error('  *** *** No --throughput-disk-path to measure the disk write rate in')
+    save_table(table)
+    if disk is None:
+        log.warning('  *** *** Use the nominal disk write rate')
+        disk = {'bytes_per_s': 1e6 * params.throughput_disk_rate}
+    return camera['frame_rate'], disk_limit(global_PVs, params, disk['bytes_per_s'])
+
+
+def disk_limit(global_PVs, params, bytes_per_s):
+    '''Returns the highest camera frame rate (Hz) at which a disk writing
+    bytes_per_s keeps up with the scan.
+    '''
+    rows, cols, link_bytes, dtype = frame_format(global_PVs)
+    disk_framerate = bytes_per_s / (rows * cols * np.dtype(dtype).itemsize)
+    log.info('  *** *** Disk: {:6.1f} MB/s, {:6.1f} frames/s'.format(bytes_per_s / 1e6, disk_framerate))
+
+    # Frames per file, and camera frames per stored frame
+    num_frames = params.num_projections * (params.sleep_steps if params.continuous else 1)
+    queue_size = global_PVs['HDF1_QueueSize'].get()
+    if num_frames <= queue_size:
+        return np.inf
+    return disk_framerate / (1.0 - queue_size / num_frames) * params.recursive_filter_n_images
@@ -0,0 +1,113 @@
+'''
+    Dropped-frame checks of fly scan files.
+
+    Once a fly scan file has closed, check_frames() works out which PSO
+    pulse each projection in it came from.  It reads the NDArray UniqueId
+    and time stamp of every frame from /defaults, a chunk at a time.  A
+    jump in UniqueId means frames were lost after the camera, a gap of
+    two or more pulse periods means the camera missed triggers, and a
+    repeated UniqueId is a duplicate.  The measured rotation angles anchor
+    the first frame to its pulse.  add_theta() then writes the angle of
+    each stored frame as /exchange/theta and marks in /exchange/theta_valid
+    the frames that match a pulse exactly once.
+'''
+from collections import namedtuple
+
+import numpy as np
+
+from tomo7bm import log
+
+# Frames read from /defaults at a time
+CHUNK = 4096
+
+
+class FrameCheck(namedtuple('FrameCheck', ['pulse', 'valid', 'num_expected', 'num_missing',
+                                           'num_duplicate', 'num_outside', 'num_mismatch'])):
+    '''Result of check_frames(): the pulse (projection index) of each stored
+    frame and whether the frame is valid; the number of projections
+    expected, missing, stored twice and stored with no projection; and how
+    many frames the UniqueIds and time stamps disagree about.
+    '''
+    __slots__ = ()
+
+    def ok(self, max_missing=0):
+        return self.num_missing <= max_missing and self.num_duplicate == 0
+
+
+def read_chunked(dset, first, count, chunk=CHUNK):
+    '''Reads count values of a 1-D dataset from index first, chunk values
+    at a time; fewer if the dataset ends first.
+    '''
+    count = max(min(count, dset.shape[0] - first), 0)
+    out = np.empty(count, dtype=dset.dtype)
+    for start in range(0, count, chunk):
+        stop = min(start + chunk, count)
+        out[start:stop] = dset[first + start:first + stop]
+    return out
+
+
+def frame_steps(unique_ids, times, period, ids_per_frame=1):
+    '''Returns the number of pulses from each frame to the next.
+    UniqueId steps count frames lost after the camera, 0 for duplicates;
+    where they show one step, a time gap of two periods or more counts the
+    triggers the camera missed.  times may be None.
+    Also returns how many steps the two disagree about.
+    '''
+    steps = np.diff(unique_ids.astype(np.int64)) // ids_per_frame
+    steps = np.maximum(steps, 0)
+    num_mismatch = 0
+    if times is not None:
+        time_steps = np.rint(np.diff(times) / period).astype(np.int64)
+        missed = (steps == 1) & (time_steps >= 2)
+        steps[missed] = time_steps[missed]
+        num_mismatch = int(np.count_nonzero((steps > 1) & (time_steps != steps)))
+    return steps, num_mismatch
+
+
+def check_frames(unique_ids, times, theta_arr, speed, ids_per_frame=1, angles=None):
+    '''Matches stored frames to the projections planned at theta_arr, evenly
+    spaced and taken at speed (deg/s).  angles, the measured angle of each
+    frame, finds the projection of the first frame; without them the first
+    frame is the first projection.
+    '''
+    num_expected = len(theta_arr)
+    step = theta_arr[1] - theta_arr[0]
+    steps, num_mismatch = frame_steps(unique_ids, times, abs(step) / speed, ids_per_frame)
+    pulse = np.concatenate([[0], np.cumsum(steps)])
+    if angles is not None and np.isfinite(angles).any():
+        offset = np.nanmedian((angles - theta_arr[0]) / step - pulse)
+        pulse += int(np.rint(offset))
+    inside = (pulse >= 0) & (pulse < num_expected)
+    first = np.zeros(len(pulse), dtype=bool)
+    first[np.unique(pulse, return_index=True)[1]] = True
+    valid = inside & first
+    num_duplicate = int(np.count_nonzero(inside & ~first))
+    return FrameCheck(pulse, valid, num_expected, num_expected - int(np.count_nonzero(valid)),
+                      num_duplicate, int(np.count_nonzero(~inside)), num_mismatch)
+
+
+def uniform(theta_arr):
+    '''True if theta_arr is evenly spaced, as check_frames() needs.
+    '''
+    if len(theta_arr) < 2:
+        return False
+    spacing = np.diff(theta_arr)
+    return bool(spacing[0] != 0 and np.allclose(spacing, spacing[0], rtol=1e-6, atol=1e-9))
+
+
+def log_check(check, camera_frames=None, num_pulses=None):
+    '''Logs the result of check_frames(), as an error if any projection is
+    missing or duplicated.  camera_frames is the number of frames the
+    camera counted for num_pulses PSO pulses.
+    '''
+    report = log.info if check.ok() and not check.num_outside else log.error
+    report('  *** *** {:d} frames for {:d} projections: {:d} missing, {:d} duplicate, {:d} outside the scan'.format(
+                len(check.pulse), check.num_expected, check.num_missing, check.num_duplicate, check.num_outside))
+    if camera_frames is not None and camera_frames != num_pulses:
+        log.warning('  *** *** The camera took {:d} frames for {:d} PSO pulses'.format(int(camera_frames), num_pulses))
+    if check.num_missing:
+        missing = np.setdiff1d(np.arange(check.num_expected), check.pulse[check.valid])
+        log.error('  *** *** Missing projections: {:s}{:s}'.format(
+                    ' '.join(str(i) for i in missing[:20]), ' ...' if len(missing) > 20 else ''))
+    if check.num_mismatch:
+        log.warning('  *** *** UniqueId and time stamps disagree at {:d} frames'.format(check.num_mismatch))